@@ -2,26 +2,99 @@
 # it connects to redis and monitors a zset for jobs that it can do
 # TODO: should it receive shutdown notices from the scheduler? or redis? does it matter?
 # TODO: add responsible signal handling for graceful shutdown
-from typing import Optional, Literal
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, List, Optional, Literal, Set, Tuple
+import codecs
 import docker
-from app.persistence import dequeue_job
-from time import sleep
+import redis
+import requests
+import threading
+import traceback
 from os import cpu_count, environ
 from sys import exit
+from app import metrics
 from app.models import Job
+from app.persistence import (
+    HEARTBEAT_INTERVAL,
+    LOG_CHUNK_BYTES,
+    append_job_logs,
+    connect as connect_to_redis,
+    finish_job_logs,
+    heartbeat,
+    prune_executors,
+    renew_leases,
+    subscribe_to_aborts,
+    upcoming_images,
+    wait_for_work,
+    wake_executor,
+)
 from datetime import datetime
+from time import perf_counter, sleep
 from socket import gethostname, gethostbyname
 import psutil
 
-idle_time = environ.get("EXECUTOR_IDLE_TIME", 1)
-blocking_time = environ.get("EXECUTOR_BLOCKING_TIME", 1)
+# how long an idle executor blocks waiting for work before checking whether it should stop
+blocking_time = float(environ.get("EXECUTOR_BLOCKING_TIME", 5))
+# docker tells us when a container exits (see ContainerSupervisor). in case it ever doesn't,
+# we go and ask about a running container ourselves if we haven't heard anything in this long
+supervise_interval = float(environ.get("EXECUTOR_SUPERVISE_INTERVAL", 30))
+
+# how long a job's output can sit in our buffer before it's sent to redis anyway
+log_flush_interval = float(environ.get("EXECUTOR_LOG_FLUSH_INTERVAL", 0.5))
+
+# how much disk the images we pulled may take up before the least recently used ones go
+image_cache_gb = float(environ.get("EXECUTOR_IMAGE_CACHE_GB", 50))
+# how many jobs off the front of every queue we serve we pull the images of ahead of time,
+# and how often we go and look
+prefetch_depth = int(environ.get("EXECUTOR_PREFETCH_DEPTH", 10))
+prefetch_interval = float(environ.get("EXECUTOR_PREFETCH_INTERVAL", 5))
+
+# serve our metrics (see app.metrics) on this port, off unless it's set
+metrics_port = int(environ.get("EXECUTOR_METRICS_PORT", 0))
+
+# our containers are labelled with who runs them and for which job, so we can pick our own
+# out of the docker events stream
+EXECUTOR_LABEL = "jobservitor.executor"
+JOB_LABEL = "jobservitor.job"
+
+
+class LazyDockerClient:
+    """
+    Stands in for the docker client and only makes the real one (with factory) the first
+    time it's used. Making one talks to the daemon (to find out its API version), so doing
+    that when we're imported made every import of this module wait on docker, or exit
+    without it. See connect_to_docker for the check the executor does as it starts.
+    """
+
+    def __init__(self, factory: Callable[[], docker.DockerClient]):
+        self.factory = factory
+        self.client: Optional[docker.DockerClient] = None
+        self.lock = threading.Lock()
+
+    def get(self) -> docker.DockerClient:
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self.factory()
+        return self.client
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+
+client = LazyDockerClient(lambda: docker.from_env())
+
+
+def connect_to_docker():
+    """Make sure we can talk to docker, and get out if we can't. For when the executor starts"""
+    try:
+        print("Docker server version: " + client.info()["ServerVersion"])
+    except docker.errors.DockerException as e:
+        print(e)
+        exit(1)
 
-try:
-    client = docker.from_env()
-    print("Docker server version: " + client.info()["ServerVersion"])
-except docker.errors.DockerException as e:
-    print(e)
-    exit(1)
 
 # not the best way to get the IP
 executor_name = (
@@ -29,6 +102,461 @@ executor_name = (
 )
 
 
+class AbortListener:
+    """
+    Aborts get pushed to us over our own redis channel, so a running job doesn't have to keep
+    asking redis whether it got aborted. One subscription per executor, shared by every job.
+
+    Jobs watch() their id before they're claimed and get back an event that is set the
+    moment an abort for them comes in.
+    """
+
+    def __init__(self, worker: str):
+        self.worker = worker
+        self.watched: Dict[str, threading.Event] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = subscribe_to_aborts(self.worker, self.on_abort)
+
+    def on_abort(self, job_id: str):
+        with self.lock:
+            event = self.watched.get(job_id)
+        if event:
+            event.set()
+
+    def watch(self, job_id: str) -> threading.Event:
+        self.start()
+        with self.lock:
+            return self.watched.setdefault(job_id, threading.Event())
+
+    def unwatch(self, job_id: str):
+        with self.lock:
+            self.watched.pop(job_id, None)
+
+
+abort_listener = AbortListener(executor_name)
+
+
+class Heartbeat:
+    """
+    Every few seconds (HEARTBEAT_INTERVAL) we tell redis we're alive and how busy we are, and
+    renew the leases on every job we're holding (see dequeue_job) while we're at it.
+    All of that is one round trip from one background thread, however many jobs we're running,
+    so the jobs themselves never have to think about it.
+
+    If we ever find out we lost a lease (we were cut off from redis for longer than it
+    lasts and the reaper put the job back in line) the job is someone else's now, so we
+    stop it the same way an abort would.
+    """
+
+    def __init__(self, worker: str, on_lost: Callable[[str], None]):
+        self.worker = worker
+        self.on_lost = on_lost
+        self.held: Set[str] = set()
+        # what we registered with, empty while we aren't registered
+        self.info: Dict[str, str] = {}
+        self.ledger: Optional["ResourceLedger"] = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.keep_beating, daemon=True)
+                self.thread.start()
+
+    def keep_beating(self):
+        while True:
+            sleep(HEARTBEAT_INTERVAL)
+            self.beat()
+
+    def register(self, ledger: "ResourceLedger", **info):
+        """Show up in the registry, with what we've got (gpu_type, cpu_cores, memory_gb, dc, region)"""
+        with self.lock:
+            self.ledger = ledger
+            self.info = {"name": self.worker, **{k: str(v) for k, v in info.items()}}
+        # right away, so we take part in the fair share math from our first dequeue
+        self.beat()
+        self.start()
+
+    def deregister(self):
+        with self.lock:
+            self.info = {}
+            self.ledger = None
+        prune_executors([self.worker])
+
+    def beat(self):
+        with self.lock:
+            job_ids = list(self.held)
+            fields = dict(self.info)
+            ledger = self.ledger
+        if fields and ledger:
+            fields.update(ledger.usage())
+            fields["running_jobs"] = str(len(job_ids))
+        try:
+            if fields:
+                lost = heartbeat(self.worker, fields, job_ids)
+            else:
+                lost = renew_leases(self.worker, job_ids)
+        except redis.RedisError as e:
+            # we'll try again next time around, the lease has some slack for this
+            print(f"Could not send a heartbeat: {e}")
+            return
+        for job_id in lost:
+            print(f"Lost the lease on job {job_id}, stopping it")
+            self.on_lost(job_id)
+
+    def hold(self, job_id: str):
+        self.start()
+        with self.lock:
+            self.held.add(job_id)
+
+    def release(self, job_id: str):
+        # nothing to tell redis, the lease runs out and the reaper drops it
+        with self.lock:
+            self.held.discard(job_id)
+
+
+executor_heartbeat = Heartbeat(executor_name, abort_listener.on_abort)
+
+
+class ContainerExit:
+    """How a container went, filled in by the ContainerSupervisor as docker tells it"""
+
+    def __init__(self, wakeup: threading.Event):
+        # set once the container exited, or once there's something else we should look at
+        self.wakeup = wakeup
+        self.exit_code: Optional[int] = None
+        self.oom_killed = False
+
+    @property
+    def exited(self) -> bool:
+        return self.exit_code is not None
+
+
+class ContainerSupervisor:
+    """
+    Follows the docker events stream for our containers, one long lived connection for all of
+    them, instead of every running job asking docker about its container over and over.
+    The die (and oom) events land here and wake up the job they belong to.
+    """
+
+    def __init__(self, worker: str):
+        self.worker = worker
+        self.watched: Dict[str, ContainerExit] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        # when we last heard from docker, so a reconnect can pick up where we left off
+        self.since = None
+
+    def events(self):
+        return client.events(
+            decode=True,
+            since=self.since,
+            filters={
+                "type": "container",
+                "event": ["die", "oom"],
+                "label": [f"{EXECUTOR_LABEL}={self.worker}"],
+            },
+        )
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                # subscribe before we return, so no container we start after this can die unseen
+                stream = self.events()
+                self.thread = threading.Thread(
+                    target=self.follow, args=(stream,), daemon=True
+                )
+                self.thread.start()
+
+    def follow(self, stream):
+        while True:
+            try:
+                for event in stream:
+                    self.on_event(event)
+            except (docker.errors.DockerException, requests.RequestException) as e:
+                print(f"Lost the docker events stream: {e}")
+            # the stream ended or broke, pick it back up without missing anything
+            sleep(1)
+            try:
+                stream = self.events()
+            except (docker.errors.DockerException, requests.RequestException) as e:
+                print(f"Could not reconnect to the docker events stream: {e}")
+
+    def on_event(self, event: Dict):
+        self.since = event.get("time", self.since)
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        with self.lock:
+            container_exit = self.watched.get(attributes.get(JOB_LABEL))
+        if container_exit is None:
+            return
+
+        # docker sends the oom right before the die
+        if event.get("Action") == "oom":
+            container_exit.oom_killed = True
+        elif event.get("Action") == "die":
+            container_exit.exit_code = int(attributes.get("exitCode", -1))
+            container_exit.wakeup.set()
+
+    def watch(self, job_id: str, wakeup: threading.Event) -> ContainerExit:
+        """Start watching for the container of job_id, before it's started"""
+        self.start()
+        with self.lock:
+            return self.watched.setdefault(job_id, ContainerExit(wakeup))
+
+    def unwatch(self, job_id: str):
+        with self.lock:
+            self.watched.pop(job_id, None)
+
+
+container_supervisor = ContainerSupervisor(executor_name)
+
+
+class LogPump:
+    """
+    Copies a container's output into its job's log stream (see append_job_logs) while it runs.
+    A thread follows the docker log stream and sends it on in chunks of LOG_CHUNK_BYTES, so
+    we never hold more than about one chunk of it, however much the job prints.
+    Whatever is left over gets sent by flush(), which the job calls every log_flush_interval
+    so slow trickles of output still show up quickly.
+    """
+
+    def __init__(self, job_id: str, container):
+        self.job_id = job_id
+        self.container = container
+        # a chunk can end in the middle of a multi byte character, this keeps it for the next one
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer: List[str] = []
+        self.buffered = 0
+        # held while sending, so chunks can't overtake each other on the way to redis
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.pump, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def pump(self):
+        try:
+            for data in self.container.logs(stream=True, follow=True):
+                with self.lock:
+                    self.buffer.append(self.decoder.decode(data))
+                    self.buffered += len(data)
+                    if self.buffered >= LOG_CHUNK_BYTES:
+                        self.send()
+        except (docker.errors.DockerException, requests.RequestException) as e:
+            print(f"Lost the logs of job {self.job_id}: {e}")
+
+    def send(self):
+        chunk = "".join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        if chunk:
+            append_job_logs(self.job_id, chunk)
+
+    def flush(self):
+        with self.lock:
+            self.send()
+
+    def finish(self, timeout: float = 10):
+        """Once the container exited: wait for the last of its output and close the log"""
+        self.thread.join(timeout)
+        with self.lock:
+            self.buffer.append(self.decoder.decode(b"", final=True))
+            self.send()
+        finish_job_logs(self.job_id)
+
+
+class ImageCache:
+    """
+    The images our jobs run. A job that finds its image here starts right away, instead of
+    sitting there while docker pulls it. The prefetcher (see prefetch_images) fills this up
+    with the images of jobs that are coming our way.
+
+    What we pulled is kept under a disk budget (image_cache_gb), once we go over it the least
+    recently used images get removed. Never the ones a running job is using, and never images
+    we didn't pull or run ourselves, those are someone else's business.
+    """
+
+    def __init__(self, budget_gb: float):
+        self.budget = budget_gb * 1024**3
+        # image to its size in bytes, least recently used first
+        self.images: "OrderedDict[str, int]" = OrderedDict()
+        # how many running jobs use each image
+        self.in_use: Dict[str, int] = defaultdict(int)
+        # one pull per image at a time, a job waits for the prefetcher instead of pulling too
+        self.pulls: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def acquire(self, image: str) -> float:
+        """
+        Make sure we have image, and hold on to it until release(). Returns how long we waited
+        for it to be pulled, 0 if it was here already.
+        """
+        with self.lock:
+            self.in_use[image] += 1
+        try:
+            return self.fetch(image)
+        except BaseException:
+            self.release(image)
+            raise
+
+    def release(self, image: str):
+        with self.lock:
+            self.in_use[image] -= 1
+            if self.in_use[image] <= 0:
+                del self.in_use[image]
+
+    def fetch(self, image: str) -> float:
+        """Pull image unless we have it, and mark it used. Returns how long we waited"""
+        with self.lock:
+            if image in self.images:
+                self.images.move_to_end(image)
+                return 0
+            pull_lock = self.pulls[image]
+
+        start = perf_counter()
+        with pull_lock:
+            with self.lock:
+                pulled = image in self.images
+            if not pulled:
+                try:
+                    found = client.images.get(image)
+                except docker.errors.ImageNotFound:
+                    pull_started = perf_counter()
+                    found = client.images.pull(image)
+                    metrics.PULL_SECONDS.observe(perf_counter() - pull_started)
+                with self.lock:
+                    self.images[image] = found.attrs.get("Size", 0)
+                self.evict()
+        return perf_counter() - start
+
+    def evict(self):
+        """Remove the least recently used images until we're within budget again"""
+        # under the lock the whole time, so nobody starts using an image we're removing
+        with self.lock:
+            total = sum(self.images.values())
+            # the newest one stays no matter what, somebody is about to use it
+            for image, size in list(self.images.items())[:-1]:
+                if total <= self.budget:
+                    break
+                if image in self.in_use:
+                    continue
+                try:
+                    client.images.remove(image)
+                except docker.errors.ImageNotFound:
+                    # someone else removed it already, it's not taking up space either way
+                    pass
+                except docker.errors.APIError as e:
+                    # docker won't let it go, so it's still on the disk and still counts
+                    print(f"Could not remove image {image}: {e}")
+                    continue
+                total -= size
+                del self.images[image]
+
+
+image_cache = ImageCache(image_cache_gb)
+
+
+def prefetch_images(
+    stop: threading.Event,
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str,
+    region: str,
+):
+    """
+    Every so often look at the jobs at the front of the queues we take work from, and pull
+    the images we don't have yet. One at a time, the jobs running here need the bandwidth too.
+    """
+    while not stop.wait(prefetch_interval):
+        try:
+            images = upcoming_images(
+                gpu_type, cpu_cores, memory_gb, dc, region, depth=prefetch_depth
+            )
+        except redis.RedisError as e:
+            print(f"Could not look for images to prefetch: {e}")
+            continue
+        for image in images:
+            if stop.is_set():
+                return
+            try:
+                if image_cache.fetch(image):
+                    print(f"Prefetched {image}")
+            except (docker.errors.DockerException, requests.RequestException) as e:
+                # the job will fail on it the same way when it gets here
+                print(f"Could not prefetch {image}: {e}")
+
+
+class ResourceLedger:
+    """
+    Keeps track of how many of our cores and how much of our memory is promised to running jobs,
+    so we only ever pick up jobs that fit in what's left.
+    """
+
+    def __init__(self, cpu_cores: int, memory_gb: int):
+        self.cpu_cores = cpu_cores
+        self.memory_gb = memory_gb
+        self.reserved_cores = 0
+        self.reserved_memory = 0
+        self.released = threading.Condition()
+
+    def available(self) -> Tuple[int, int]:
+        """free cores and memory"""
+        with self.released:
+            return (
+                self.cpu_cores - self.reserved_cores,
+                self.memory_gb - self.reserved_memory,
+            )
+
+    def reserve(self, job: Job) -> bool:
+        with self.released:
+            if (
+                job.cpu_cores_requested > self.cpu_cores - self.reserved_cores
+                or job.memory_requested > self.memory_gb - self.reserved_memory
+            ):
+                return False
+            self.reserved_cores += job.cpu_cores_requested
+            self.reserved_memory += job.memory_requested
+            self.publish_usage()
+            return True
+
+    def usage(self) -> Dict[str, str]:
+        """How much of us is in use, for the heartbeat"""
+        with self.released:
+            return {
+                "cores_used": str(self.reserved_cores),
+                "memory_used": str(self.reserved_memory),
+            }
+
+    def release(self, job: Job):
+        with self.released:
+            self.reserved_cores -= job.cpu_cores_requested
+            self.reserved_memory -= job.memory_requested
+            self.publish_usage()
+            self.released.notify_all()
+
+    def publish_usage(self):
+        # called with the lock held
+        if self.cpu_cores:
+            metrics.EXECUTOR_BUSY.set(
+                self.reserved_cores / self.cpu_cores, resource="cpu"
+            )
+        if self.memory_gb:
+            metrics.EXECUTOR_BUSY.set(
+                self.reserved_memory / self.memory_gb, resource="memory"
+            )
+
+    def wait_for_release(self, timeout: float) -> bool:
+        """Block until a job gives its resources back, or the timeout runs out"""
+        with self.released:
+            return self.released.wait(timeout=timeout)
+
+
 # TODO: could be rewritten as a generator. for funsies and better readability.
 def handle_one_job(
     gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
@@ -38,95 +566,319 @@ def handle_one_job(
     region: str,
 ) -> Optional[Job]:
 
-    # look at my DC + my region + my GPU
-    job = dequeue_job(gpu_type, blocking_time, cpu_cores, memory_gb, dc, region)
+    # one round trip that walks my DC + my region + my GPU, then my DC + my region + any GPU,
+    # then my DC + any region + any GPU and finally any dc + any region + any gpu
+    job = Job.dequeue(gpu_type, cpu_cores, memory_gb, dc, region, executor_name)
 
-    # my DC + my region + any GPU
     if job is None:
-        job = dequeue_job("Any", blocking_time, cpu_cores, memory_gb, dc, region)
+        print("No job found, sleeping...")
+        return None
 
-    # look at my DC + any region + any GPU
-    if job is None:
-        job = dequeue_job("Any", blocking_time, cpu_cores, memory_gb, dc, "Any")
+    try:
+        return execute_job(job)
+    finally:
+        # dequeueing counted the job's cores as used in the registry, give them back
+        wake_executor(executor_name, released_cores=job.cpu_cores_requested)
 
-    # any dc + any region + any gpu
-    if job is None:
-        job = dequeue_job("Any", blocking_time, cpu_cores, memory_gb, "Any", "Any")
 
-    if job is None:
-        print("No job found, sleeping...")
-        return None
+def execute_job(job: Job) -> Optional[Job]:
+    """Run a job we popped off the queue, start to finish"""
+    # watch for aborts before claiming, so there's no gap where an abort could slip past us.
+    # the container exiting wakes us up through the same event
+    wakeup = abort_listener.watch(job.id)
+    container_exit = container_supervisor.watch(job.id, wakeup)
+    executor_heartbeat.hold(job.id)
+    try:
+        return run_job(job, wakeup, container_exit)
+    finally:
+        executor_heartbeat.release(job.id)
+        container_supervisor.unwatch(job.id)
+        abort_listener.unwatch(job.id)
+
+
+def run_job(
+    job: Job, wakeup: threading.Event, container_exit: ContainerExit
+) -> Optional[Job]:
+    queue_wait_seconds = (datetime.now() - job.submitted_at).total_seconds()
+    metrics.QUEUE_WAIT_SECONDS.observe(queue_wait_seconds)
+    # get the image while the job is still pending, so a slow pull doesn't count as running.
+    # it usually is here already, see prefetch_images
+    try:
+        pull_seconds = image_cache.acquire(job.image)
+    except (docker.errors.ImageNotFound, docker.errors.APIError):
+        if not job.transition(
+            ["pending"],
+            expected_worker=executor_name,
+            status="failed",
+            completed_at=datetime.now(),
+            queue_wait_seconds=queue_wait_seconds,
+        ):
+            # got aborted in the meantime, the abort wins
+            return Job.load(job.id)
+        return job
+
+    try:
+        return run_container(
+            job, wakeup, container_exit, queue_wait_seconds, pull_seconds
+        )
+    finally:
+        image_cache.release(job.image)
+
 
-    if job.status != "pending":
+def remove_container(container):
+    """
+    Get rid of a container that's done. Docker keeps stopped containers around, and one
+    that's left behind pins its image, so the image cache could never get it off the disk
+    """
+    try:
+        container.remove(force=True)
+    except docker.errors.APIError as e:
+        print(f"Could not remove container {container.id}: {e}")
+
+
+def run_container(
+    job: Job,
+    wakeup: threading.Event,
+    container_exit: ContainerExit,
+    queue_wait_seconds: float,
+    pull_seconds: float,
+) -> Optional[Job]:
+    # claim the job. this only goes through if nobody touched it since it was popped,
+    # e.g. an abort that landed between the dequeue and now, or the reaper handing it to
+    # someone else because our lease ran out. the same goes for every update from here on
+    if not job.transition(
+        ["pending"],
+        expected_worker=executor_name,
+        status="running",
+        started_at=datetime.now(),
+        worker=executor_name,
+        queue_wait_seconds=queue_wait_seconds,
+        pull_seconds=pull_seconds,
+    ):
         # this could be an exception at this layer, because a non-pending job
         # should never be popped
         return
 
-    job.status = "running"
-    job.started_at = datetime.now()
-    job.worker = executor_name
-    job.save()
-
     # detach so that we can return to it and kill it if needed
+    started = perf_counter()
     try:
         container = client.containers.run(
-            image=job.image, command=" ".join(job.command + job.arguments), detach=True
+            image=job.image,
+            command=" ".join(job.command + job.arguments),
+            detach=True,
+            labels={EXECUTOR_LABEL: executor_name, JOB_LABEL: job.id},
+            # hold the job to what it asked for, going over gets it oom killed
+            # instead of eating into the memory of the jobs next to it
+            mem_limit=f"{job.memory_requested}g",
+            # a task of an array job gets told which one it is
+            environment=(
+                {"JOB_ARRAY_INDEX": str(job.array_index)}
+                if job.array_index is not None
+                else None
+            ),
         )
     except (docker.errors.ImageNotFound, docker.errors.APIError):
-        job.status = "failed"
-        job.completed_at = datetime.now()
-        job.save()
+        if not job.transition(
+            ["running"],
+            expected_worker=executor_name,
+            status="failed",
+            completed_at=datetime.now(),
+        ):
+            # got aborted in the meantime, the abort wins
+            return Job.load(job.id)
 
         return job
 
-    while container.status != "exited":
-        # TODO: watch for kill signal on the executor
+    logs = LogPump(job.id, container)
+    logs.start()
+    try:
         # TODO: watch for resource consumption
-        container.reload()
-
-        # again,t his is very very bad engineering
-        # and solely first implementation just to get this working
-        # but what i need is a comms channel for the scheduler to tell the executor
-        # to kill the job
-        job = Job.load(job.id)
-        if job.status == "aborted":
-            container.kill()
-            job.completed_at = datetime.now()
-            job.status = "aborted"
-            job.save()
+        # nothing to do until docker tells us the container exited, or an abort gets pushed to us,
+        # so waiting here costs nothing on the docker or the redis side. we do wake up every so
+        # often to send whatever the job printed since the last time
+        last_heard = perf_counter()
+        while not wakeup.wait(timeout=log_flush_interval):
+            logs.flush()
+            if perf_counter() - last_heard < supervise_interval:
+                continue
+            # not a peep in a long while. make sure we didn't miss the exit somehow
+            last_heard = perf_counter()
+            container.reload()
+            if container.status == "exited":
+                state = container.attrs["State"]
+                container_exit.oom_killed = state.get("OOMKilled", False)
+                container_exit.exit_code = state.get("ExitCode", -1)
+                break
+
+        if not container_exit.exited:
+            # we got woken up by an abort (or the timeout, the scheduler's sweeper keeps an eye
+            # on the clock for us). completed_at - aborted_at on the job is how long it took to kill
+            try:
+                container.kill()
+            except docker.errors.APIError:
+                # it beat us to it and exited on its own
+                pass
+            logs.finish()
+            job = Job.load(job.id)
+            if job is None:
+                # a task of an array job is gone once it's done, unless it gets archived
+                return None
+            run_seconds = perf_counter() - started
+            if not job.transition(
+                ["aborted", "timed_out"],
+                expected_worker=executor_name,
+                completed_at=datetime.now(),
+                run_seconds=run_seconds,
+            ):
+                job = Job.load(job.id)
+                if job is None:
+                    return None
+            # by what it ended up as, whoever got to say so
+            metrics.RUN_SECONDS.observe(run_seconds, status=job.status)
             return job
 
-    # massively not ideal, but properly managing these logs
-    # is out of scope here (and indeed, for some enterprise tools that will
-    # remain nameless..)
-    print(container.logs().decode())
-    job.completed_at = datetime.now()
-    if container.wait()["StatusCode"] != 0:
-        job.status = "failed"
-    else:
-        job.status = "succeeded"
+        logs.finish()
+        status = "failed" if container_exit.exit_code != 0 else "succeeded"
+        run_seconds = perf_counter() - started
 
-    job.save()
+        if not job.transition(
+            ["running"],
+            expected_worker=executor_name,
+            status=status,
+            completed_at=datetime.now(),
+            exit_code=container_exit.exit_code,
+            oom_killed=container_exit.oom_killed,
+            run_seconds=run_seconds,
+        ):
+            # an abort (or the timeout) beat us to it, and the abort wins. or the job isn't
+            # ours anymore, and whoever has it now gets to say how it went
+            job = Job.load(job.id)
+            if job is not None:
+                metrics.RUN_SECONDS.observe(run_seconds, status=job.status)
+            return job
 
-    return job
+        metrics.RUN_SECONDS.observe(run_seconds, status=status)
+        return job
+    finally:
+        # we have its output and how it exited, that's all we needed it for
+        remove_container(container)
+
+
+def run_reserved_job(job: Job, ledger: ResourceLedger) -> Optional[Job]:
+    """execute_job for a job we reserved resources for, which get handed back however the job ends"""
+    try:
+        return execute_job(job)
+    finally:
+        ledger.release(job)
+        # the dispatch loop may be blocked in redis waiting for work, with room for more now.
+        # and the registry gets the cores back so our fair share is right again
+        wake_executor(executor_name, released_cores=job.cpu_cores_requested)
+
+
+def report_crash(job_id: str, future: Future):
+    """
+    Done callback of the jobs handed to the worker pool. Nobody waits on those futures, so
+    whatever blew up in there would go unnoticed otherwise
+    """
+    if future.cancelled() or future.exception() is None:
+        return
+    error = future.exception()
+    print(
+        f"💥 Running job {job_id} crashed:\n"
+        + "".join(traceback.format_exception(error)),
+        end="",
+    )
 
 
 def listen_for_work(
     gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"] = "Any",
     cpu_cores: int = 1,
     memory_gb: int = 1,
+    dc: str = "Any",
+    region: str = "Any",
+    stop: Optional[threading.Event] = None,
 ):
+    """
+    Keep picking up jobs for as long as we have room for them, and run them side by side.
+    Every job holds on to the cores and memory it asked for until it's done, so the
+    jobs running on this box never add up to more than it has.
 
-    while True:
-        handle_one_job(gpu_type, cpu_cores, memory_gb)
-        sleep(idle_time)
+    We show up in the executor registry while this runs (see Heartbeat), which is also how
+    dequeue_job knows to hold back when we're busier than the rest of the fleet.
+
+    Runs until stop is set, and then waits for the jobs that are still running.
+    """
+    stop = stop or threading.Event()
+    ledger = ResourceLedger(cpu_cores, memory_gb)
+    executor_heartbeat.register(
+        ledger,
+        gpu_type=gpu_type,
+        cpu_cores=cpu_cores,
+        memory_gb=memory_gb,
+        dc=dc,
+        region=region,
+    )
+
+    # pull the images of the jobs coming our way before they get here
+    threading.Thread(
+        target=prefetch_images,
+        args=(stop, gpu_type, cpu_cores, memory_gb, dc, region),
+        daemon=True,
+    ).start()
+
+    # every job takes at least one core, so we can never run more jobs than that
+    with ThreadPoolExecutor(max_workers=cpu_cores) as pool:
+        while not stop.is_set():
+            free_cores, free_memory = ledger.available()
+            job = None
+            if free_cores > 0 and free_memory > 0:
+                job = Job.dequeue(
+                    gpu_type, free_cores, free_memory, dc, region, executor_name
+                )
+
+            if job is None:
+                if free_cores > 0 and free_memory > 0:
+                    # nothing for us right now. block in redis until a job lands in one of our
+                    # queues, or one of our running jobs finishes and frees up room
+                    wait_for_work(
+                        gpu_type,
+                        free_cores,
+                        free_memory,
+                        dc,
+                        region,
+                        timeout=blocking_time,
+                        worker=executor_name,
+                    )
+                else:
+                    # we're full, nothing to do until a running job finishes
+                    ledger.wait_for_release(timeout=blocking_time)
+                continue
+
+            # only jobs that fit what's free get dequeued, so this can't fail
+            ledger.reserve(job)
+            pool.submit(run_reserved_job, job, ledger).add_done_callback(
+                partial(report_crash, job.id)
+            )
+
+    # we're not taking any more work, no need to wait for us to miss our heartbeats
+    executor_heartbeat.deregister()
 
 
 def start_worker():
     """The entry point for the worker to configure itself
     and begin listening for work.
     """
+    if metrics_port:
+        metrics.serve_metrics(metrics_port)
+    # both at once, there's no reason to wait for one before asking the other
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for check in [pool.submit(connect_to_docker), pool.submit(connect_to_redis)]:
+            check.result()
+    listen_for_work(**worker_config())
 
+
+def worker_config() -> Dict:
+    """What this box has to offer, out of the environment"""
     # gpu detection is probably done with something like pytorch
     # which doesnt install nicely on M4 macs
     gpu_type = environ.get("EXECUTOR_GPU_TYPE", "Any")
@@ -140,13 +892,13 @@ def start_worker():
     dc = environ.get("EXECUTOR_DATA_CENTER", "unknown-dc")
     region = environ.get("EXECUTOR_REGION", "unknown-dc")
 
-    listen_for_work(
-        gpu_type=gpu_type,
-        cpu_cores=cpu_cores,
-        memory_gb=memory_gb,
-        dc=dc,
-        region=region,
-    )
+    return {
+        "gpu_type": gpu_type,
+        "cpu_cores": cpu_cores,
+        "memory_gb": memory_gb,
+        "dc": dc,
+        "region": region,
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+"""Where finished jobs go to live out their days.
+
+Redis holds the queues and every job that's still pending or running, because the executors
+(on other boxes) and the lua scripts need those to be right there and atomic. Without a job
+store that's also where finished jobs stay, forever, so redis grows with the job history.
+
+With a job store configured (JOBSERVITOR_JOB_STORE) the scheduler moves finished jobs out of
+redis and into the store a little while after they finish (see app.persistence.archive_jobs),
+and reads them back from there. Redis then only grows with the jobs that are in flight.
+"""
+
+import json
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from os import environ
+from typing import Dict, List, Optional, Tuple
+
+# "redis" keeps everything in redis like it always did, "sqlite" archives finished jobs
+JOB_STORE = environ.get("JOBSERVITOR_JOB_STORE", "redis")
+SQLITE_PATH = environ.get("JOBSERVITOR_SQLITE_PATH", "jobservitor.db")
+
+
+class JobStore(ABC):
+    """
+    What app.persistence needs out of a job store. Records are the same flat dicts of strings
+    the redis hashes hold (see Job.to_record), score is when the job was submitted, as a
+    timestamp, which is what the listing indexes in redis are ordered by too.
+    """
+
+    @abstractmethod
+    def save(self, records: List[Tuple[Dict[str, str], float]]):
+        """Insert or replace a bunch of (record, score)s, all or nothing"""
+
+    @abstractmethod
+    def load(self, job_ids: List[str]) -> List[Dict[str, str]]:
+        """The records of the jobs that are in here, in no particular order"""
+
+    @abstractmethod
+    def list(
+        self,
+        status: Optional[str],
+        filters: Dict[str, str],
+        after: Optional[Tuple[float, str]],
+        limit: int,
+    ) -> List[Tuple[Dict[str, str], float]]:
+        """Up to limit (record, score)s, ordered by score and id, that come after `after`"""
+
+
+class SqliteJobStore(JobStore):
+    """
+    Finished jobs in a sqlite database, WAL mode so listing doesn't get in the way of archiving.
+    The fields we filter on get columns (and indexes) of their own, the whole record goes
+    into one more column as it is. The tasks of array jobs are in here too, but only their
+    arrays get listed, same as in redis.
+
+    sqlite connections can't be shared between threads, so every thread gets its own.
+    Nothing is opened until the store is first used.
+    """
+
+    COLUMNS = ("status", "gpu_type", "dc", "region", "worker", "array_id")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.created = False
+        self.lock = threading.Lock()
+
+    def create(self, db: sqlite3.Connection):
+        """The table and its indexes, by the first connection we open"""
+        with self.lock:
+            if self.created:
+                return
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    score REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    gpu_type TEXT,
+                    dc TEXT,
+                    region TEXT,
+                    worker TEXT,
+                    record TEXT NOT NULL,
+                    array_id TEXT NOT NULL DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS jobs_by_submitted_at ON jobs (score, id);
+                CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, score, id);
+                CREATE INDEX IF NOT EXISTS jobs_by_worker ON jobs (worker, score, id);
+                """)
+            # databases from before array jobs don't have the column yet
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+            if "array_id" not in columns:
+                db.execute(
+                    "ALTER TABLE jobs ADD COLUMN array_id TEXT NOT NULL DEFAULT ''"
+                )
+            db.commit()
+            self.created = True
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps us consistent with NORMAL, we'd only lose the last few commits to a power cut
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.create(db)
+            self.local.db = db
+        return db
+
+    def save(self, records: List[Tuple[Dict[str, str], float]]):
+        with self.connection() as db:
+            db.executemany(
+                f"INSERT OR REPLACE INTO jobs (id, score, {', '.join(self.COLUMNS)}, record)"
+                f" VALUES (?, ?, {', '.join('?' * len(self.COLUMNS))}, ?)",
+                [
+                    (
+                        record["id"],
+                        score,
+                        *[record.get(column, "") for column in self.COLUMNS],
+                        json.dumps(record),
+                    )
+                    for record, score in records
+                ],
+            )
+
+    def load(self, job_ids: List[str]) -> List[Dict[str, str]]:
+        if not job_ids:
+            return []
+        rows = self.connection().execute(
+            f"SELECT record FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})",
+            job_ids,
+        )
+        return [json.loads(record) for (record,) in rows]
+
+    def list(
+        self,
+        status: Optional[str],
+        filters: Dict[str, str],
+        after: Optional[Tuple[float, str]],
+        limit: int,
+    ) -> List[Tuple[Dict[str, str], float]]:
+        # the tasks of array jobs are listed as their array
+        conditions, params = ["array_id = ''"], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        for field, value in filters.items():
+            if field not in self.COLUMNS:
+                raise ValueError(f"Can't filter jobs on {field}")
+            conditions.append(f"{field} = ?")
+            params.append(value)
+        if after:
+            conditions.append("(score, id) > (?, ?)")
+            params += list(after)
+
+        rows = self.connection().execute(
+            "SELECT record, score FROM jobs"
+            + f" WHERE {' AND '.join(conditions)}"
+            + " ORDER BY score, id LIMIT ?",
+            [*params, limit],
+        )
+        return [(json.loads(record), score) for record, score in rows]
+
+
+def job_store_from_config() -> Optional[JobStore]:
+    """The job store to archive finished jobs to, None to keep them in redis"""
+    if JOB_STORE == "sqlite":
+        return SqliteJobStore(SQLITE_PATH)
+    if JOB_STORE != "redis":
+        raise ValueError(f"Unknown JOBSERVITOR_JOB_STORE {JOB_STORE}")
+    return None
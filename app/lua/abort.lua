@@ -0,0 +1,133 @@
+-- Abort jobs, either the ones we're given or every job in an index that matches a filter.
+--
+-- KEYS[1] the index to walk, the waiting, pending or running jobs (ignored when given ids)
+-- KEYS[2] the index of all jobs
+-- KEYS[3] the deadline index, a running job we abort leaves it
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] prefix of the job records, the job id gets appended to it
+-- ARGV[3] prefix of the executors' abort channels, the worker gets appended to it
+-- ARGV[4] what to put in aborted_at
+-- ARGV[5] where finished jobs wait to be archived, empty if we don't archive them
+-- ARGV[6] score of the cursor to walk KEYS[1] from, "-inf" for the start of it.
+--         Empty to abort exactly the jobs in ARGV[10..] instead of walking anything
+-- ARGV[7] id of the cursor, anything tied with its score up to and including this id was
+--         looked at by an earlier call (see list.lua)
+-- ARGV[8] how many entries we're willing to look at before handing back a cursor
+-- ARGV[9] the finish config, the jobs depending on the aborted ones fail (see finish.lua)
+-- ARGV[10..] the job ids to abort, or field, value pairs the jobs have to match when walking
+--
+-- Only waiting, pending and running jobs get aborted, anything else is left alone.
+-- A pending job comes out of the queue it's in (enqueueing and dequeueing both write
+-- down which one that is), so executors never come across it and the queue actually
+-- shrinks. The executor holding a job gets told to kill it over its abort channel, same
+-- as before. It's all one step, so an executor claiming the job either got there first
+-- (and gets the kill) or its claim fails.
+-- Aborting an array job (see dequeue.lua) aborts the tasks of it that are being worked
+-- on too, the ones nobody claimed yet go with the array.
+--
+-- Returns {next cursor score, next cursor id, aborted ids...}. The cursor is empty once
+-- the index is exhausted, and always when given ids.
+--
+-- NOTE: the job records and queues are not passed in as KEYS, same as dequeue.lua
+--!include finish
+local status_prefix, prefix, channel_prefix = ARGV[1], ARGV[2], ARGV[3]
+local aborted_at, archive = ARGV[4], ARGV[5]
+local tasks_prefix = cjson.decode(ARGV[9]).tasks
+
+local result = { "", "" }
+
+local function abort(job_id, task)
+    local job = prefix .. job_id
+    local fields = redis.call("HMGET", job, "status", "queue", "worker")
+    local status, queue, worker = fields[1], fields[2], fields[3]
+    if status ~= "waiting" and status ~= "pending" and status ~= "running" then
+        return
+    end
+
+    redis.call("HSET", job, "status", "aborted", "aborted_at", aborted_at)
+    redis.call("ZREM", status_prefix .. status, job_id)
+    local score = redis.call("ZSCORE", KEYS[2], job_id)
+    if score then
+        redis.call("ZADD", status_prefix .. "aborted", score, job_id)
+    end
+    if status == "running" then
+        redis.call("ZREM", KEYS[3], job_id)
+    end
+    -- a running array job is still queued while it has tasks nobody claimed yet
+    if queue then
+        redis.call("ZREM", queue, job_id)
+    end
+    if archive ~= "" then
+        local now = redis.call("TIME")
+        redis.call("ZADD", archive, now[1], job_id)
+    end
+    if worker then
+        redis.call("PUBLISH", channel_prefix .. worker, job_id)
+    end
+    finish_job(job_id, "aborted", ARGV[9])
+    for _, task_id in ipairs(redis.call("SMEMBERS", tasks_prefix .. job_id)) do
+        abort(task_id, true)
+    end
+    if not task then
+        table.insert(result, job_id)
+    end
+end
+
+if ARGV[6] == "" then
+    for i = 10, #ARGV do
+        abort(ARGV[i])
+    end
+    return result
+end
+
+local cursor_score, cursor_id = ARGV[6], ARGV[7]
+local budget = tonumber(ARGV[8])
+local filter_fields, filter_values = {}, {}
+for i = 10, #ARGV, 2 do
+    table.insert(filter_fields, ARGV[i])
+    table.insert(filter_values, ARGV[i + 1])
+end
+
+-- walk first and abort after, aborting takes the jobs out of the index we're walking
+local matching, examined, offset = {}, 0, 0
+while examined < budget do
+    local entries = redis.call(
+        "ZRANGEBYSCORE", KEYS[1], cursor_score, "+inf", "WITHSCORES", "LIMIT", offset, budget
+    )
+    if #entries == 0 then
+        break
+    end
+    offset = offset + #entries / 2
+
+    for i = 1, #entries, 2 do
+        local job_id, score = entries[i], entries[i + 1]
+        local seen = cursor_id ~= "" and tonumber(score) == tonumber(cursor_score) and job_id <= cursor_id
+        if not seen then
+            examined = examined + 1
+
+            local matches = true
+            if #filter_fields > 0 then
+                local values = redis.call("HMGET", prefix .. job_id, unpack(filter_fields))
+                for k = 1, #filter_fields do
+                    if values[k] ~= filter_values[k] then
+                        matches = false
+                        break
+                    end
+                end
+            end
+            if matches then
+                table.insert(matching, job_id)
+            end
+
+            if examined >= budget then
+                result[1], result[2] = score, job_id
+                break
+            end
+        end
+    end
+end
+
+for _, job_id in ipairs(matching) do
+    abort(job_id)
+end
+return result
@@ -0,0 +1,73 @@
+-- Hold a freshly saved job that depends on other jobs until they're done, instead of
+-- putting it in its queue.
+--
+-- KEYS[1] the job record
+-- ARGV[1] the finish config (see app.persistence.finish_config)
+-- ARGV[2] the job id
+-- ARGV[3] the queue the job goes into once its dependencies are done
+-- ARGV[4] its score in there (see queue_score)
+-- ARGV[5..] dependency id, status pairs. The status is what the job store says for a
+--           dependency that's archived out of redis already, empty if it doesn't have it
+--
+-- Whatever is already done is settled right here: a job whose dependencies all succeeded
+-- goes straight into its queue, and one with a dependency that failed (or doesn't exist)
+-- fails. Otherwise the job goes into the dependents set of everything it still waits on,
+-- with a count of those, and waits. It's all one step, so a dependency can't finish
+-- between us looking at it and signing up for hearing about it (see finish.lua).
+--
+-- Returns the status the job ended up in.
+--!include enqueue
+local c = cjson.decode(ARGV[1])
+local job_id, queue = ARGV[2], ARGV[3]
+
+local left, failed_dependency, seen = 0, nil, {}
+for i = 5, #ARGV, 2 do
+    local dependency = ARGV[i]
+    if not seen[dependency] then
+        seen[dependency] = true
+        local status = redis.call("HGET", c.jobs .. dependency, "status") or ARGV[i + 1]
+        if status ~= "succeeded" then
+            local finished = status == ""
+            for _, terminal in ipairs(c.finished) do
+                finished = finished or terminal == status
+            end
+            if finished then
+                failed_dependency = failed_dependency or dependency
+            else
+                redis.call("SADD", c.dependents .. dependency, job_id)
+                left = left + 1
+            end
+        end
+    end
+end
+
+-- remember where it goes, for when it's released (and so an abort knows where to look)
+redis.call("HSET", KEYS[1], "queue", queue)
+local status = "pending"
+if failed_dependency then
+    status = "failed"
+    redis.call(
+        "HSET", KEYS[1], "status", status, "completed_at", c.now,
+        "failed_dependency", failed_dependency
+    )
+    if c.archive ~= "" then
+        local now = redis.call("TIME")
+        redis.call("ZADD", c.archive, now[1], job_id)
+    end
+elseif left > 0 then
+    status = "waiting"
+    redis.call("HSET", KEYS[1], "status", status, "dependencies_left", left)
+else
+    -- an executor for every task of an array job, see app.persistence.wake_tokens
+    local tokens = tonumber(redis.call("HGET", KEYS[1], "array_size")) or 1
+    queue_job(c, queue, job_id, tonumber(ARGV[4]), tokens)
+end
+
+if status ~= "pending" then
+    redis.call("ZREM", c.statuses .. "pending", job_id)
+    local score = redis.call("ZSCORE", c.all, job_id)
+    if score then
+        redis.call("ZADD", c.statuses .. status, score, job_id)
+    end
+end
+return status
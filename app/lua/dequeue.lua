@@ -0,0 +1,222 @@
+-- Atomically pick the next job an executor can run.
+--
+-- KEYS are the size sets of the candidate buckets (see app.persistence.sizes_key), grouped
+-- into tiers that the executor wants checked in order (own gpu/dc/region first, the Any
+-- fallbacks after that). Every tier is made up of the resource buckets the executor can fit.
+-- ARGV[1] memory the executor has, in GB
+-- ARGV[2] cpu cores the executor has
+-- ARGV[3] prefix of the job records, the job id gets appended to it
+-- ARGV[4] the most queue entries to look at in one go
+-- ARGV[5] the in-flight set, job ids scored by when their lease runs out
+-- ARGV[6] how long the lease on the picked job lasts, in seconds
+-- ARGV[7] the executor asking, it becomes the owner of the lease
+-- ARGV[8] the registry record of that executor (see heartbeat.lua), "" for anonymous callers
+-- ARGV[9] the fleet wide totals of cores and cores in use
+-- ARGV[10] how far above the fleet's utilization an executor can be before it backs off
+-- ARGV[11] jobs that have been waiting this many seconds go to whoever asks, busy or not
+-- ARGV[12] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[13] the index of all jobs
+-- ARGV[14] prefix of the sets of tasks of array jobs that are being worked on
+-- ARGV[15] prefix of the queues
+-- ARGV[16] prefix of the size sets, what's after it is the bucket
+-- ARGV[17] the set of the names of all queues
+-- ARGV[18..] how many KEYS belong to each tier
+--
+-- Every size of job has a queue of its own in its bucket (see app.persistence.queue_name),
+-- and the bucket has a set of the sizes it has queues for. So jobs too big for us are
+-- skipped a whole queue at a time, by their size, without reading a single one of them,
+-- and the front of every queue we do fit in is a job we can run. How long this takes
+-- doesn't depend on how many jobs are waiting, only on how many sizes there are.
+-- Within a tier we take the oldest job that fits across all its queues.
+-- Only the job that gets picked is removed from its queue, everything else
+-- keeps its place (and its score), so FIFO order survives a miss.
+-- Entries whose record is gone or is no longer pending are garbage and get
+-- dropped on the way past, and a queue that's empty comes out of its size set (and the set
+-- of all queues). We look at
+-- no more than ARGV[4] entries in one go, whatever we don't get to the next call picks up.
+--
+-- The picked job goes into the in-flight set with a lease, in the same step that takes
+-- it off its queue, so there is no moment where the job only exists in the executor's
+-- memory. The executor renews the lease while it works (see renew.lua) and the reaper
+-- puts the job back in line if it stops doing that (see reap.lua). Leases are timed
+-- with the redis clock so executors and schedulers don't have to agree on the time.
+--
+-- To keep one executor from hogging the work just because it asks the most, an executor
+-- that is busier than the fleet as a whole (cores in use over cores it has) leaves fresh
+-- jobs to the others. Once a job has waited long enough anyone gets it, so a job nobody
+-- else can run is only ever held up a little. The cores an executor is using are bumped
+-- right here, and given back when the job is done (see release.lua).
+-- How long a job has waited goes by its queue score, so a high priority job counts as
+-- having waited longer and goes to whoever asks sooner.
+--
+-- An array job (one with an array_size) sits in its queue once, for all of its tasks.
+-- Picking it claims the next task index, and only the last one takes it off the queue.
+-- The task gets a job record of its own right here, a copy of the array's with id
+-- <array id>_<index>, an array_id and its array_index, and from then on it's a job like
+-- any other: it has a lease, runs, times out and gets reaped by itself. It's not in the
+-- listing indexes though, the array is listed (and aborted) as a whole, and it finishes
+-- with its last task (see finish.lua).
+--
+-- Returns the picked job record as a flat HGETALL style list.
+--
+-- NOTE: the job records are not passed in as KEYS, so this will not fly on
+-- redis cluster. We're a single redis for now.
+local memory_gb = tonumber(ARGV[1])
+local cpu_cores = tonumber(ARGV[2])
+local prefix = ARGV[3]
+local scan_limit = tonumber(ARGV[4])
+local inflight = ARGV[5]
+local lease_seconds = tonumber(ARGV[6])
+local worker = ARGV[7]
+local executor = ARGV[8]
+local fleet = ARGV[9]
+local share_slack = tonumber(ARGV[10])
+local backoff_grace = tonumber(ARGV[11])
+local status_prefix = ARGV[12]
+local all = ARGV[13]
+local tasks_prefix = ARGV[14]
+local queue_prefix = ARGV[15]
+local sizes_prefix = ARGV[16]
+local queue_registry = ARGV[17]
+
+-- what stays with the array when a task of it gets a record of its own
+local array_only = {
+    id = true, status = true, array_size = true, tasks_claimed = true,
+    tasks_succeeded = true, tasks_failed = true, depends_on = true, dependencies_left = true,
+}
+
+local now = redis.call("TIME")
+now = now[1] + now[2] / 1000000
+
+-- are we busier than everybody else?
+local registered = executor ~= "" and redis.call("EXISTS", executor) == 1
+local above_share = false
+if registered then
+    local mine = redis.call("HMGET", executor, "cpu_cores", "cores_used")
+    local all = redis.call("HMGET", fleet, "cpu_cores", "cores_used")
+    local my_cores, my_used = tonumber(mine[1]) or 0, tonumber(mine[2]) or 0
+    local fleet_cores = tonumber(all[1]) or 0
+    if my_used > 0 and my_cores > 0 and fleet_cores > 0 then
+        above_share = my_used / my_cores > (tonumber(all[2]) or 0) / fleet_cores + share_slack
+    end
+end
+
+-- how many more queue entries we're willing to look at
+local budget = scan_limit
+
+-- the oldest job in this queue that we can fit, as id, score, cores, status and array size.
+-- nil if there is none, or we ran out of budget before we found it
+local function first_fit(queue)
+    local offset = 0
+    while budget > 0 do
+        local candidates = redis.call(
+            "ZRANGE", queue, offset, offset + budget - 1, "WITHSCORES"
+        )
+        if #candidates == 0 then
+            return nil
+        end
+        for i = 1, #candidates, 2 do
+            local job_id = candidates[i]
+            budget = budget - 1
+            -- only read the few fields we need, not the whole record
+            local job = redis.pcall(
+                "HMGET", prefix .. job_id, "status", "memory_requested", "cpu_cores_requested",
+                "array_size"
+            )
+            if job.err then
+                -- a json record from before records were hashes (see
+                -- app.persistence.migrate_queues), not ours to judge. leave it where it is
+                offset = offset + 1
+            -- an array job runs while there are tasks of it left to claim
+            elseif job[1] ~= "pending" and not (job[1] == "running" and job[4]) then
+                redis.call("ZREM", queue, job_id)
+            elseif tonumber(job[2]) <= memory_gb and tonumber(job[3]) <= cpu_cores then
+                return job_id, tonumber(candidates[i + 1]), tonumber(job[3]), job[1],
+                    tonumber(job[4])
+            else
+                -- the queue says it fits and the job says otherwise. leave it be
+                offset = offset + 1
+            end
+            if budget <= 0 then
+                return nil
+            end
+        end
+    end
+    return nil
+end
+
+-- give the next task of an array job a record of its own, returns its id
+local function claim_task(array_id, queue, status, size)
+    local array = prefix .. array_id
+    local index = redis.call("HINCRBY", array, "tasks_claimed", 1) - 1
+    if index + 1 >= size then
+        redis.call("ZREM", queue, array_id)
+    end
+    if status == "pending" then
+        redis.call("HSET", array, "status", "running")
+        redis.call("ZREM", status_prefix .. "pending", array_id)
+        local score = redis.call("ZSCORE", all, array_id)
+        if score then
+            redis.call("ZADD", status_prefix .. "running", score, array_id)
+        end
+    end
+
+    local task_id = array_id .. "_" .. index
+    local task = { "id", task_id, "status", "pending", "array_id", array_id, "array_index", index }
+    local record = redis.call("HGETALL", array)
+    for i = 1, #record, 2 do
+        if not array_only[record[i]] then
+            table.insert(task, record[i])
+            table.insert(task, record[i + 1])
+        end
+    end
+    redis.call("HSET", prefix .. task_id, unpack(task))
+    redis.call("SADD", tasks_prefix .. array_id, task_id)
+    return task_id
+end
+
+local offset = 0
+for tier = 18, #ARGV do
+    local best_queue, best_id, best_score, best_cores, best_status, best_size
+    for k = offset + 1, offset + tonumber(ARGV[tier]) do
+        local bucket = string.sub(KEYS[k], #sizes_prefix + 1)
+        for _, job_size in ipairs(redis.call("SMEMBERS", KEYS[k])) do
+            local memory, cores = string.match(job_size, "^(%d+)x(%d+)$")
+            if tonumber(memory) <= memory_gb and tonumber(cores) <= cpu_cores then
+                local queue = queue_prefix .. bucket .. ":" .. job_size
+                local job_id, score, cores, status, size = first_fit(queue)
+                if job_id and (best_score == nil or score < best_score) then
+                    best_queue, best_id, best_score, best_cores = queue, job_id, score, cores
+                    best_status, best_size = status, size
+                elseif not job_id and redis.call("EXISTS", queue) == 0 then
+                    redis.call("SREM", KEYS[k], job_size)
+                    redis.call("SREM", queue_registry, queue)
+                end
+            end
+        end
+    end
+
+    if best_id and above_share and now - best_score < backoff_grace then
+        -- it's young enough to leave for someone less busy
+        return false
+    end
+
+    if best_id then
+        if best_size then
+            best_id = claim_task(best_id, best_queue, best_status, best_size)
+        else
+            redis.call("ZREM", best_queue, best_id)
+        end
+        redis.call("ZADD", inflight, now + lease_seconds, best_id)
+        if registered then
+            redis.call("HINCRBY", executor, "cores_used", best_cores)
+            redis.call("HINCRBY", fleet, "cores_used", best_cores)
+        end
+        -- remember where the job came from, so the reaper knows where to put it back
+        redis.call("HSET", prefix .. best_id, "worker", worker, "queue", best_queue)
+        return redis.call("HGETALL", prefix .. best_id)
+    end
+    offset = offset + tonumber(ARGV[tier])
+end
+
+return false
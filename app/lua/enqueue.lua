@@ -0,0 +1,23 @@
+-- Not a script of its own, like finish.lua. Scripts that put jobs (back) in their queue
+-- pull this in with an include line, so they all do it the way
+-- app.persistence.queue_job_commands does.
+--
+-- queue_job(c, queue, job_id, score, tokens) with c the finish config (see
+-- app.persistence.finish_config), the queue the job goes in (see app.persistence.queue_name)
+-- and how many executors it wakes up (see app.persistence.wake_tokens).
+--
+-- The size of the job goes into the set of sizes its bucket has queues for, that set is
+-- how dequeue.lua finds the queue. The queue goes into the set of all of them, for
+-- app.persistence.queue_stats. The wake tokens go to the bucket, executors block on those
+-- and not on every size there could be.
+local function queue_job(c, queue, job_id, score, tokens)
+    local bucket, size = string.match(string.sub(queue, #c.queues + 1), "^(.*):([^:]+)$")
+    redis.call("ZADD", queue, score, job_id)
+    redis.call("SADD", c.sizes .. bucket, size)
+    redis.call("SADD", c.queue_registry, queue)
+    local wake = c.wake .. bucket
+    for _ = 1, math.min(tokens, c.wake_limit) do
+        redis.call("LPUSH", wake, job_id)
+    end
+    redis.call("LTRIM", wake, 0, c.wake_limit - 1)
+end
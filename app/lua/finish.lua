@@ -0,0 +1,112 @@
+-- Not a script of its own. Scripts that finish jobs pull this in with an include line
+-- (see app.persistence.script_source), so everything that hangs off a job hears about it
+-- finishing in the same atomic step.
+--
+-- finish_job(job_id, status, config) with the status the job just went into, and config
+-- the json app.persistence.finish_config hands every one of those scripts.
+--
+-- Every job that depends on a job has its id in the dependents set of that job (see
+-- depend.lua) and waits, out of the queues, with a count of the dependencies it still
+-- waits on. A dependency succeeding counts that down, and at zero the job goes into its
+-- queue. A dependency failing (or being aborted, or timing out) fails the job, and
+-- everything depending on that in turn, all the way down the graph.
+-- A task of an array job (see dequeue.lua) gets counted on its array instead, and the
+-- array finishes with its last task: succeeded if they all did, failed otherwise. Which
+-- then goes for the jobs depending on the array like for any other job. A finished task
+-- only sticks around to be archived, without a job store it's gone right away.
+-- All of that only ever touches the jobs hanging off the ones that finished, nothing is
+-- scanned and nothing polls.
+--!include enqueue
+local function finish_job(job_id, status, config)
+    local c = cjson.decode(config)
+    local function is_finished(s)
+        for _, terminal in ipairs(c.finished) do
+            if terminal == s then
+                return true
+            end
+        end
+        return false
+    end
+    if not is_finished(status) then
+        return
+    end
+
+    local function move(job_id, from, to)
+        redis.call("ZREM", c.statuses .. from, job_id)
+        local score = redis.call("ZSCORE", c.all, job_id)
+        if score then
+            redis.call("ZADD", c.statuses .. to, score, job_id)
+        end
+        return score
+    end
+
+    local function archive(job_id)
+        if c.archive ~= "" then
+            local now = redis.call("TIME")
+            redis.call("ZADD", c.archive, now[1], job_id)
+        end
+    end
+
+    -- the jobs whose dependents still have to hear about it, with how they ended
+    local upstream = { { job_id, status } }
+    while #upstream > 0 do
+        local done = table.remove(upstream)
+
+        local array_id = redis.call("HGET", c.jobs .. done[1], "array_id")
+        if array_id then
+            local array = c.jobs .. array_id
+            redis.call("SREM", c.tasks .. array_id, done[1])
+            -- with no job store to archive it to, a finished task would sit in redis for
+            -- good, thousands of them for a big array. the counters on the array are all
+            -- that's left of it
+            if c.archive == "" then
+                redis.call("DEL", c.jobs .. done[1])
+            end
+            redis.call(
+                "HINCRBY", array, done[2] == "succeeded" and "tasks_succeeded" or "tasks_failed", 1
+            )
+            local fields = redis.call(
+                "HMGET", array, "status", "array_size", "tasks_succeeded", "tasks_failed"
+            )
+            local succeeded, failed = tonumber(fields[3]) or 0, tonumber(fields[4]) or 0
+            -- an aborted array stays aborted, however its tasks end
+            if not is_finished(fields[1]) and succeeded + failed >= tonumber(fields[2]) then
+                local array_status = failed > 0 and "failed" or "succeeded"
+                redis.call("HSET", array, "status", array_status, "completed_at", c.now)
+                move(array_id, fields[1], array_status)
+                archive(array_id)
+                table.insert(upstream, { array_id, array_status })
+            end
+        end
+
+        local key = c.dependents .. done[1]
+        local dependents = redis.call("SMEMBERS", key)
+        redis.call("DEL", key)
+
+        for _, dependent in ipairs(dependents) do
+            local job = c.jobs .. dependent
+            local fields = redis.call("HMGET", job, "status", "queue", "priority", "array_size")
+            -- anything else got aborted while it waited, or was failed by another dependency
+            if fields[1] == "waiting" then
+                if done[2] == "succeeded" then
+                    if redis.call("HINCRBY", job, "dependencies_left", -1) <= 0 then
+                        redis.call("HSET", job, "status", "pending")
+                        local score = move(dependent, "waiting", "pending")
+                        -- into its queue like it was just submitted, see queue_score
+                        score = score - (tonumber(fields[3]) or 0) * c.priority_seconds
+                        -- an executor for every task of an array job
+                        queue_job(c, fields[2], dependent, score, tonumber(fields[4]) or 1)
+                    end
+                else
+                    redis.call(
+                        "HSET", job, "status", "failed", "completed_at", c.now,
+                        "failed_dependency", done[1]
+                    )
+                    move(dependent, "waiting", "failed")
+                    archive(dependent)
+                    table.insert(upstream, { dependent, "failed" })
+                end
+            end
+        end
+    end
+end
@@ -0,0 +1,34 @@
+-- Drop archived jobs from redis, now that the job store has them.
+--
+-- KEYS[1] where finished jobs wait to be archived
+-- KEYS[2] the index of all jobs
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] prefix of the job records, the job id gets appended to it
+-- ARGV[3] space separated statuses a job has to be in to be dropped
+-- ARGV[4..] the ids of the jobs that made it into the job store
+--
+-- Every one of the jobs leaves the archive queue. A job that isn't finished anymore
+-- (never happens, but if it did we don't want to lose it) stays in redis otherwise.
+--
+-- Returns how many jobs were dropped.
+local finished = {}
+for status in string.gmatch(ARGV[3], "%S+") do
+    finished[status] = true
+end
+
+local dropped = 0
+for i = 4, #ARGV do
+    local job_id = ARGV[i]
+    local status = redis.call("HGET", ARGV[2] .. job_id, "status")
+    if not status or finished[status] then
+        if status then
+            redis.call("ZREM", ARGV[1] .. status, job_id)
+            redis.call("DEL", ARGV[2] .. job_id)
+            dropped = dropped + 1
+        end
+        redis.call("ZREM", KEYS[2], job_id)
+    end
+    redis.call("ZREM", KEYS[1], job_id)
+end
+
+return dropped
@@ -0,0 +1,27 @@
+-- Register an executor, or tell everyone it's still alive and how busy it is.
+-- Same script for both, registering is just the first heartbeat.
+--
+-- KEYS[1] the executor's registry record
+-- KEYS[2] the registry, executor names scored by when we last heard from them
+-- KEYS[3] the fleet wide totals of cores and cores in use
+-- ARGV[1] the executor's name
+-- ARGV[2..] field, value pairs for its record, cpu_cores and cores_used included
+--
+-- The fleet totals are kept up to date with whatever changed since the last heartbeat,
+-- so nobody ever has to add up thousands of executors to know how busy the fleet is.
+local before = redis.call("HMGET", KEYS[1], "cpu_cores", "cores_used")
+redis.call("HSET", KEYS[1], unpack(ARGV, 2))
+local after = redis.call("HMGET", KEYS[1], "cpu_cores", "cores_used")
+
+redis.call("HINCRBY", KEYS[3], "cpu_cores", (tonumber(after[1]) or 0) - (tonumber(before[1]) or 0))
+redis.call("HINCRBY", KEYS[3], "cores_used", (tonumber(after[2]) or 0) - (tonumber(before[2]) or 0))
+
+local now = redis.call("TIME")
+now = now[1] + now[2] / 1000000
+if not before[1] then
+    redis.call("HSET", KEYS[1], "registered_at", now)
+end
+redis.call("HSET", KEYS[1], "heartbeat_at", now)
+redis.call("ZADD", KEYS[2], now, ARGV[1])
+
+return 1
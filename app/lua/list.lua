@@ -0,0 +1,64 @@
+-- One page of job ids out of one of the listing indexes, oldest first.
+--
+-- KEYS[1] the index to walk, all jobs or the jobs in one status
+-- ARGV[1] score of the cursor, "-inf" for the first page
+-- ARGV[2] id of the cursor, empty for the first page. Jobs with the same score as the cursor
+--         are ordered by id, so anything tied with it up to and including this id was on an
+--         earlier page
+-- ARGV[3] page size
+-- ARGV[4] how many entries we're willing to look at before handing back a short page
+-- ARGV[5] prefix of the job records, the job id gets appended to it
+-- ARGV[6..] field, value pairs the jobs have to match
+--
+-- Returns {next cursor score, next cursor id, job ids...}. The cursor is empty once the
+-- index is exhausted.
+--
+-- NOTE: the job records are not passed in as KEYS, same as dequeue.lua
+local cursor_score, cursor_id = ARGV[1], ARGV[2]
+local limit, budget = tonumber(ARGV[3]), tonumber(ARGV[4])
+local prefix = ARGV[5]
+
+local filter_fields, filter_values = {}, {}
+for i = 6, #ARGV, 2 do
+    table.insert(filter_fields, ARGV[i])
+    table.insert(filter_values, ARGV[i + 1])
+end
+
+local result = { "", "" }
+local examined, offset = 0, 0
+while true do
+    local entries = redis.call(
+        "ZRANGEBYSCORE", KEYS[1], cursor_score, "+inf", "WITHSCORES", "LIMIT", offset, limit
+    )
+    if #entries == 0 then
+        return result
+    end
+    offset = offset + #entries / 2
+
+    for i = 1, #entries, 2 do
+        local job_id, score = entries[i], entries[i + 1]
+        local seen = cursor_id ~= "" and tonumber(score) == tonumber(cursor_score) and job_id <= cursor_id
+        if not seen then
+            examined = examined + 1
+
+            local matches = true
+            if #filter_fields > 0 then
+                local values = redis.call("HMGET", prefix .. job_id, unpack(filter_fields))
+                for k = 1, #filter_fields do
+                    if values[k] ~= filter_values[k] then
+                        matches = false
+                        break
+                    end
+                end
+            end
+            if matches then
+                table.insert(result, job_id)
+            end
+
+            if #result - 2 == limit or examined >= budget then
+                result[1], result[2] = score, job_id
+                return result
+            end
+        end
+    end
+end
@@ -0,0 +1,35 @@
+-- Take executors out of the registry, along with their share of the fleet totals.
+--
+-- KEYS[1] the registry, executor names scored by when we last heard from them
+-- KEYS[2] the fleet wide totals of cores and cores in use
+-- ARGV[1] prefix of the registry records, the name gets appended to it
+-- ARGV[2] executors we haven't heard from in this many seconds are dead
+-- ARGV[3] the most dead executors to prune in one go
+-- ARGV[4..] if given, prune exactly these executors instead (they're shutting down)
+--
+-- Returns the names of the executors that got pruned.
+local names = {}
+if #ARGV > 3 then
+    for i = 4, #ARGV do
+        table.insert(names, ARGV[i])
+    end
+else
+    local now = redis.call("TIME")
+    local cutoff = now[1] + now[2] / 1000000 - tonumber(ARGV[2])
+    names = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", cutoff, "LIMIT", 0, tonumber(ARGV[3]))
+end
+
+local pruned = {}
+for _, name in ipairs(names) do
+    local executor = ARGV[1] .. name
+    local record = redis.call("HMGET", executor, "cpu_cores", "cores_used")
+    if record[1] then
+        redis.call("HINCRBY", KEYS[2], "cpu_cores", -(tonumber(record[1]) or 0))
+        redis.call("HINCRBY", KEYS[2], "cores_used", -(tonumber(record[2]) or 0))
+        redis.call("DEL", executor)
+        table.insert(pruned, name)
+    end
+    redis.call("ZREM", KEYS[1], name)
+end
+
+return pruned
@@ -0,0 +1,103 @@
+-- Put jobs whose lease ran out back in line, or fail them once they ran out of retries.
+--
+-- KEYS[1] the in-flight set, job ids scored by when their lease runs out
+-- KEYS[2] the index of all jobs
+-- KEYS[3] the deadline index, a running job we take away from its executor leaves it
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] prefix of the job records, the job id gets appended to it
+-- ARGV[3] how many times a job gets put back before we give up on it
+-- ARGV[4] the most expired leases to look at in one go
+-- ARGV[5] what to put in completed_at for the jobs we give up on
+-- ARGV[6] where finished jobs wait to be archived, empty if we don't archive them
+-- ARGV[7] how many seconds of waiting a point of priority is worth (see queue_score)
+-- ARGV[8] the finish config, the jobs depending on the ones we give up on fail (see
+--         finish.lua), and what a job going back in line needs (see enqueue.lua)
+-- ARGV[9] how many seconds the scheduler's clock is ahead of UTC, submitted_at is in
+--         local time
+--
+-- An expired lease means the executor holding it stopped renewing it, so it died or got
+-- cut off from redis. Jobs that finished (or got aborted) since are simply dropped from
+-- the in-flight set, executors don't bother removing their leases when they're done.
+-- Everything happens in here so an executor renewing at the last second can't race us.
+--
+-- Returns {requeued ids..., "", failed ids...}
+--!include finish
+local c = cjson.decode(ARGV[8])
+local now = redis.call("TIME")
+now = now[1] + now[2] / 1000000
+
+-- submitted_at of a job record as seconds since the epoch, like python's timestamp() of
+-- it. nil if it isn't there
+local function submitted_seconds(submitted_at)
+    local year, month, day, hour, minute, second = string.match(
+        submitted_at or "", "^(%d+)-(%d+)-(%d+)T(%d+):(%d+):([%d.]+)"
+    )
+    if not year then
+        return nil
+    end
+    -- days since 1970-01-01, counting years from march so the leap day comes last
+    year, month = tonumber(year), tonumber(month)
+    if month <= 2 then
+        year = year - 1
+    end
+    local era = math.floor(year / 400)
+    local year_of_era = year - era * 400
+    local day_of_year = math.floor((153 * ((month + 9) % 12) + 2) / 5) + tonumber(day) - 1
+    local day_of_era = year_of_era * 365 + math.floor(year_of_era / 4)
+        - math.floor(year_of_era / 100) + day_of_year
+    local days = era * 146097 + day_of_era - 719468
+    return days * 86400 + tonumber(hour) * 3600 + tonumber(minute) * 60 + tonumber(second)
+        - tonumber(ARGV[9])
+end
+
+local requeued, failed = {}, {}
+local expired = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", now, "LIMIT", 0, tonumber(ARGV[4]))
+for _, job_id in ipairs(expired) do
+    redis.call("ZREM", KEYS[1], job_id)
+
+    local job = ARGV[2] .. job_id
+    local fields = redis.call("HMGET", job, "status", "retries", "queue")
+    local status, retries, queue = fields[1], (tonumber(fields[2]) or 0) + 1, fields[3]
+
+    if status == "pending" or status == "running" then
+        local new_status = "pending"
+        if retries > tonumber(ARGV[3]) or not queue or queue == "" then
+            new_status = "failed"
+            redis.call("HSET", job, "status", new_status, "completed_at", ARGV[5])
+            if ARGV[6] ~= "" then
+                redis.call("ZADD", ARGV[6], math.floor(now), job_id)
+            end
+            finish_job(job_id, new_status, ARGV[8])
+            table.insert(failed, job_id)
+        else
+            redis.call("HSET", job, "status", new_status, "retries", retries)
+            redis.call("HDEL", job, "worker", "started_at")
+            -- back where it was, with its original score, so it doesn't lose its place in line.
+            -- the task of an array job isn't indexed, it goes where its array was
+            local more = redis.call("HMGET", job, "priority", "array_id", "submitted_at")
+            local priority = tonumber(more[1]) or 0
+            -- a job missing from the index (it got trimmed, or never made it in) still goes
+            -- back in line by when it was submitted, and failing that, at the back
+            local submitted = tonumber(redis.call("ZSCORE", KEYS[2], more[2] or job_id))
+                or submitted_seconds(more[3]) or now
+            local score = submitted - priority * tonumber(ARGV[7])
+            queue_job(c, queue, job_id, score, 1)
+            table.insert(requeued, job_id)
+        end
+
+        if new_status ~= status then
+            redis.call("ZREM", KEYS[3], job_id)
+            redis.call("ZREM", ARGV[1] .. status, job_id)
+            local score = redis.call("ZSCORE", KEYS[2], job_id)
+            if score then
+                redis.call("ZADD", ARGV[1] .. new_status, score, job_id)
+            end
+        end
+    end
+end
+
+table.insert(requeued, "")
+for _, job_id in ipairs(failed) do
+    table.insert(requeued, job_id)
+end
+return requeued
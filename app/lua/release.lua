@@ -0,0 +1,14 @@
+-- Hand back the cores a finished job was using, the other half of the bump in dequeue.lua.
+--
+-- KEYS[1] the executor's registry record
+-- KEYS[2] the fleet wide totals of cores and cores in use
+-- ARGV[1] how many cores the job had
+--
+-- Executors that aren't registered (or got pruned) have nothing to give back,
+-- their next heartbeat sets the record straight.
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("HINCRBY", KEYS[1], "cores_used", -tonumber(ARGV[1]))
+redis.call("HINCRBY", KEYS[2], "cores_used", -tonumber(ARGV[1]))
+return 1
@@ -0,0 +1,28 @@
+-- Renew the leases an executor holds on the jobs it is working on, all in one go.
+--
+-- KEYS[1] the in-flight set, job ids scored by when their lease runs out
+-- ARGV[1] how long the renewed leases last, in seconds
+-- ARGV[2] prefix of the job records, the job id gets appended to it
+-- ARGV[3] the executor renewing
+-- ARGV[4..] the job ids it is holding
+--
+-- A lease only gets renewed if it still exists and the job is still ours. If the reaper
+-- already took it away (we were gone for too long) the job may be back in line or even
+-- running somewhere else, and renewing it would keep a stranger's lease alive.
+--
+-- Returns the ids of the jobs whose lease we lost.
+local now = redis.call("TIME")
+local expires = now[1] + now[2] / 1000000 + tonumber(ARGV[1])
+
+local lost = {}
+for i = 4, #ARGV do
+    local job_id = ARGV[i]
+    if redis.call("ZSCORE", KEYS[1], job_id)
+        and redis.call("HGET", ARGV[2] .. job_id, "worker") == ARGV[3] then
+        redis.call("ZADD", KEYS[1], "XX", expires, job_id)
+    else
+        table.insert(lost, job_id)
+    end
+end
+
+return lost
@@ -0,0 +1,41 @@
+-- Write a whole job record and keep the listing indexes in step with it.
+--
+-- KEYS[1] the job record
+-- KEYS[2] the index of all jobs
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] the job id
+-- ARGV[3] score of the job in the indexes (when it was submitted)
+-- ARGV[4] where finished jobs wait to be archived, empty unless the job is finished
+--         and we have a job store to archive it to
+-- ARGV[5..] field, value pairs of the record
+--
+-- Empty values mean the field isn't set, and those aren't stored at all (see Job.to_record).
+local old_status = redis.call("HGET", KEYS[1], "status")
+local set, unset = {}, {}
+for i = 5, #ARGV, 2 do
+    if ARGV[i + 1] == "" then
+        table.insert(unset, ARGV[i])
+    else
+        table.insert(set, ARGV[i])
+        table.insert(set, ARGV[i + 1])
+    end
+end
+-- a brand new job has nothing to unset
+if old_status and #unset > 0 then
+    redis.call("HDEL", KEYS[1], unpack(unset))
+end
+redis.call("HSET", KEYS[1], unpack(set))
+local status = redis.call("HGET", KEYS[1], "status")
+
+if old_status and old_status ~= status then
+    redis.call("ZREM", ARGV[1] .. old_status, ARGV[2])
+end
+redis.call("ZADD", ARGV[1] .. status, ARGV[3], ARGV[2])
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[2])
+
+if ARGV[4] ~= "" then
+    local now = redis.call("TIME")
+    redis.call("ZADD", ARGV[4], now[1], ARGV[2])
+end
+
+return 1
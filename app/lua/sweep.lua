@@ -0,0 +1,47 @@
+-- Time out the running jobs that are past their deadline.
+--
+-- KEYS[1] the deadline index, running jobs scored by when they're out of time
+-- KEYS[2] the index of all jobs
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] prefix of the job records, the job id gets appended to it
+-- ARGV[3] prefix of the executors' abort channels, the worker gets appended to it
+-- ARGV[4] the most overdue jobs to look at in one go
+-- ARGV[5] what to put in completed_at, the executor overwrites it once it killed the container
+-- ARGV[6] where finished jobs wait to be archived, empty if we don't archive them
+-- ARGV[7] the finish config, the jobs depending on the timed out ones fail (see finish.lua)
+--
+-- The deadline index is ordered, so finding what's overdue is one range query off the
+-- front of it no matter how many jobs are running. The executor running the job gets
+-- told to kill it over its abort channel, same as an abort.
+--
+-- Returns the ids of the jobs that timed out.
+--!include finish
+local now = redis.call("TIME")
+now = now[1] + now[2] / 1000000
+
+local timed_out = {}
+local overdue = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", now, "LIMIT", 0, tonumber(ARGV[4]))
+for _, job_id in ipairs(overdue) do
+    redis.call("ZREM", KEYS[1], job_id)
+
+    local job = ARGV[2] .. job_id
+    local fields = redis.call("HMGET", job, "status", "worker")
+    if fields[1] == "running" then
+        redis.call("HSET", job, "status", "timed_out", "completed_at", ARGV[5])
+        redis.call("ZREM", ARGV[1] .. "running", job_id)
+        local score = redis.call("ZSCORE", KEYS[2], job_id)
+        if score then
+            redis.call("ZADD", ARGV[1] .. "timed_out", score, job_id)
+        end
+        if ARGV[6] ~= "" then
+            redis.call("ZADD", ARGV[6], math.floor(now), job_id)
+        end
+        if fields[2] and fields[2] ~= "" then
+            redis.call("PUBLISH", ARGV[3] .. fields[2], job_id)
+        end
+        finish_job(job_id, "timed_out", ARGV[7])
+        table.insert(timed_out, job_id)
+    end
+end
+
+return timed_out
@@ -0,0 +1,88 @@
+-- Compare-and-set on a job's status, so racing updates (an abort and a completion
+-- landing at the same time, say) can't overwrite each other.
+-- When the status changes the job moves between the per-status indexes too,
+-- and a job that starts running with a timeout goes into the deadline index
+-- (and comes back out of it once it stops running).
+--
+-- KEYS[1] the job record
+-- KEYS[2] the index of all jobs
+-- KEYS[3] the deadline index, running jobs scored by when they're out of time
+-- ARGV[1] prefix of the per-status indexes, the status gets appended to it
+-- ARGV[2] the job id
+-- ARGV[3] space separated statuses the job has to be in for the update to go through,
+--         empty if any status will do
+-- ARGV[4] where finished jobs wait to be archived, empty unless this update finishes the
+--         job and we have a job store to archive it to
+-- ARGV[5] the finish config, a job that finishes lets the jobs depending on it know
+--         (see finish.lua)
+-- ARGV[6] the worker the job has to be held by for the update to go through, empty if
+--         it doesn't matter who holds it
+-- ARGV[7..] field, value pairs to write, an empty value unsets the field (see save.lua)
+--
+-- Returns 1 if the update went through, 0 if the job wasn't in one of the expected statuses
+-- (or wasn't held by the expected worker).
+--!include finish
+local status = redis.call("HGET", KEYS[1], "status")
+if not status then
+    return 0
+end
+
+local allowed = ARGV[3] == ""
+for expected in string.gmatch(ARGV[3], "%S+") do
+    if expected == status then
+        allowed = true
+        break
+    end
+end
+if not allowed then
+    return 0
+end
+-- a job that got reaped from a slow executor and handed to another one is the other one's
+-- now, whatever the slow one has to say about it
+if ARGV[6] ~= "" and redis.call("HGET", KEYS[1], "worker") ~= ARGV[6] then
+    return 0
+end
+
+local set, unset = {}, {}
+for i = 7, #ARGV, 2 do
+    if ARGV[i + 1] == "" then
+        table.insert(unset, ARGV[i])
+    else
+        table.insert(set, ARGV[i])
+        table.insert(set, ARGV[i + 1])
+    end
+end
+if #unset > 0 then
+    redis.call("HDEL", KEYS[1], unpack(unset))
+end
+if #set > 0 then
+    redis.call("HSET", KEYS[1], unpack(set))
+end
+
+local new_status = redis.call("HGET", KEYS[1], "status")
+if new_status ~= status then
+    redis.call("ZREM", ARGV[1] .. status, ARGV[2])
+    local score = redis.call("ZSCORE", KEYS[2], ARGV[2])
+    if score then
+        redis.call("ZADD", ARGV[1] .. new_status, score, ARGV[2])
+    end
+
+    if new_status == "running" then
+        local timeout = tonumber(redis.call("HGET", KEYS[1], "timeout_seconds"))
+        if timeout and timeout > 0 then
+            local now = redis.call("TIME")
+            redis.call("ZADD", KEYS[3], now[1] + now[2] / 1000000 + timeout, ARGV[2])
+        end
+    elseif status == "running" then
+        redis.call("ZREM", KEYS[3], ARGV[2])
+    end
+
+    if ARGV[4] ~= "" then
+        local now = redis.call("TIME")
+        redis.call("ZADD", ARGV[4], now[1], ARGV[2])
+    end
+
+    finish_job(ARGV[2], new_status, ARGV[5])
+end
+
+return 1
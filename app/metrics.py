@@ -0,0 +1,237 @@
+"""Counters, gauges and latency histograms, in the Prometheus text format.
+
+Just enough of a metrics library to see where the time goes without pulling one in. Every
+metric lives in this process and is cheap to bump (a lock and a dict lookup), so the
+hot paths can afford it. render() writes all of them out for a scrape.
+
+The scheduler serves them on GET /metrics. Executors run in processes of their own, set
+EXECUTOR_METRICS_PORT and they serve theirs too (see serve_metrics).
+
+What goes in here is defined at the bottom, all in one place, so it's easy to see what
+we have.
+"""
+
+import asyncio
+import functools
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# roughly what a redis round trip takes, up to something has gone quite wrong
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# how long jobs wait, pull and run, seconds up to hours
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600)
+
+registry: List["Metric"] = []
+
+# a sample is a name suffix, its labels and its value
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+        registry.append(self)
+
+    def key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self) -> Iterator[Sample]:
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield "", tuple(zip(self.labels, key, strict=True)), value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, one for +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self) -> Iterator[Sample]:
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            labels = tuple(zip(self.labels, key, strict=True))
+            # the buckets are cumulative on the way out
+            total = 0
+            # counts ends in the sum, which isn't a bucket
+            for bound, count in zip((*self.buckets, "+Inf"), counts[:-1], strict=True):
+                total += count
+                yield "_bucket", (*labels, ("le", str(bound))), total
+            yield "_sum", labels, counts[-1]
+            yield "_count", labels, total
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render() -> str:
+    """Every metric we have, in the Prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            text = ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+            lines.append(
+                f"{metric.name}{suffix}{{{text}}} {value}"
+                if text
+                else f"{metric.name}{suffix} {value}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def timed(operation: str):
+    """Time every call of the decorated function (sync or async) in PERSISTENCE_SECONDS"""
+
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def timed_coroutine(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    PERSISTENCE_SECONDS.observe(
+                        perf_counter() - start, operation=operation
+                    )
+
+            return timed_coroutine
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PERSISTENCE_SECONDS.observe(perf_counter() - start, operation=operation)
+
+        return timed_function
+
+    return decorate
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a scrape every few seconds would drown out everything else
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """Serve GET /metrics on port, from a thread of its own"""
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics on port {server.server_port}")
+    return server
+
+
+PERSISTENCE_SECONDS = Histogram(
+    "jobservitor_persistence_seconds",
+    "How long saving, loading, enqueueing and dequeueing jobs takes",
+    ("operation",),
+)
+ENQUEUED_JOBS = Counter("jobservitor_enqueued_jobs_total", "Jobs put in a queue")
+DEQUEUES = Counter(
+    "jobservitor_dequeues_total",
+    "Times an executor asked for a job, by whether it got one",
+    ("result",),
+)
+REQUEUED_JOBS = Counter(
+    "jobservitor_requeued_jobs_total",
+    "Jobs put back in line because their executor stopped renewing its lease",
+)
+QUEUE_DEPTH = Gauge(
+    "jobservitor_queue_depth",
+    "Jobs waiting in each queue shard, as of the last scrape",
+    ("queue",),
+)
+QUEUE_OLDEST_AGE = Gauge(
+    "jobservitor_queue_oldest_job_age_seconds",
+    "How long the job at the front of each queue shard has been waiting",
+    ("queue",),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "jobservitor_queue_wait_seconds",
+    "How long jobs waited in line before an executor picked them up",
+    buckets=DURATION_BUCKETS,
+)
+PULL_SECONDS = Histogram(
+    "jobservitor_image_pull_seconds",
+    "How long pulling an image took",
+    buckets=DURATION_BUCKETS,
+)
+RUN_SECONDS = Histogram(
+    "jobservitor_job_run_seconds",
+    "How long jobs ran, by how they ended",
+    ("status",),
+    buckets=DURATION_BUCKETS,
+)
+EXECUTOR_BUSY = Gauge(
+    "jobservitor_executor_busy_ratio",
+    "How much of this executor's cores and memory running jobs are holding on to",
+    ("resource",),
+)
@@ -1,9 +1,56 @@
-from typing import List, Optional, Literal, Dict
+from typing import Any, List, Optional, Literal, Dict, Tuple
 from datetime import datetime
+from json import dumps, loads
 from uuid import uuid4
 
 from pydantic import BaseModel, Field
-from app.persistence import redis_client, enqueue_job, save_job, load_job
+from app import metrics, persistence_async
+from app.persistence import (
+    redis_client,  # noqa: F401 (re-exported, the scheduler and tests use it)
+    enqueue_job,
+    dequeue_job,
+    save_job,
+    save_and_enqueue_jobs,
+    load_job,
+    list_jobs,
+    list_executors,
+    load_job_status,
+    abort_jobs,
+    abort_matching_jobs,
+    update_job,
+    ABORTABLE_STATUSES,
+    JSON_RECORD_VERSION,
+    TERMINAL_STATUSES,  # noqa: F401 (re-exported for the scheduler)
+)
+
+# the job fields that can't be stored as a plain string in a redis hash
+LIST_FIELDS = ("command", "arguments", "depends_on")
+
+# goes up whenever the way jobs are written into their hashes changes, see Job.from_record.
+# records without one are from before we had it, and wrote unset fields as empty strings
+RECORD_VERSION = "2"
+
+
+def record_value(value: Any) -> str:
+    """How a single job field is written into its redis hash"""
+    if value is None:
+        # hashes have no null, an empty string means "not set" and the field isn't stored
+        # at all (see save.lua)
+        return ""
+    if isinstance(value, list):
+        return dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+GpuType = Literal["Intel", "NVIDIA", "AMD", "Any"]
+# technically the requirement specified did not include 'aborted'
+# but i think its valuable to separate that from failed. same goes for timed_out.
+# 'waiting' is a job that's waiting on its dependencies, it's not in a queue yet
+JobStatus = Literal[
+    "waiting", "pending", "running", "succeeded", "failed", "aborted", "timed_out"
+]
 
 
 class JobCreate(BaseModel):
@@ -24,26 +71,87 @@ class JobCreate(BaseModel):
     command: List[str]
     arguments: List[str]
 
-    gpu_type: Literal["Intel", "NVIDIA", "AMD", "Any"] = "Any"
-    memory_requested: int = 1  # in GB
-    cpu_cores_requested: int = 1
+    gpu_type: GpuType = "Any"
+    # a job asking for nothing would fit anywhere and never count against the executor running it
+    memory_requested: int = Field(default=1, ge=1)  # in GB
+    cpu_cores_requested: int = Field(default=1, ge=1)
 
     # do not allow any random strings in here, add validation!
     region: str = "Any"
     dc: str = "Any"
 
+    # how long the job gets to run before it's killed and marked timed_out, None is forever
+    timeout_seconds: Optional[int] = Field(default=None, gt=0)
+
+    # higher goes first. a point of priority is worth PRIORITY_SECONDS of waiting in line,
+    # so lower priority jobs still get their turn once they've waited long enough
+    priority: int = Field(default=0, ge=-100, le=100)
+
+    # ids of jobs that have to succeed before this one runs. it waits (out of the queues)
+    # until they did, and fails if one of them doesn't
+    depends_on: Optional[List[str]] = None
+
+    # run this many tasks of the job instead of one, each with its JOB_ARRAY_INDEX (0 up to
+    # array_size - 1) in its environment. however many tasks, the job is stored, queued and
+    # listed once. the tasks are jobs of their own (id <job id>_<index>) from the moment an
+    # executor claims them, and the job is done once all of them are
+    array_size: Optional[int] = Field(default=None, ge=1, le=1_000_000)
+
 
 class Job(JobCreate):
     # job housekeeping stuff
     id: str = Field(default_factory=lambda: str(uuid4()))
-    # technically the requirement specified did not include 'aborted'
-    # but i think its valuable to separate that from failed
-    status: Literal["pending", "running", "succeeded", "failed", "aborted"] = "pending"
+    status: JobStatus = "pending"
     submitted_at: datetime = Field(default_factory=lambda: datetime.now())
     aborted_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
     started_at: Optional[datetime] = None
     worker: Optional[str] = None
+    # how many times the job got put back in line because its executor went away
+    retries: int = 0
+    # how the container exited, once it did
+    exit_code: Optional[int] = None
+    oom_killed: bool = False
+    # where the time went, in seconds: waiting in line for an executor to pick the job up,
+    # waiting on its image to be pulled (0 if the executor had it already), and running
+    queue_wait_seconds: Optional[float] = None
+    pull_seconds: Optional[float] = None
+    run_seconds: Optional[float] = None
+    # how many of depends_on the job is still waiting on, and the one that failed it
+    dependencies_left: Optional[int] = None
+    failed_dependency: Optional[str] = None
+    # on an array job, how many of its tasks were claimed, and how many of those ended
+    # which way. on a task of one, which array and which task of it this is
+    tasks_claimed: Optional[int] = None
+    tasks_succeeded: Optional[int] = None
+    tasks_failed: Optional[int] = None
+    array_id: Optional[str] = None
+    array_index: Optional[int] = None
+
+    def to_record(self) -> Dict[str, str]:
+        record = {field: record_value(value) for field, value in self}
+        record["v"] = RECORD_VERSION
+        return record
+
+    @classmethod
+    def from_record(cls, record: Dict[str, str]) -> "Job":
+        """
+        The other half of to_record, pydantic takes care of turning the strings back into
+        ints/datetimes. Reads every RECORD_VERSION: the json records jobs started out as
+        (see legacy_record), the unversioned hashes after that, and the current ones.
+        """
+        version = record.get("v")
+        if version == JSON_RECORD_VERSION:
+            return Job.model_validate_json(record["json"])
+        if version not in (None, RECORD_VERSION):
+            raise ValueError(f"Job record version {version} is newer than we know")
+        # unversioned records have every field, the unset ones as empty strings. the
+        # current ones leave those out once they're saved (see save.lua)
+        data = {field: value for field, value in record.items() if value != ""}
+        for field in LIST_FIELDS:
+            if field in data:
+                data[field] = loads(data[field])
+        return Job.model_validate(data)
 
     def save(self) -> bool:
         """
@@ -54,6 +162,62 @@ class Job(JobCreate):
 
         return save_job(self)
 
+    def transition(
+        self, from_status: List[str], expected_worker: Optional[str] = None, **changes
+    ) -> bool:
+        """
+        Update just the given fields, and only if the job is still in one of from_status
+        (and held by expected_worker, if given).
+        This is how state changes should happen, rather than a save() of the whole job, because
+        it can't clobber a change someone else made in the meantime (e.g. an abort racing a completion)
+
+        Returns whether the update went through. If it did, this object is updated to match.
+        """
+        updated = update_job(
+            self.id,
+            {field: record_value(value) for field, value in changes.items()},
+            expected_status=from_status,
+            expected_worker=expected_worker,
+        )
+        if updated:
+            for field, value in changes.items():
+                setattr(self, field, value)
+        return updated
+
+    def abort(self) -> bool:
+        """
+        Mark the job aborted, take it out of its queue if it's still waiting in one, and if an
+        executor already picked it up tell that executor to kill it. Jobs depending on it fail.
+        Returns False if the job was already done (or aborted) and there was nothing to abort.
+        """
+        aborted_at = datetime.now()
+        # all of it in one script. the status flips and the worker gets read in the same step,
+        # so an executor that claimed the job first gets told, and one that didn't will fail
+        # its claim and never start the container.
+        # (the worker is already set from the moment the job is dequeued with a lease, so we
+        # may tell an executor that hasn't claimed yet. no harm done, its claim fails anyway)
+        if not abort_jobs([self.id], aborted_at):
+            return False
+        self.status, self.aborted_at = "aborted", aborted_at
+        return True
+
+    @classmethod
+    def abort_all(cls, job_ids: List[str]) -> List[str]:
+        """abort() a whole bunch of jobs at once. Returns the ids of the ones that got aborted"""
+        return abort_jobs(job_ids, datetime.now())
+
+    @classmethod
+    def abort_matching(cls, status: Optional[str] = None, **filters: str) -> List[str]:
+        """
+        Abort every job in status (all that can still be aborted if not given) whose
+        fields match filters, e.g. image="busybox". Redis does the matching, so cancelling
+        a backlog of 100k jobs is a handful of round trips instead of 100k.
+        Returns the ids of the jobs that got aborted.
+        """
+        return abort_matching_jobs(
+            [status] if status else list(ABORTABLE_STATUSES), filters, datetime.now()
+        )
+
     def enqueue(self) -> bool:
         """
         Push the job ID onto the redis queue.
@@ -67,43 +231,184 @@ class Job(JobCreate):
 
         And once I start sharding, does it make sense to only shard by architecture or should I also shard by
         mem/cpu buckets? e.g. 1-5GB, 5-20GB, 20+GB?
+        Turns out yes. A small executor stuck behind a head of big jobs kept scanning the same jobs
+        over and over, so the shards now include mem/cpu buckets (see MEMORY_BUCKETS/CPU_BUCKETS)
         """
 
-        return enqueue_job(self)
+        enqueued = enqueue_job(self)
+        metrics.ENQUEUED_JOBS.inc(enqueued)
+        return enqueued
+
+    @classmethod
+    def save_and_enqueue_all(cls, jobs: List["Job"]) -> List[bool]:
+        """save() and enqueue() for a whole batch of jobs in a single round trip"""
+        saved = save_and_enqueue_jobs(jobs)
+        metrics.ENQUEUED_JOBS.inc(sum(saved))
+        return saved
 
     @classmethod
     def load(cls, job_id) -> Optional["Job"]:
         """Dear oren. are you just reinventing ActiveRecord?"""
         data = load_job(job_id)
         if data:
-            return Job.model_validate_json(data)
+            return Job.from_record(data)
+        return None
+
+    @classmethod
+    def load_status(cls, job_id) -> Optional[str]:
+        """Only the status of a job, which is way cheaper than load() when that's all you need"""
+        return load_job_status(job_id)
+
+    @classmethod
+    def dequeue(
+        cls,
+        gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+        cpu_cores: int,
+        memory_gb: int,
+        dc: str = "Any",
+        region: str = "Any",
+        worker: str = "",
+    ) -> Optional["Job"]:
+        """
+        Pop the next job this executor can run, if there is one.
+        worker holds a lease on it from here on, see dequeue_job.
+        """
+        data = dequeue_job(
+            gpu_type,
+            cpu_cores=cpu_cores,
+            memory_gb=memory_gb,
+            dc=dc,
+            region=region,
+            worker=worker,
+        )
+        metrics.DEQUEUES.inc(result="job" if data else "empty")
+        if data:
+            return Job.from_record(data)
         return None
 
     @classmethod
-    def all(cls) -> List[Dict]:
-        """Retrieve all jobs from redis. DEFINITELY just recreating AR now"""
-        # TODO: this is a potentially expensive call and will need to be rewritten
-        # TODO2: do not rehydrate the IDs here, force the client to do it
-        # TODO3: so here we are. sharded the queue and now its kinda ugly. does this method even make sense anymore?
-        values = []
-        for dc in ["Any"]:
-            for region in ["Any", "az1"]:
-                for gpu_type in ["Intel", "NVIDIA", "AMD", "Any"]:
-                    values += redis_client.zrange(
-                        f"jobservitor:queue:{dc}:{region}:{gpu_type}",
-                        0,
-                        -1,
-                        withscores=True,
-                    )
-
-        # TODO3: is it better to rehydrate here or return these fragments? the problem here
-        # is that because we only store fragments of the job definition in the sorted set
-        # when we do this mini rehydration we are potentially setting incorrect defaults
-        # return [
-        #     Job(id=job_id, submitted_at=timestamp) for (job_id, timestamp) in values
-        # ]
-        # return a non-rehydrated dictionary instead for now and let upstream figure it out
+    def list(
+        cls,
+        status: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        **filters: str,
+    ) -> Tuple[List["Job"], Optional[str]]:
+        """
+        One page of jobs, oldest first. DEFINITELY just recreating AR now.
+        filters are exact matches on gpu_type/dc/region.
+
+        This used to walk the queues, so it could only ever see pending jobs and cost a round
+        trip per job. It's backed by the listing indexes now (see list_jobs) so it sees
+        everything, and it's the same two round trips no matter how many jobs there are.
+
+        Returns the jobs and the cursor to pass in for the next page, None once we're out of jobs.
+        """
+        records, next_cursor = list_jobs(status, filters, cursor, limit)
+        return [Job.from_record(record) for record in records], next_cursor
+
+    # async flavours of the above, for the scheduler API. Django style, same name with an "a" in front
+
+    async def asave_and_enqueue(self) -> bool:
+        """save() and enqueue() in one go, which is one round trip"""
+        return (await Job.asave_and_enqueue_all([self]))[0]
+
+    @classmethod
+    async def asave_and_enqueue_all(cls, jobs: List["Job"]) -> List[bool]:
+        saved = await persistence_async.save_and_enqueue_jobs(jobs)
+        metrics.ENQUEUED_JOBS.inc(sum(saved))
+        return saved
+
+    async def atransition(
+        self, from_status: List[str], expected_worker: Optional[str] = None, **changes
+    ) -> bool:
+        updated = await persistence_async.update_job(
+            self.id,
+            {field: record_value(value) for field, value in changes.items()},
+            expected_status=from_status,
+            expected_worker=expected_worker,
+        )
+        if updated:
+            for field, value in changes.items():
+                setattr(self, field, value)
+        return updated
+
+    async def aabort(self) -> bool:
+        aborted_at = datetime.now()
+        if not await persistence_async.abort_jobs([self.id], aborted_at):
+            return False
+        self.status, self.aborted_at = "aborted", aborted_at
+        return True
+
+    @classmethod
+    async def aabort_all(cls, job_ids: List[str]) -> List[str]:
+        return await persistence_async.abort_jobs(job_ids, datetime.now())
+
+    @classmethod
+    async def aabort_matching(
+        cls, status: Optional[str] = None, **filters: str
+    ) -> List[str]:
+        return await persistence_async.abort_matching_jobs(
+            [status] if status else list(ABORTABLE_STATUSES), filters, datetime.now()
+        )
+
+    @classmethod
+    async def aload(cls, job_id) -> Optional["Job"]:
+        data = await persistence_async.load_job(job_id)
+        if data:
+            return Job.from_record(data)
+        return None
+
+    @classmethod
+    async def aload_status(cls, job_id) -> Optional[str]:
+        return await persistence_async.load_job_field(job_id, "status")
+
+    @classmethod
+    async def alist(
+        cls,
+        status: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 100,
+        **filters: str,
+    ) -> Tuple[List["Job"], Optional[str]]:
+        records, next_cursor = await persistence_async.list_jobs(
+            status, filters, cursor, limit
+        )
+        return [Job.from_record(record) for record in records], next_cursor
+
+
+class Executor(BaseModel):
+    """
+    What an executor told us about itself in its last heartbeat (see app.persistence.heartbeat).
+    Read only, the executors themselves are the only ones writing these.
+    """
+
+    name: str
+    gpu_type: GpuType = "Any"
+    cpu_cores: int
+    memory_gb: int
+    dc: str = "Any"
+    region: str = "Any"
+
+    cores_used: int = 0
+    memory_used: int = 0
+    running_jobs: int = 0
+
+    registered_at: datetime
+    heartbeat_at: datetime
+
+    @classmethod
+    def from_record(cls, record: Dict[str, str]) -> "Executor":
+        return Executor.model_validate(record)
+
+    @classmethod
+    def live(cls) -> List["Executor"]:
+        """Every executor that's been heard from recently, the dead ones age out on their own"""
+        return [Executor.from_record(record) for record in list_executors()]
+
+    @classmethod
+    async def alive(cls) -> List["Executor"]:
         return [
-            {"job_id": job_id, "submitted_at": datetime.fromtimestamp(timestamp)}
-            for (job_id, timestamp) in values
+            Executor.from_record(record)
+            for record in await persistence_async.list_executors()
         ]
@@ -1,104 +1,1274 @@
 """Not a real persistence layer, just a thin wrapper around our redis enqueue/dequeue logic for now.
 
-Purpose is just to keep the rest of the code clean and consistent"""
+Purpose is just to keep the rest of the code clean and consistent
 
+With JOBSERVITOR_BACKEND=memory there's no redis at all, everything below that talks to redis
+is swapped out for the in-process versions in app.persistence_memory (see the bottom of this file)
+"""
+
+import re
 import redis
+from datetime import datetime
+from json import dumps, loads
 from os import environ
-from typing import Optional, Literal, Dict
+from pathlib import Path
+from typing import Callable, Optional, Literal, List, Dict, Tuple
+
+from app.job_store import JobStore, job_store_from_config
+from app.metrics import timed
+
+# the most queue entries one dequeue looks at. every job in a queue is the same size, so
+# these are only ever entries of jobs that are done (or aborted) and not cleaned out yet
+DEQUEUE_SCAN_LIMIT = int(environ.get("JOBSERVITOR_DEQUEUE_SCAN_LIMIT", 100))
 
 PROJECT_PREFIX = "jobservitor:"
+# jobs from before they were hashes are one json string under their key. we still read
+# those, as records of this version (see legacy_record and Job.from_record)
+JSON_RECORD_VERSION = "0"
 QUEUE_PREFIX = "jobservitor:queue:"
-
-redis_client = redis.from_url(
-    environ.get("REDIS_URI", "redis://localhost:6379/0"), decode_responses=True
+# the names of every queue that had jobs put in it, so nobody has to SCAN for them.
+# dequeue.lua takes the ones that are empty back out
+QUEUES_KEY = "jobservitor:queues"
+# which layout the queues are in, see migrate_queues. the jobs in queues of the layouts before
+# this one (one queue per dc/region/gpu, then one per resource bucket) need moving
+QUEUE_LAYOUT_KEY = "jobservitor:queue_layout"
+QUEUE_LAYOUT = "3"
+# every resource bucket has a set of the job sizes it has queues for, see queue_name
+SIZES_PREFIX = "jobservitor:sizes:"
+# listing indexes, sorted sets of job ids scored by when they were submitted
+INDEX_PREFIX = "jobservitor:index:"
+ALL_JOBS_INDEX = INDEX_PREFIX + "all"
+STATUS_INDEX_PREFIX = INDEX_PREFIX + "status:"
+# running jobs that have a timeout, scored by when they run out of time
+DEADLINE_INDEX = INDEX_PREFIX + "deadlines"
+# how many jobs one listing call looks at before it hands back a short page
+LIST_SCAN_LIMIT = int(environ.get("JOBSERVITOR_LIST_SCAN_LIMIT", 1000))
+# executors block on these lists while they're idle, enqueue pushes a token to wake them up
+WAKE_PREFIX = "jobservitor:wake:"
+WAKE_TOKEN_LIMIT = 64
+# every executor listens on its own channel for jobs it should kill
+ABORT_CHANNEL_PREFIX = "jobservitor:aborts:"
+# the output of every job goes into a redis stream of its own, in chunks of up to LOG_CHUNK_BYTES.
+# only the last LOG_MAX_CHUNKS of them are kept (roughly, redis trims in whole nodes), and the
+# whole stream goes away LOG_TTL seconds after the job is done
+LOGS_PREFIX = "jobservitor:logs:"
+LOG_CHUNK_BYTES = int(environ.get("JOBSERVITOR_LOG_CHUNK_BYTES", 16 * 1024))
+LOG_MAX_CHUNKS = int(environ.get("JOBSERVITOR_LOG_MAX_CHUNKS", 1000))
+LOG_TTL = int(environ.get("JOBSERVITOR_LOG_TTL", 7 * 24 * 60 * 60))
+# how many log followers the scheduler takes on at once. each one holds a redis connection
+# (or a thread, without redis) of a pool of their own, more than that get turned away
+LOG_FOLLOWERS_LIMIT = int(environ.get("JOBSERVITOR_LOG_FOLLOWERS_LIMIT", 16))
+# dequeued jobs sit in here, scored by when the lease of the executor working on them runs out
+INFLIGHT_KEY = "jobservitor:inflight"
+# executors renew their leases well before this runs out, see app.executor.Heartbeat
+LEASE_SECONDS = float(environ.get("JOBSERVITOR_LEASE_SECONDS", 30))
+# how many times a job whose executor disappeared gets put back in line before it's failed
+MAX_RETRIES = int(environ.get("JOBSERVITOR_MAX_RETRIES", 3))
+# the most expired leases one reap_expired_jobs call deals with
+REAP_LIMIT = 1000
+# executors register themselves in here, and keep telling us how busy they are
+EXECUTOR_PREFIX = "jobservitor:executor:"
+EXECUTOR_REGISTRY = "jobservitor:executors"
+# running totals of cores and cores in use across all live executors
+FLEET_KEY = "jobservitor:fleet"
+# the heartbeat renews the leases too, so it has to come around well within LEASE_SECONDS
+HEARTBEAT_INTERVAL = float(
+    environ.get("JOBSERVITOR_HEARTBEAT_INTERVAL", LEASE_SECONDS / 3)
 )
+# an executor that missed this many heartbeats in a row is considered dead
+EXECUTOR_TTL = HEARTBEAT_INTERVAL * 3
+# executors busier than the fleet by more than this (0.25 is 25 points of utilization)
+# leave new jobs to the others, until the job has waited FAIR_SHARE_GRACE seconds
+FAIR_SHARE_SLACK = float(environ.get("JOBSERVITOR_FAIR_SHARE_SLACK", 0.25))
+FAIR_SHARE_GRACE = float(environ.get("JOBSERVITOR_FAIR_SHARE_GRACE", 5))
 
-print(
-    f"Connected to Redis at {environ.get('REDIS_URI', 'redis://localhost:6379/0')}, version {redis_client.info()['redis_version']}"
-)
+# once a job is in one of these, it's not going anywhere anymore
+TERMINAL_STATUSES = ("succeeded", "failed", "aborted", "timed_out")
+# the jobs in these can still be aborted
+ABORTABLE_STATUSES = ("waiting", "pending", "running")
+# every job that other jobs depend on has a set of those in here, see finish.lua
+DEPENDENTS_PREFIX = "jobservitor:dependents:"
+# the tasks of an array job that executors claimed and that aren't done yet, see dequeue.lua
+TASKS_PREFIX = "jobservitor:tasks:"
+# how many jobs one call of the abort script deals with, so aborting a huge backlog doesn't
+# hold up everyone else that's waiting on redis for the whole time
+ABORT_LIMIT = int(environ.get("JOBSERVITOR_ABORT_LIMIT", 10000))
+# finished jobs wait in here, scored by when they finished, until they're archived
+# into the job store (if there is one, see app.job_store)
+ARCHIVE_KEY = "jobservitor:archive"
+# how long a finished job stays in redis before it's archived. a little while, so whoever
+# is waiting on the job (or is about to write its exit code) still finds it there
+ARCHIVE_DELAY = float(environ.get("JOBSERVITOR_ARCHIVE_DELAY", 60))
+# the most jobs one archive_jobs call moves
+ARCHIVE_LIMIT = 500
+
+# on top of dc/region/gpu the queues are sharded by how much a job asks for,
+# so a small executor never has to wade through a pile of jobs it could never fit.
+# these are the (inclusive) upper bounds of each bucket, anything bigger than the
+# last bound goes into one more bucket at the end.
+# e.g. memory buckets are 1-4GB, 5-16GB, 17-64GB and 64GB+
+# within a bucket every size of job gets a queue of its own (see queue_name), so the jobs
+# too big for an executor in its own bucket get skipped a queue at a time, not a job at a time
+MEMORY_BUCKETS = (4, 16, 64)
+CPU_BUCKETS = (2, 8, 32)
+
+# within a queue jobs go oldest first, and every point of priority a job has counts as this
+# many seconds of waiting in line (see queue_score)
+PRIORITY_SECONDS = float(environ.get("JOBSERVITOR_PRIORITY_SECONDS", 60))
+
+REDIS_URI = environ.get("REDIS_URI", "redis://localhost:6379/0")
+# "redis", or "memory" to keep the queues and jobs in this process. that's only any good
+# when the executors run in here too, e.g. a single box setup or the tests
+BACKEND = environ.get("JOBSERVITOR_BACKEND", "redis")
+if BACKEND not in ("redis", "memory"):
+    raise ValueError(f"Unknown JOBSERVITOR_BACKEND {BACKEND}")
+
+
+def redis_client_from_config() -> Optional[redis.Redis]:
+    """
+    The client everything in here talks to redis through, None without redis.
+    It doesn't connect until it's first used, so importing us (or anything that imports us,
+    like app.models) costs no round trips and works without redis being up yet.
+    """
+    if BACKEND != "redis":
+        return None
+    return redis.from_url(REDIS_URI, decode_responses=True)
+
+
+redis_client = redis_client_from_config()
+
+
+def connect():
+    """
+    Make sure we can talk to redis. Services call this as they start, so a bad REDIS_URI
+    shows up right away instead of with the first job.
+    """
+    if redis_client is None:
+        print("✅ No redis, jobs and queues live in this process")
+        return
+    print(
+        f"Connected to Redis at {REDIS_URI}, version {redis_client.info()['redis_version']}"
+    )
+
+
+# where finished jobs get archived to, None keeps them in redis
+job_store: Optional[JobStore] = job_store_from_config()
+
+
+def script_source(name: str) -> str:
+    """
+    One of the lua scripts in app/lua. A line like "--!include finish" in there is
+    swapped for all of app/lua/finish.lua, scripts can't call each other.
+    """
+    lines = (Path(__file__).parent / "lua" / f"{name}.lua").read_text().splitlines()
+    return "\n".join(
+        (
+            script_source(line.removeprefix("--!include ").strip())
+            if line.startswith("--!include ")
+            else line
+        )
+        for line in lines
+    )
+
+
+def load_script(name: str, client=None):
+    """Register one of the lua scripts in app/lua.
+
+    register_script hands back a callable that uses EVALSHA and only sends the
+    script body over again if redis doesn't know the sha yet (e.g. after a restart).
+    Nothing goes to redis here, the sha is worked out locally.
+    """
+    return (client or redis_client).register_script(script_source(name))
+
+
+if BACKEND == "redis":
+    dequeue_script = load_script("dequeue")
+    transition_script = load_script("transition")
+    save_script = load_script("save")
+    list_script = load_script("list")
+    renew_script = load_script("renew")
+    reap_script = load_script("reap")
+    heartbeat_script = load_script("heartbeat")
+    release_script = load_script("release")
+    prune_script = load_script("prune")
+    sweep_script = load_script("sweep")
+    forget_script = load_script("forget")
+    abort_script = load_script("abort")
+    depend_script = load_script("depend")
+
+
+@timed("save")
+def save_job(job, client=None) -> bool:
+    """
+    Jobs are stored as a redis hash, one field per job field.
+    That way status changes (see update_job) only touch the fields that changed,
+    and hot paths like the dequeue script can read just the fields they care about.
+    """
+    # client can be a pipeline, when we want to batch this with other writes
+    keys, args = save_job_args(job)
+    save_script(keys=keys, args=args, client=client or redis_client)
+    return True
+
+
+def save_job_args(job) -> Tuple[List[str], List]:
+    """keys and args for the save script"""
+    args = [
+        STATUS_INDEX_PREFIX,
+        job.id,
+        job.submitted_at.timestamp(),
+        archive_key(job.status),
+    ]
+    for field, value in job.to_record().items():
+        args += [field, value]
+    return [PROJECT_PREFIX + job.id, ALL_JOBS_INDEX], args
+
+
+def is_wrong_type(result) -> bool:
+    """Whether redis said no because the key isn't a hash, i.e. it's a json job record"""
+    return isinstance(result, redis.ResponseError) and str(result).startswith(
+        "WRONGTYPE"
+    )
+
+
+def legacy_record(data: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    A job from before jobs were hashes, when the whole job was saved as one json string.
+    It's handed on as it is, Job.from_record knows it by its version
+    """
+    if data is None:
+        return None
+    return {"v": JSON_RECORD_VERSION, "json": data}
+
+
+def legacy_field(data: Optional[str], field: str) -> Optional[str]:
+    """A single field of a json job record, as the string it would be in a hash"""
+    if data is None:
+        return None
+    value = loads(data).get(field)
+    return value if value is None or isinstance(value, str) else dumps(value)
+
+
+def hash_results(results: List) -> List:
+    """
+    Raise the first error in a pipeline's results, other than the ones for json job
+    records. Those are left in for the caller to read the old way
+    """
+    for result in results:
+        if isinstance(result, Exception) and not is_wrong_type(result):
+            raise result
+    return results
+
+
+def load_jobs(job_ids: List[str]) -> List[Dict[str, str]]:
+    """Load a bunch of jobs in one round trip. Jobs that don't exist are left out"""
+    with redis_client.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(PROJECT_PREFIX + job_id)
+        records = hash_results(pipe.execute(raise_on_error=False))
+    records = [
+        (
+            legacy_record(redis_client.get(PROJECT_PREFIX + job_id))
+            if is_wrong_type(record)
+            else record
+        )
+        for job_id, record in zip(job_ids, records, strict=True)
+    ]
+    return with_archived_jobs(job_ids, records)
+
+
+def with_archived_jobs(
+    job_ids: List[str], records: List[Dict[str, str]]
+) -> List[Dict[str, str]]:
+    """
+    Fill in the jobs that weren't in redis from the job store, if we have one.
+    Jobs come back in the order of job_ids.
+    """
+    missing = [
+        job_id for job_id, record in zip(job_ids, records, strict=True) if not record
+    ]
+    if missing and job_store is not None:
+        archived = {record["id"]: record for record in job_store.load(missing)}
+        records = [
+            record or archived.get(job_id)
+            for job_id, record in zip(job_ids, records, strict=True)
+        ]
+    return [record for record in records if record]
+
+
+@timed("load")
+def load_job(job_id) -> Optional[Dict[str, str]]:
+    try:
+        record = redis_client.hgetall(PROJECT_PREFIX + job_id)
+    except redis.ResponseError as e:
+        if not is_wrong_type(e):
+            raise
+        return legacy_record(redis_client.get(PROJECT_PREFIX + job_id))
+    if not record and job_store is not None:
+        return next(iter(job_store.load([job_id])), None)
+    return record or None
+
+
+def load_job_field(job_id, field: str) -> Optional[str]:
+    """A single field of a job, without reading (and parsing) the rest of it"""
+    try:
+        value = redis_client.hget(PROJECT_PREFIX + job_id, field)
+    except redis.ResponseError as e:
+        if not is_wrong_type(e):
+            raise
+        return legacy_field(redis_client.get(PROJECT_PREFIX + job_id), field)
+    if value is None and job_store is not None:
+        # finished and archived, the store only does whole records
+        return (load_job(job_id) or {}).get(field)
+    return value
+
+
+def load_job_status(job_id) -> Optional[str]:
+    return load_job_field(job_id, "status")
+
+
+def update_job(
+    job_id,
+    fields: Dict[str, str],
+    expected_status: Optional[List[str]] = None,
+    expected_worker: Optional[str] = None,
+) -> bool:
+    """
+    Write only the given fields of a job.
+
+    With expected_status this is a compare-and-set: the update only goes through
+    if the job is currently in one of those statuses, otherwise nothing is written
+    and we get False back. expected_worker adds that the job still has to be held by
+    that worker, so an executor can't write over a job it lost its lease on.
+    Either way a status change moves the job to the right status index,
+    and in or out of the deadline index when it starts or stops running.
+    """
+    keys, args = update_job_args(job_id, fields, expected_status, expected_worker)
+    return transition_script(keys=keys, args=args) == 1
+
+
+def update_job_args(
+    job_id,
+    fields: Dict[str, str],
+    expected_status: Optional[List[str]] = None,
+    expected_worker: Optional[str] = None,
+) -> Tuple[List[str], List]:
+    """keys and args for the transition script"""
+    args = [
+        STATUS_INDEX_PREFIX,
+        job_id,
+        " ".join(expected_status or []),
+        archive_key(fields.get("status")),
+        finish_config(),
+        expected_worker or "",
+    ]
+    for field, value in fields.items():
+        args += [field, value]
+    return [PROJECT_PREFIX + job_id, ALL_JOBS_INDEX, DEADLINE_INDEX], args
 
 
-def save_job(job) -> bool:
-    return redis_client.set(PROJECT_PREFIX + job.id, job.model_dump_json())
+def list_jobs(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """
+    One page of jobs, oldest first, optionally only the ones in a given status and/or
+    with the given field values (gpu_type/dc/region).
+
+    Two round trips no matter how many jobs there are: one script that walks the index
+    and hands back the ids for the page, and one pipeline to load them.
+    Returns the jobs and the cursor for the next page, which is None when we're out of jobs.
+    """
+    keys, args = list_jobs_args(status, filters, cursor, limit)
+    job_ids, next_cursor = list_jobs_result(list_script(keys=keys, args=args))
+    jobs = load_jobs(job_ids)
+    archived = list_archived_jobs(status, filters, cursor, limit)
+    if archived is None:
+        return jobs, next_cursor
+    return merge_job_pages(jobs, next_cursor, archived, limit)
+
+
+def list_jobs_args(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[str], List]:
+    """keys and args for the list script"""
+    index = STATUS_INDEX_PREFIX + status if status else ALL_JOBS_INDEX
+    # the cursor is score:id of the last job we looked at
+    cursor_score, _, cursor_id = cursor.partition(":") if cursor else ("-inf", "", "")
 
+    args = [cursor_score, cursor_id, limit, LIST_SCAN_LIMIT, PROJECT_PREFIX]
+    for field, value in (filters or {}).items():
+        args += [field, value]
+    return [index], args
 
-def load_job(job_id) -> str | None:
-    return redis_client.get(PROJECT_PREFIX + job_id)
+
+def list_jobs_result(result: List[str]) -> Tuple[List[str], Optional[str]]:
+    """The job ids and next page cursor out of what the list script handed back"""
+    next_score, next_id, *job_ids = result
+    return job_ids, f"{next_score}:{next_id}" if next_score else None
+
+
+def list_archived_jobs(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Optional[List[Tuple[Dict[str, str], float]]]:
+    """
+    The job store's side of a list_jobs page, None when there's no store to look in
+    (or nothing in the status we're asked about could be in there)
+    """
+    if job_store is None or (status and status not in TERMINAL_STATUSES):
+        return None
+    return job_store.list(status, filters or {}, cursor_position(cursor), limit)
+
+
+def cursor_position(cursor: Optional[str]) -> Optional[Tuple[float, str]]:
+    if not cursor:
+        return None
+    score, _, job_id = cursor.partition(":")
+    return float(score), job_id
+
+
+def job_position(record: Dict[str, str]) -> Tuple[float, str]:
+    """Where a job goes in the listings, the same score the listing indexes have it at"""
+    return datetime.fromisoformat(record["submitted_at"]).timestamp(), record["id"]
+
+
+def merge_job_pages(
+    jobs: List[Dict[str, str]],
+    next_cursor: Optional[str],
+    archived: List[Tuple[Dict[str, str], float]],
+    limit: int,
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """
+    Put a page out of redis and a page out of the job store together into one page.
+
+    Either page only covers the jobs up to where it stopped: redis up to its cursor, the store
+    up to its last job if the page is full. Past the first of those two we don't know what
+    the other side has, so that's as far as this page goes, and where the next one picks up.
+    A job that's in both (archived but not dropped from redis yet) is the one out of redis.
+    """
+    merged = {record["id"]: (job_position(record), record) for record, _ in archived}
+    merged.update({record["id"]: (job_position(record), record) for record in jobs})
+    combined = sorted(merged.values(), key=lambda entry: entry[0])
+
+    bounds = []
+    if next_cursor:
+        bounds.append(cursor_position(next_cursor))
+    if len(archived) >= limit:
+        bounds.append(job_position(archived[-1][0]))
+    bound = min(bounds) if bounds else None
+    if bound is not None:
+        combined = [entry for entry in combined if entry[0] <= bound]
+
+    page = combined[:limit]
+    if len(combined) > limit:
+        bound = page[-1][0]
+    cursor = f"{bound[0]}:{bound[1]}" if bound is not None else None
+    return [record for _, record in page], cursor
+
+
+def archive_jobs(delay: float = ARCHIVE_DELAY, limit: int = ARCHIVE_LIMIT) -> int:
+    """
+    Move the jobs that finished more than `delay` seconds ago out of redis and into the
+    job store. Returns how many jobs got archived.
+
+    The store gets them first and redis lets go of them after, so a job is always in
+    at least one of the two (and for a moment in both, which readers are fine with).
+    """
+    if job_store is None:
+        return 0
+    seconds, _ = redis_client.time()
+    job_ids = redis_client.zrangebyscore(
+        ARCHIVE_KEY, "-inf", seconds - delay, start=0, num=limit
+    )
+    if not job_ids:
+        return 0
+    with redis_client.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(PROJECT_PREFIX + job_id)
+        records = pipe.execute()
+
+    archived = archivable_jobs(records)
+    job_store.save([(record, job_position(record)[0]) for record in archived])
+    keys, args = forget_jobs_args(job_ids)
+    forget_script(keys=keys, args=args)
+    return len(archived)
+
+
+def archivable_jobs(records: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    return [record for record in records if record.get("status") in TERMINAL_STATUSES]
+
+
+def forget_jobs_args(job_ids: List[str]) -> Tuple[List[str], List]:
+    """keys and args for the forget script"""
+    return [ARCHIVE_KEY, ALL_JOBS_INDEX], [
+        STATUS_INDEX_PREFIX,
+        PROJECT_PREFIX,
+        " ".join(TERMINAL_STATUSES),
+        *job_ids,
+    ]
+
+
+def archive_key(status: Optional[str]) -> str:
+    """What the lua scripts get for the archive key when a job goes into `status`"""
+    if job_store is None or status not in TERMINAL_STATUSES:
+        return ""
+    return ARCHIVE_KEY
+
+
+def abort_jobs(job_ids: List[str], aborted_at: datetime) -> List[str]:
+    """
+    Abort the given jobs, the ones that are still pending or running that is. Pending jobs
+    come out of their queue right away, and the executors holding the rest get told to kill
+    them. One round trip per ABORT_LIMIT jobs, see abort.lua.
+
+    Returns the ids of the jobs that got aborted.
+    """
+    aborted = []
+    for start in range(0, len(job_ids), ABORT_LIMIT):
+        keys, args = abort_jobs_args(job_ids[start : start + ABORT_LIMIT], aborted_at)
+        aborted += list_jobs_result(abort_script(keys=keys, args=args))[0]
+    return aborted
+
+
+def abort_jobs_args(job_ids: List[str], aborted_at: datetime) -> Tuple[List[str], List]:
+    """keys and args for the abort script, to abort exactly these jobs"""
+    return abort_args(ALL_JOBS_INDEX, aborted_at, "", "", job_ids)
+
+
+def abort_matching_jobs(
+    statuses: List[str], filters: Dict[str, str], aborted_at: datetime
+) -> List[str]:
+    """
+    Abort every job in one of statuses (pending and/or running) whose fields match filters.
+    The matching happens in redis, nothing but the aborted ids ever comes back to us, and
+    it takes a round trip per ABORT_LIMIT jobs looked at.
+
+    Returns the ids of the jobs that got aborted.
+    """
+    aborted = []
+    for status in statuses:
+        cursor = None
+        while True:
+            keys, args = abort_matching_jobs_args(status, filters, aborted_at, cursor)
+            job_ids, cursor = list_jobs_result(abort_script(keys=keys, args=args))
+            aborted += job_ids
+            if cursor is None:
+                break
+    return aborted
+
+
+def abort_matching_jobs_args(
+    status: str,
+    filters: Dict[str, str],
+    aborted_at: datetime,
+    cursor: Optional[str] = None,
+) -> Tuple[List[str], List]:
+    """keys and args for the abort script, to walk the jobs in status from cursor on"""
+    if status not in ABORTABLE_STATUSES:
+        raise ValueError(f"Jobs that are {status} can't be aborted")
+    # same cursors as the listings, score:id of the last job we looked at
+    cursor_score, _, cursor_id = cursor.partition(":") if cursor else ("-inf", "", "")
+    pairs = [item for field, value in filters.items() for item in (field, value)]
+    return abort_args(
+        STATUS_INDEX_PREFIX + status, aborted_at, cursor_score, cursor_id, pairs
+    )
+
+
+def abort_args(
+    index: str, aborted_at: datetime, cursor_score: str, cursor_id: str, rest: List
+) -> Tuple[List[str], List]:
+    return [index, ALL_JOBS_INDEX, DEADLINE_INDEX], [
+        STATUS_INDEX_PREFIX,
+        PROJECT_PREFIX,
+        ABORT_CHANNEL_PREFIX,
+        aborted_at.isoformat(),
+        archive_key("aborted"),
+        cursor_score,
+        cursor_id,
+        ABORT_LIMIT,
+        finish_config(),
+        *rest,
+    ]
+
+
+def publish_abort(worker: str, job_id: str) -> int:
+    """Tell the executor running a job to kill it. Returns how many listeners got the message"""
+    return redis_client.publish(ABORT_CHANNEL_PREFIX + worker, job_id)
+
+
+def subscribe_to_aborts(worker: str, handler: Callable[[str], None]):
+    """
+    Call handler with the job id for every abort sent to this worker, from a background thread.
+
+    This only returns once redis confirmed the subscription, so anything published
+    after that is guaranteed to reach us.
+    """
+    pubsub = redis_client.pubsub()
+    pubsub.subscribe(
+        **{ABORT_CHANNEL_PREFIX + worker: lambda message: handler(message["data"])}
+    )
+    if pubsub.get_message(timeout=5) is None:
+        raise redis.ConnectionError("Never got the abort subscription confirmed")
+    return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def resource_bucket(amount: int, bounds: Tuple[int, ...]) -> int:
+    """Index of the bucket the given amount of memory/cpu falls into"""
+    for index, bound in enumerate(bounds):
+        if amount <= bound:
+            return index
+    return len(bounds)
 
 
 def queue_name(
     gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
     dc: str,
     region: str,
+    memory_gb: int = 1,
+    cpu_cores: int = 1,
+) -> str:
+    """
+    The queue of the jobs of exactly this size, in the resource bucket they fall into:
+    <QUEUE_PREFIX><bucket>:<memory_gb>x<cpu_cores>. The bucket keeps the sizes it has
+    queues for in a set (see sizes_key), which is how dequeue.lua finds them
+    """
+    bucket = bucket_name(
+        gpu_type,
+        dc,
+        region,
+        resource_bucket(memory_gb, MEMORY_BUCKETS),
+        resource_bucket(cpu_cores, CPU_BUCKETS),
+    )
+    return f"{QUEUE_PREFIX}{bucket}:{memory_gb}x{cpu_cores}"
+
+
+def bucket_name(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    dc: str,
+    region: str,
+    memory_bucket: int,
+    cpu_bucket: int,
 ) -> str:
-    return f"{QUEUE_PREFIX}{dc}:{region}:{gpu_type}"
+    return f"{dc}:{region}:{gpu_type}:m{memory_bucket}:c{cpu_bucket}"
+
 
+def queue_bucket(queue: str) -> Tuple[str, str]:
+    """The bucket a queue is in and the size of the jobs in it, see queue_name"""
+    bucket, size = queue.removeprefix(QUEUE_PREFIX).rsplit(":", 1)
+    return bucket, size
 
-def enqueue_job(job) -> bool:
-    # score by submission timestamp so we can FIFO as much as possible
-    score = job.submitted_at.timestamp()
 
-    return redis_client.zadd(
-        queue_name(job.gpu_type, job.dc, job.region), {job.id: score}
+def sizes_key(bucket: str) -> str:
+    """The set of the job sizes a bucket has queues for"""
+    return SIZES_PREFIX + bucket
+
+
+def wake_key(bucket: str) -> str:
+    """The list executors block on while they wait for jobs to show up in this bucket"""
+    return WAKE_PREFIX + bucket
+
+
+def executor_wake_key(worker: str) -> str:
+    """An executor blocks on this too, so it can be woken up for reasons other than new jobs"""
+    return f"{WAKE_PREFIX}executor:{worker}"
+
+
+def wake_tokens(array_size: Optional[int]) -> int:
+    """
+    How many executors a job entering its queue wakes up: one, or one for every task of an
+    array job, since that many of them can work on it at once
+    """
+    return min(int(array_size or 1), WAKE_TOKEN_LIMIT)
+
+
+def queued_job_ids(queue: str) -> List[str]:
+    """What's in a queue, front first. Jobs that are done but not cleaned out yet included"""
+    return redis_client.zrange(queue, 0, -1)
+
+
+def queue_stats() -> List[Tuple[str, int, float]]:
+    """
+    Every queue with something in it (out of QUEUES_KEY, so no SCAN over the keyspace): its
+    name (without QUEUE_PREFIX), how many jobs are in it and how long the one at the front
+    has been waiting, in seconds (counting its priority as waiting, see queue_score).
+    Jobs that are done but not cleaned out of the queue yet are counted too.
+    """
+    queues = sorted(redis_client.smembers(QUEUES_KEY))
+    seconds, microseconds = redis_client.time()
+    with redis_client.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.zcard(queue)
+            pipe.zrange(queue, 0, 0, withscores=True)
+        return queue_stats_result(
+            queues, pipe.execute(), seconds + microseconds / 1_000_000
+        )
+
+
+def queue_stats_result(
+    queues: List[str], results: List, now: float
+) -> List[Tuple[str, int, float]]:
+    """queue_stats out of a ZCARD and a ZRANGE of the front for every queue"""
+    stats = []
+    for queue, depth, front in zip(queues, results[::2], results[1::2], strict=True):
+        # it may have been emptied since we found it
+        if depth and front:
+            stats.append((queue.removeprefix(QUEUE_PREFIX), depth, now - front[0][1]))
+    return stats
+
+
+def migrate_queues() -> int:
+    """
+    Move the jobs still waiting in queues of an older layout (see QUEUE_LAYOUT_KEY) to the
+    queues they go in now, in the same place in line, and rewrite the json records of the
+    ones that are still json (see legacy_record) as hashes, since dequeue.lua only reads
+    hashes. Nothing reads the old queues anymore, so until this ran those jobs would never
+    get picked up.
+
+    The scheduler runs it as it starts. It's a SCAN over the whole keyspace, so once it's
+    done it writes down that the queues are in this layout and doesn't do it again.
+    Returns how many jobs it moved.
+    """
+    # the models import us, we can only import them once we're all there
+    from app.models import Job
+
+    if redis_client.get(QUEUE_LAYOUT_KEY) == QUEUE_LAYOUT:
+        return 0
+    moved = 0
+    for queue in redis_client.scan_iter(
+        match=QUEUE_PREFIX + "*", count=1000, _type="zset"
+    ):
+        if re.fullmatch(r".*:m\d+:c\d+:\d+x\d+", queue):
+            continue
+        for job_id in redis_client.zrange(queue, 0, -1):
+            record = load_job(job_id)
+            with redis_client.pipeline(transaction=True) as pipe:
+                pipe.zrem(queue, job_id)
+                job = Job.from_record(record) if record else None
+                # an array job runs while there are tasks of it left to claim
+                if job and (
+                    job.status == "pending"
+                    or (job.status == "running" and job.array_size)
+                ):
+                    if record.get("v") == JSON_RECORD_VERSION:
+                        pipe.delete(PROJECT_PREFIX + job_id)
+                        keys, args = save_job_args(job)
+                        save_script(keys=keys, args=args, client=pipe)
+                    # queue_score of the job is the score it had, it never changes
+                    queue_job_commands(job, pipe)
+                    moved += 1
+                pipe.execute()
+    redis_client.set(QUEUE_LAYOUT_KEY, QUEUE_LAYOUT)
+    return moved
+
+
+@timed("enqueue")
+def enqueue_job(job, client=None) -> bool:
+    if job.depends_on:
+        # it waits for its dependencies, out of the queues
+        keys, args = hold_job_args(job, archived_dependency_statuses([job]))
+        depend_script(keys=keys, args=args, client=client or redis_client)
+        return True
+
+    # unless we're part of someone else's pipeline, still do it all in one round trip
+    if client is not None:
+        queue_job_commands(job, client)
+        return True
+
+    with redis_client.pipeline(transaction=False) as pipe:
+        queue_job_commands(job, pipe)
+        return pipe.execute()[0]
+
+
+def queue_score(submitted_at: float, priority: int) -> float:
+    """
+    Where a job goes in its queue, lowest first: when it was submitted, moved up
+    PRIORITY_SECONDS for every point of priority.
+
+    That's all the aging there is. Nothing ever gets rescored, a job just gets older while
+    the jobs coming in after it have later timestamps, so once a low priority job has waited
+    PRIORITY_SECONDS for every point it's behind, it goes ahead of new higher priority jobs.
+    Nobody starves, and the queues stay plain sorted sets.
+    """
+    return submitted_at - priority * PRIORITY_SECONDS
+
+
+def queue_job_commands(job, pipe):
+    """
+    Queue up everything enqueueing a job takes on a pipeline (sync or asyncio, the commands
+    are only buffered here) so it goes out in one round trip
+    """
+    # score by submission timestamp so we can FIFO as much as possible, priority moves it up
+    score = queue_score(job.submitted_at.timestamp(), job.priority)
+    queue = queue_name(
+        job.gpu_type,
+        job.dc,
+        job.region,
+        job.memory_requested,
+        job.cpu_cores_requested,
     )
 
+    bucket, size = queue_bucket(queue)
+    pipe.zadd(queue, {job.id: score})
+    pipe.sadd(sizes_key(bucket), size)
+    pipe.sadd(QUEUES_KEY, queue)
+    # write down where the job is, so an abort can take it back out (see abort.lua)
+    pipe.hset(PROJECT_PREFIX + job.id, "queue", queue)
+    # wake up an executor blocked on this bucket. if nobody is waiting the token sticks around
+    # for the next executor to come by, but there's no point keeping more than a handful
+    pipe.lpush(wake_key(bucket), *[job.id] * wake_tokens(job.array_size))
+    pipe.ltrim(wake_key(bucket), 0, WAKE_TOKEN_LIMIT - 1)
+
+
+def hold_job_args(job, archived: Dict[str, str]) -> Tuple[List[str], List]:
+    """
+    keys and args for the depend script, which holds a job with dependencies back until
+    they're done. archived has the statuses of dependencies that are only in the job store
+    """
+    args = [
+        finish_config(),
+        job.id,
+        queue_name(
+            job.gpu_type,
+            job.dc,
+            job.region,
+            job.memory_requested,
+            job.cpu_cores_requested,
+        ),
+        queue_score(job.submitted_at.timestamp(), job.priority),
+    ]
+    for dependency in job.depends_on:
+        args += [dependency, archived.get(dependency, "")]
+    return [PROJECT_PREFIX + job.id], args
+
+
+def archived_dependency_statuses(jobs) -> Dict[str, str]:
+    """
+    What the job store has for the dependencies of jobs. Those are done and won't change
+    anymore, and once they're out of redis the depend script can't see them
+    """
+    dependencies = list(
+        {dependency for job in jobs for dependency in job.depends_on or []}
+    )
+    if job_store is None or not dependencies:
+        return {}
+    return {record["id"]: record["status"] for record in job_store.load(dependencies)}
+
+
+def finish_config() -> str:
+    """
+    Everything the scripts that finish jobs need for letting the jobs depending on them
+    (and the arrays they're a task of) know, see finish.lua. As json so it's one argument
+    for all of them
+    """
+    return dumps(
+        {
+            "dependents": DEPENDENTS_PREFIX,
+            "tasks": TASKS_PREFIX,
+            "jobs": PROJECT_PREFIX,
+            "statuses": STATUS_INDEX_PREFIX,
+            "all": ALL_JOBS_INDEX,
+            "queues": QUEUE_PREFIX,
+            "sizes": SIZES_PREFIX,
+            "queue_registry": QUEUES_KEY,
+            "wake": WAKE_PREFIX,
+            "wake_limit": WAKE_TOKEN_LIMIT,
+            "priority_seconds": PRIORITY_SECONDS,
+            "finished": TERMINAL_STATUSES,
+            "archive": archive_key("failed"),
+            "now": datetime.now().isoformat(),
+        }
+    )
+
+
+def wake_executor(worker: str, released_cores: int = 0):
+    """
+    Wake up an executor blocked in wait_for_work, one token is plenty.
+    When it's because a job finished, released_cores hands its cores back in the registry too.
+    """
+    with redis_client.pipeline(transaction=False) as pipe:
+        if released_cores:
+            release_script(
+                keys=[executor_key(worker), FLEET_KEY],
+                args=[released_cores],
+                client=pipe,
+            )
+        pipe.lpush(executor_wake_key(worker), 1)
+        pipe.ltrim(executor_wake_key(worker), 0, 0)
+        pipe.execute()
+
+
+def wait_for_work(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str = "Any",
+    region: str = "Any",
+    timeout: float = 1,
+    worker: Optional[str] = None,
+) -> bool:
+    """
+    Block (server side, no polling) until a job lands in one of the buckets we'd dequeue
+    from, or the worker gets woken up some other way (see wake_executor), or we hit the timeout.
+
+    Returns whether we got woken up. Getting woken up doesn't promise there's a job for us
+    (someone else may have grabbed it, or it may not fit), so dequeue and find out.
+    """
+    keys = [
+        wake_key(bucket)
+        for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores)
+        for bucket in tier
+    ]
+    if worker:
+        keys.append(executor_wake_key(worker))
+    return redis_client.blpop(keys, timeout=timeout) is not None
+
+
+def upcoming_images(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str = "Any",
+    region: str = "Any",
+    depth: int = 10,
+) -> List[str]:
+    """
+    The images of the jobs at the front of every queue an executor takes work from (see
+    candidate_buckets), without repeats, so it can pull them before the jobs get to it.
+    Three round trips, one for the queues, one for the job ids and one for their images.
+    """
+    buckets = [
+        bucket
+        for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores)
+        for bucket in tier
+    ]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for bucket in buckets:
+            pipe.smembers(sizes_key(bucket))
+        queues = fitting_queues(buckets, pipe.execute(), memory_gb, cpu_cores)
+    with redis_client.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.zrange(queue, 0, depth - 1)
+        job_ids = [job_id for queued in pipe.execute() for job_id in queued]
+    with redis_client.pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hget(PROJECT_PREFIX + job_id, "image")
+        return list(dict.fromkeys(image for image in pipe.execute() if image))
 
+
+@timed("save_and_enqueue")
+def save_and_enqueue_jobs(jobs) -> List[bool]:
+    """
+    Persist and enqueue a whole batch of jobs in one transactional pipeline,
+    so it's one round trip no matter how many jobs there are.
+
+    Returns whether each job made it, in the same order as the jobs.
+    """
+    archived = archived_dependency_statuses(jobs)
+    with redis_client.pipeline(transaction=True) as pipe:
+        commands = []
+        for job in jobs:
+            buffered = len(pipe)
+            # not through save_job/enqueue_job, those would time how long buffering takes
+            keys, args = save_job_args(job)
+            save_script(keys=keys, args=args, client=pipe)
+            if job.depends_on:
+                keys, args = hold_job_args(job, archived)
+                depend_script(keys=keys, args=args, client=pipe)
+            else:
+                queue_job_commands(job, pipe)
+            commands.append(len(pipe) - buffered)
+        return batch_results(pipe.execute(raise_on_error=False), commands)
+
+
+def batch_results(results: List, commands: List[int]) -> List[bool]:
+    """
+    Whether each job of a batch made it, out of the results of the whole pipeline.
+    commands is how many commands each job queued up, one job after the other
+    """
+    made_it, start = [], 0
+    for count in commands:
+        made_it.append(
+            not any(
+                isinstance(result, Exception)
+                for result in results[start : start + count]
+            )
+        )
+        start += count
+    return made_it
+
+
+def candidate_buckets(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    dc: str = "Any",
+    region: str = "Any",
+    memory_gb: int = 1,
+    cpu_cores: int = 1,
+) -> List[List[str]]:
+    """
+    The buckets an executor should look in, in the order it should look at them:
+    my DC + my region + my GPU, then my DC + my region + any GPU,
+    then my DC + any region + any GPU, and finally any DC + any region + any GPU.
+
+    Each of those tiers is made up of every resource bucket at or below what the
+    executor has. Buckets above that only hold jobs we can't fit, so we never look at them.
+    In the buckets we do look in, only the queues of sizes we fit, see fitting_queues.
+    """
+    buckets = [
+        (memory_bucket, cpu_bucket)
+        for memory_bucket in range(resource_bucket(memory_gb, MEMORY_BUCKETS) + 1)
+        for cpu_bucket in range(resource_bucket(cpu_cores, CPU_BUCKETS) + 1)
+    ]
+
+    tiers = []
+    for tier_gpu, tier_dc, tier_region in (
+        (gpu_type, dc, region),
+        ("Any", dc, region),
+        ("Any", dc, "Any"),
+        ("Any", "Any", "Any"),
+    ):
+        tier = [
+            bucket_name(tier_gpu, tier_dc, tier_region, memory, cpu)
+            for memory, cpu in buckets
+        ]
+        # an executor that is already "Any" something would check the same queues twice
+        if tier not in tiers:
+            tiers.append(tier)
+    return tiers
+
+
+def fitting_queues(
+    buckets: List[str], sizes: List[List[str]], memory_gb: int, cpu_cores: int
+) -> List[str]:
+    """The queues of the given buckets (with the sizes each has queues for) that we fit"""
+    queues = []
+    for bucket, bucket_sizes in zip(buckets, sizes, strict=True):
+        for size in bucket_sizes:
+            memory, cpu = size.split("x")
+            if int(memory) <= memory_gb and int(cpu) <= cpu_cores:
+                queues.append(f"{QUEUE_PREFIX}{bucket}:{size}")
+    return queues
+
+
+@timed("dequeue")
 def dequeue_job(
     gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
     cpu_cores: int,
     memory_gb: int,
-    blocking_time: int = 1,
     dc: str = "Any",
     region: str = "Any",
-) -> Optional[Dict]:
-    """
-    Get the next job that should be worked on, given the passed in requirements
-    TODO: we have to check the job requirements in addition to the gpu type!
-    we got two options here, we can switch from a bzpopmin to a zrange, which pulls
-    my objects, and then i can do ZREM once i find the job that matches my requirements best
-    but that's not properly atomic
-    an alternative is using a lua script to do the same thing atomically
-    another alternative is creating a semaphore on this dequeue job function
-    to make sure that only one executor is dequeing at a time, but then
-    we're introducing a whole new bottleneck
-
-    lua is the way to go probably, but lets do the "bad" way first to get something working,
-    and revisit the lua way once I have enough tests to test the refactor with
-    """
-    # avoid circular imports
-    # the fact we're here means I'm breaking my own layeringn rules
-    # which means that this entire function does not belong here
-    # this should be either refactored to move into the executor logic, the model logic,
-    # or if I switch to lua, entirely done-away with
-    from app.models import Job
+    worker: str = "",
+) -> Optional[Dict[str, str]]:
+    """
+    Get the next job that should be worked on, given the passed in requirements.
 
-    # first version of this is just a bzpopmin, but it can only get one item
-    # queued_work = redis_client.bzpopmin(QUEUE_PREFIX + gpu_type, timeout=blocking_time)
+    The whole fallback cascade (see candidate_buckets) and the requirement checks
+    happen inside one lua script, so this is a single round trip and it is atomic:
+    either a job is removed from its queue and handed to us, or nothing moves.
+    Jobs we can't fit are never popped, so they keep their place in line.
+    Within a tier we take the oldest job that fits across all of its resource buckets.
+    This never blocks, see wait_for_work for that.
 
-    # so switch to zpopmin which can pop multiple items
-    possible_jobs = redis_client.zpopmin(queue_name(gpu_type, dc, region), count=10)
-    if not possible_jobs:
-        # we found none, so return none and let the caller try again
+    The job comes with a lease for worker, taken out by the same script (so it costs no
+    extra round trips). Keep it alive with renew_leases, or reap_expired_jobs puts the job
+    back in line.
+    A registered worker that's busier than the rest of the fleet gets nothing unless the
+    job has been waiting for a while, see dequeue.lua.
+    An array job hands out one of its tasks per call, as a job record of its own.
+
+    Returns the raw job record, the caller gets to decide how to rehydrate it.
+    """
+    tiers = candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores)
+    record = dequeue_script(
+        keys=[sizes_key(bucket) for tier in tiers for bucket in tier],
+        args=[
+            memory_gb,
+            cpu_cores,
+            PROJECT_PREFIX,
+            DEQUEUE_SCAN_LIMIT,
+            INFLIGHT_KEY,
+            LEASE_SECONDS,
+            worker,
+            executor_key(worker) if worker else "",
+            FLEET_KEY,
+            FAIR_SHARE_SLACK,
+            FAIR_SHARE_GRACE,
+            STATUS_INDEX_PREFIX,
+            ALL_JOBS_INDEX,
+            TASKS_PREFIX,
+            QUEUE_PREFIX,
+            SIZES_PREFIX,
+            QUEUES_KEY,
+            *[len(tier) for tier in tiers],
+        ],
+    )
+    if not record:
         return None
+    # lua hands hashes back as a flat list of field, value, field, value...
+    return dict(zip(record[::2], record[1::2], strict=True))
+
+
+def logs_key(job_id: str) -> str:
+    return LOGS_PREFIX + job_id
+
+
+def append_job_logs(job_id: str, chunk: str):
+    """Add a chunk of output to the job's log stream, trimming the oldest chunks as we go"""
+    redis_client.xadd(
+        logs_key(job_id), {"data": chunk}, maxlen=LOG_MAX_CHUNKS, approximate=True
+    )
+
+
+def finish_job_logs(job_id: str):
+    """
+    Mark the end of the job's output, so anyone following the logs knows to stop waiting,
+    and have the logs expire some time from now.
+    """
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xadd(
+            logs_key(job_id), {"eof": "1"}, maxlen=LOG_MAX_CHUNKS, approximate=True
+        )
+        pipe.expire(logs_key(job_id), LOG_TTL)
+        pipe.execute()
+
+
+def time_out_overdue_jobs() -> List[str]:
+    """
+    Mark the running jobs that are past their deadline timed_out, and have their
+    executors kill them. Returns the ids of the jobs that timed out.
+    """
+    keys, args = time_out_overdue_jobs_args()
+    return sweep_script(keys=keys, args=args)
+
+
+def time_out_overdue_jobs_args() -> Tuple[List[str], List]:
+    """keys and args for the sweep script"""
+    return [DEADLINE_INDEX, ALL_JOBS_INDEX], [
+        STATUS_INDEX_PREFIX,
+        PROJECT_PREFIX,
+        ABORT_CHANNEL_PREFIX,
+        REAP_LIMIT,
+        datetime.now().isoformat(),
+        archive_key("timed_out"),
+        finish_config(),
+    ]
+
+
+def executor_key(worker: str) -> str:
+    return EXECUTOR_PREFIX + worker
+
+
+def heartbeat(
+    worker: str, fields: Dict[str, str], job_ids: Optional[List[str]] = None
+) -> List[str]:
+    """
+    Register worker (the first time around) or refresh its registry record with fields,
+    which carry what it has and how much of it is in use, and renew the leases on job_ids.
+    All of it is one round trip, so thousands of executors beating every few seconds is fine.
+
+    Returns the ids whose lease we don't hold anymore, like renew_leases.
+    """
+    with redis_client.pipeline(transaction=False) as pipe:
+        args = [worker]
+        for field, value in fields.items():
+            args += [field, value]
+        heartbeat_script(
+            keys=[executor_key(worker), EXECUTOR_REGISTRY, FLEET_KEY],
+            args=args,
+            client=pipe,
+        )
+        if job_ids:
+            renew_script(
+                keys=[INFLIGHT_KEY],
+                args=[LEASE_SECONDS, PROJECT_PREFIX, worker, *job_ids],
+                client=pipe,
+            )
+        results = pipe.execute()
+    return results[1] if job_ids else []
+
+
+def prune_executors(workers: Optional[List[str]] = None) -> List[str]:
+    """
+    Drop the executors we haven't heard from in EXECUTOR_TTL from the registry,
+    or exactly the given workers (when they shut down). Returns who got dropped.
+    """
+    keys, args = prune_executors_args(workers)
+    return prune_script(keys=keys, args=args)
+
+
+def prune_executors_args(workers: Optional[List[str]] = None) -> Tuple[List[str], List]:
+    """keys and args for the prune script"""
+    return [EXECUTOR_REGISTRY, FLEET_KEY], [
+        EXECUTOR_PREFIX,
+        EXECUTOR_TTL,
+        REAP_LIMIT,
+        *(workers or []),
+    ]
+
+
+def list_executors() -> List[Dict[str, str]]:
+    """The registry records of every executor we heard from within EXECUTOR_TTL"""
+    seconds, microseconds = redis_client.time()
+    names = redis_client.zrangebyscore(
+        EXECUTOR_REGISTRY, seconds + microseconds / 1_000_000 - EXECUTOR_TTL, "+inf"
+    )
+    with redis_client.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.hgetall(executor_key(name))
+        return [record for record in pipe.execute() if record]
+
+
+def renew_leases(worker: str, job_ids: List[str]) -> List[str]:
+    """
+    Extend the leases worker holds on job_ids, in one round trip however many there are.
+    Returns the ids whose lease we don't hold anymore (the reaper took them away from us).
+    """
+    if not job_ids:
+        return []
+    return renew_script(
+        keys=[INFLIGHT_KEY], args=[LEASE_SECONDS, PROJECT_PREFIX, worker, *job_ids]
+    )
+
+
+def reap_expired_jobs() -> Tuple[List[str], List[str]]:
+    """
+    Put the jobs whose executor stopped renewing its lease back in line, and fail
+    the ones that already went through that MAX_RETRIES times.
+
+    Returns the ids of the requeued and of the failed jobs.
+    """
+    keys, args = reap_expired_jobs_args()
+    return reap_expired_jobs_result(reap_script(keys=keys, args=args))
+
+
+def reap_expired_jobs_args() -> Tuple[List[str], List]:
+    """keys and args for the reap script"""
+    return [INFLIGHT_KEY, ALL_JOBS_INDEX, DEADLINE_INDEX], [
+        STATUS_INDEX_PREFIX,
+        PROJECT_PREFIX,
+        MAX_RETRIES,
+        REAP_LIMIT,
+        datetime.now().isoformat(),
+        archive_key("failed"),
+        PRIORITY_SECONDS,
+        finish_config(),
+        datetime.now().astimezone().utcoffset().total_seconds(),
+    ]
+
+
+def reap_expired_jobs_result(result: List[str]) -> Tuple[List[str], List[str]]:
+    """The requeued and failed job ids out of what the reap script handed back"""
+    separator = result.index("")
+    return result[:separator], result[separator + 1 :]
+
 
-    # TODO: need to wrap all of this in a try/catch because if ANYTHING goes wrong in this function
-    # we will lose jobs from the queue
-    selected_job = None
-    for queued_work in possible_jobs:
-        job = Job.model_validate_json(load_job(queued_work[0]))
-
-        # this is wildly inefficient
-        # because we waste a lookup  on jobs we dont want even after we found
-        # the selected job
-        # BUT if this is all being replaced with lua, this temporary code
-        # is fine to leave as is until tthis whole logic is luafied
-        if (
-            selected_job is None
-            and job.memory_requested <= memory_gb
-            and job.cpu_cores_requested <= cpu_cores
-        ):
-            selected_job = job
-        else:
-            enqueue_job(job)  # put it back in the queue
-
-    return selected_job
+if BACKEND == "memory":
+    # the same functions, minus redis. it replaces everything above that talks to redis
+    # with its own versions as it's imported, so this has to come last
+    import app.persistence_memory  # noqa: F401
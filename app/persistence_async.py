@@ -0,0 +1,437 @@
+"""The asyncio side of app.persistence, for the scheduler API.
+
+Same keys, same lua scripts, same argument building (all of that lives in app.persistence),
+just talking to redis through redis.asyncio so a request waiting on redis doesn't tie up
+a threadpool worker.
+
+The client sits on an explicit, bounded connection pool. The scheduler's lifespan hook
+calls connect()/disconnect(), nothing connects at import time.
+
+With JOBSERVITOR_BACKEND=memory all of it is swapped out for app.persistence_memory_async
+(see the bottom of this file)."""
+
+import asyncio
+from datetime import datetime
+from os import environ
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import redis.asyncio
+from redis.commands.core import AsyncScript
+
+from app import persistence
+from app.metrics import timed
+from app.persistence import (
+    ABORT_CHANNEL_PREFIX,
+    ABORT_LIMIT,
+    ARCHIVE_DELAY,
+    ARCHIVE_KEY,
+    ARCHIVE_LIMIT,
+    BACKEND,
+    EXECUTOR_REGISTRY,
+    EXECUTOR_TTL,
+    LOG_FOLLOWERS_LIMIT,
+    PROJECT_PREFIX,
+    QUEUES_KEY,
+    REDIS_URI,
+    TERMINAL_STATUSES,
+    abort_jobs_args,
+    abort_matching_jobs_args,
+    archivable_jobs,
+    archived_dependency_statuses,
+    batch_results,
+    executor_key,
+    forget_jobs_args,
+    hash_results,
+    hold_job_args,
+    is_wrong_type,
+    job_position,
+    legacy_field,
+    legacy_record,
+    list_archived_jobs,
+    list_jobs_args,
+    list_jobs_result,
+    logs_key,
+    merge_job_pages,
+    prune_executors_args,
+    queue_job_commands,
+    queue_stats_result,
+    reap_expired_jobs_args,
+    reap_expired_jobs_result,
+    save_job_args,
+    script_source,
+    time_out_overdue_jobs_args,
+    update_job_args,
+    with_archived_jobs,
+)
+
+# how long a log follower blocks in redis at a time, before it checks on the job
+LOG_FOLLOW_BLOCK_MS = 5000
+# how many log chunks we read from redis at a time
+LOG_READ_COUNT = 100
+
+# how many connections the scheduler process may hold open to redis. once they're all busy
+# requests wait (up to REDIS_POOL_TIMEOUT seconds) for one to free up instead of opening more
+REDIS_MAX_CONNECTIONS = int(environ.get("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(environ.get("REDIS_POOL_TIMEOUT", 5))
+
+client: Optional[redis.asyncio.Redis] = None
+# log followers sit blocked in XREAD for as long as they follow, so they get connections of
+# their own instead of taking them from everyone else
+follower_client: Optional[redis.asyncio.Redis] = None
+followers = 0
+scripts: Dict[str, AsyncScript] = {}
+
+
+async def connect():
+    global client, follower_client
+    pool = redis.asyncio.BlockingConnectionPool.from_url(
+        REDIS_URI,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        decode_responses=True,
+    )
+    client = redis.asyncio.Redis(connection_pool=pool)
+    follower_pool = redis.asyncio.BlockingConnectionPool.from_url(
+        REDIS_URI,
+        max_connections=LOG_FOLLOWERS_LIMIT,
+        timeout=REDIS_POOL_TIMEOUT,
+        decode_responses=True,
+    )
+    follower_client = redis.asyncio.Redis(connection_pool=follower_pool)
+    print(f"✅ Connected to Redis {(await client.info())['redis_version']}")
+
+    for name in (
+        "save",
+        "transition",
+        "list",
+        "reap",
+        "prune",
+        "sweep",
+        "forget",
+        "abort",
+        "depend",
+    ):
+        scripts[name] = client.register_script(script_source(name))
+
+
+async def disconnect():
+    global client, follower_client
+    for connected in (client, follower_client):
+        if connected is not None:
+            await connected.aclose()
+            await connected.connection_pool.disconnect()
+    client, follower_client = None, None
+
+
+def get_client() -> redis.asyncio.Redis:
+    if client is None:
+        raise RuntimeError("Not connected to redis, is the lifespan hook running?")
+    return client
+
+
+@timed("save_and_enqueue")
+async def save_and_enqueue_jobs(jobs) -> List[bool]:
+    """The async app.persistence.save_and_enqueue_jobs, one transaction for the whole batch"""
+    archived = {}
+    if persistence.job_store is not None and any(job.depends_on for job in jobs):
+        archived = await asyncio.to_thread(archived_dependency_statuses, jobs)
+    async with get_client().pipeline(transaction=True) as pipe:
+        commands = []
+        for job in jobs:
+            buffered = len(pipe)
+            keys, args = save_job_args(job)
+            await scripts["save"](keys=keys, args=args, client=pipe)
+            if job.depends_on:
+                keys, args = hold_job_args(job, archived)
+                await scripts["depend"](keys=keys, args=args, client=pipe)
+            else:
+                queue_job_commands(job, pipe)
+            commands.append(len(pipe) - buffered)
+        return batch_results(await pipe.execute(raise_on_error=False), commands)
+
+
+@timed("load")
+async def load_job(job_id) -> Optional[Dict[str, str]]:
+    try:
+        record = await get_client().hgetall(PROJECT_PREFIX + job_id)
+    except redis.ResponseError as e:
+        if not is_wrong_type(e):
+            raise
+        return legacy_record(await get_client().get(PROJECT_PREFIX + job_id))
+    if not record and persistence.job_store is not None:
+        return next(
+            iter(await asyncio.to_thread(persistence.job_store.load, [job_id])), None
+        )
+    return record or None
+
+
+async def load_job_field(job_id, field: str) -> Optional[str]:
+    try:
+        value = await get_client().hget(PROJECT_PREFIX + job_id, field)
+    except redis.ResponseError as e:
+        if not is_wrong_type(e):
+            raise
+        return legacy_field(await get_client().get(PROJECT_PREFIX + job_id), field)
+    if value is None and persistence.job_store is not None:
+        return (await load_job(job_id) or {}).get(field)
+    return value
+
+
+async def load_jobs(job_ids: List[str]) -> List[Dict[str, str]]:
+    async with get_client().pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(PROJECT_PREFIX + job_id)
+        records = hash_results(await pipe.execute(raise_on_error=False))
+    records = [
+        (
+            legacy_record(await get_client().get(PROJECT_PREFIX + job_id))
+            if is_wrong_type(record)
+            else record
+        )
+        for job_id, record in zip(job_ids, records, strict=True)
+    ]
+    if persistence.job_store is None or all(records):
+        return [record for record in records if record]
+    # sqlite blocks, keep it off the event loop
+    return await asyncio.to_thread(with_archived_jobs, job_ids, records)
+
+
+async def update_job(
+    job_id,
+    fields: Dict[str, str],
+    expected_status: Optional[List[str]] = None,
+    expected_worker: Optional[str] = None,
+) -> bool:
+    keys, args = update_job_args(job_id, fields, expected_status, expected_worker)
+    return await scripts["transition"](keys=keys, args=args) == 1
+
+
+async def list_jobs(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    keys, args = list_jobs_args(status, filters, cursor, limit)
+    job_ids, next_cursor = list_jobs_result(await scripts["list"](keys=keys, args=args))
+    jobs = await load_jobs(job_ids)
+    archived = await asyncio.to_thread(
+        list_archived_jobs, status, filters, cursor, limit
+    )
+    if archived is None:
+        return jobs, next_cursor
+    return merge_job_pages(jobs, next_cursor, archived, limit)
+
+
+async def archive_jobs(delay: float = ARCHIVE_DELAY, limit: int = ARCHIVE_LIMIT) -> int:
+    """The async app.persistence.archive_jobs, for the archiver in the scheduler"""
+    store = persistence.job_store
+    if store is None:
+        return 0
+    seconds, _ = await get_client().time()
+    job_ids = await get_client().zrangebyscore(
+        ARCHIVE_KEY, "-inf", seconds - delay, start=0, num=limit
+    )
+    if not job_ids:
+        return 0
+    async with get_client().pipeline(transaction=False) as pipe:
+        for job_id in job_ids:
+            pipe.hgetall(PROJECT_PREFIX + job_id)
+        records = await pipe.execute()
+
+    archived = archivable_jobs(records)
+    await asyncio.to_thread(
+        store.save, [(record, job_position(record)[0]) for record in archived]
+    )
+    keys, args = forget_jobs_args(job_ids)
+    await scripts["forget"](keys=keys, args=args)
+    return len(archived)
+
+
+async def queue_stats() -> List[Tuple[str, int, float]]:
+    """see app.persistence.queue_stats"""
+    queues = sorted(await get_client().smembers(QUEUES_KEY))
+    seconds, microseconds = await get_client().time()
+    async with get_client().pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.zcard(queue)
+            pipe.zrange(queue, 0, 0, withscores=True)
+        return queue_stats_result(
+            queues, await pipe.execute(), seconds + microseconds / 1_000_000
+        )
+
+
+async def abort_jobs(job_ids: List[str], aborted_at: datetime) -> List[str]:
+    """see app.persistence.abort_jobs"""
+    aborted = []
+    for start in range(0, len(job_ids), ABORT_LIMIT):
+        keys, args = abort_jobs_args(job_ids[start : start + ABORT_LIMIT], aborted_at)
+        aborted += list_jobs_result(await scripts["abort"](keys=keys, args=args))[0]
+    return aborted
+
+
+async def abort_matching_jobs(
+    statuses: List[str], filters: Dict[str, str], aborted_at: datetime
+) -> List[str]:
+    """see app.persistence.abort_matching_jobs"""
+    aborted = []
+    for status in statuses:
+        cursor = None
+        while True:
+            keys, args = abort_matching_jobs_args(status, filters, aborted_at, cursor)
+            job_ids, cursor = list_jobs_result(
+                await scripts["abort"](keys=keys, args=args)
+            )
+            aborted += job_ids
+            if cursor is None:
+                break
+    return aborted
+
+
+async def publish_abort(worker: str, job_id: str) -> int:
+    return await get_client().publish(ABORT_CHANNEL_PREFIX + worker, job_id)
+
+
+async def reap_expired_jobs() -> Tuple[List[str], List[str]]:
+    """The async app.persistence.reap_expired_jobs, for the reaper in the scheduler"""
+    keys, args = reap_expired_jobs_args()
+    return reap_expired_jobs_result(await scripts["reap"](keys=keys, args=args))
+
+
+async def time_out_overdue_jobs() -> List[str]:
+    keys, args = time_out_overdue_jobs_args()
+    return await scripts["sweep"](keys=keys, args=args)
+
+
+async def prune_executors(workers: Optional[List[str]] = None) -> List[str]:
+    keys, args = prune_executors_args(workers)
+    return await scripts["prune"](keys=keys, args=args)
+
+
+async def list_executors() -> List[Dict[str, str]]:
+    seconds, microseconds = await get_client().time()
+    names = await get_client().zrangebyscore(
+        EXECUTOR_REGISTRY, seconds + microseconds / 1_000_000 - EXECUTOR_TTL, "+inf"
+    )
+    async with get_client().pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.hgetall(executor_key(name))
+        return [record for record in await pipe.execute() if record]
+
+
+async def job_logs(
+    job_id: str, tail: Optional[int] = None, follow: bool = False
+) -> AsyncIterator[str]:
+    """
+    The output of a job, chunk by chunk, oldest first. Only the last `tail` lines with tail,
+    and with follow we keep going as the job prints more, until it's done.
+
+    Never holds more than a page of chunks (or the tail) in memory, however big the log is.
+    Following takes a connection of the followers' pool, whoever asks for it is expected
+    to hold a follower slot for it, see reserve_log_follower.
+    """
+    key = logs_key(job_id)
+    last_id, finished = "0-0", False
+
+    if tail is not None:
+        text, last_id, finished = await _tail(key, tail)
+        if text:
+            yield text
+    else:
+        async for chunk_id, fields in _chunks(key):
+            last_id = chunk_id
+            if "eof" in fields:
+                finished = True
+                break
+            yield fields["data"]
+
+    if not follow or finished:
+        return
+    while True:
+        # blocks in redis (one connection of the followers' pool each) instead of polling
+        response = await follower_client.xread(
+            {key: last_id}, count=LOG_READ_COUNT, block=LOG_FOLLOW_BLOCK_MS
+        )
+        if not response:
+            # nothing new. if the job is done and there's no end marker (its executor
+            # died before it could write one) there never will be, so stop here. a job
+            # that's still waiting on its dependencies hasn't even started printing
+            status = await load_job_field(job_id, "status")
+            if status is None or status in TERMINAL_STATUSES:
+                return
+            continue
+        for chunk_id, fields in response[0][1]:
+            last_id = chunk_id
+            if "eof" in fields:
+                return
+            yield fields["data"]
+
+
+def reserve_log_follower() -> bool:
+    """
+    Take one of the LOG_FOLLOWERS_LIMIT slots for following a log, False when they're all
+    taken. Check and take in one go (nothing in between awaits, so nobody can get in between
+    on the event loop). Whoever got one hands it back with release_log_follower.
+    """
+    global followers
+    if followers >= persistence.LOG_FOLLOWERS_LIMIT:
+        return False
+    followers += 1
+    return True
+
+
+def release_log_follower():
+    global followers
+    followers -= 1
+
+
+def log_followers() -> int:
+    """How many log follower slots are taken right now, see reserve_log_follower"""
+    return followers
+
+
+async def _chunks(key: str):
+    """Every chunk of a log stream, a page at a time"""
+    start = "-"
+    while True:
+        page = await get_client().xrange(key, min=start, max="+", count=LOG_READ_COUNT)
+        for chunk in page:
+            yield chunk
+        if len(page) < LOG_READ_COUNT:
+            return
+        start = "(" + page[-1][0]
+
+
+async def _tail(key: str, lines: int) -> Tuple[str, str, bool]:
+    """
+    The last `lines` lines of a log stream, reading it backwards a page at a time until we
+    have enough of them. Returns them, the id of the newest chunk and whether the log is over.
+    """
+    chunks, newlines, newest, finished = [], 0, "0-0", False
+    before = "+"
+    # one newline more than we want lines, so we know the first one is whole
+    while newlines <= lines:
+        page = await get_client().xrevrange(
+            key, max=before, min="-", count=LOG_READ_COUNT
+        )
+        for chunk_id, fields in page:
+            if newest == "0-0":
+                newest = chunk_id
+            if "eof" in fields:
+                finished = True
+                continue
+            chunks.append(fields["data"])
+            newlines += fields["data"].count("\n")
+            if newlines > lines:
+                break
+        if len(page) < LOG_READ_COUNT:
+            break
+        before = "(" + page[-1][0]
+
+    text = "".join(reversed(chunks)).splitlines(keepends=True)
+    return "".join(text[-lines:]) if lines else "", newest, finished
+
+
+if BACKEND == "memory":
+    # replaces everything above as it's imported, so this has to come last
+    import app.persistence_memory_async  # noqa: F401
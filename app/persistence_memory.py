@@ -0,0 +1,946 @@
+"""app.persistence without redis, for when everything runs in one process.
+
+Same functions, same semantics, just plain python data structures behind one lock instead of
+redis and its lua scripts. Where there's a lua script behind the redis version, the function here
+follows it step by step (and says which one it is), so the two behave the same.
+
+  - every queue (see queue_name) is a heap of (score, job id, entry number), so the
+    oldest job is always at the front. Every bucket has a set of the sizes it has queues for. Entries are never taken out of the middle of a heap,
+    a job that leaves a queue just has its entry forgotten and the stale entry gets thrown
+    out whenever it comes up at the front.
+  - job records are the same flat dicts of strings the redis hashes hold.
+  - anyone waiting on something (executors waiting for work, log followers) waits on the lock.
+
+With JOBSERVITOR_BACKEND=memory this swaps itself in for the redis versions in app.persistence
+(which imports it for that), see the bottom of this file.
+"""
+
+import heapq
+import threading
+from bisect import bisect_right, insort
+from collections import defaultdict, deque
+from datetime import datetime
+from itertools import islice
+from time import monotonic, time
+from typing import Callable, Deque, Dict, List, Literal, Optional, Set, Tuple
+
+from app import persistence
+from app.metrics import timed
+from app.persistence import (
+    ABORTABLE_STATUSES,
+    ARCHIVE_DELAY,
+    ARCHIVE_LIMIT,
+    DEQUEUE_SCAN_LIMIT,
+    EXECUTOR_TTL,
+    FAIR_SHARE_GRACE,
+    FAIR_SHARE_SLACK,
+    LEASE_SECONDS,
+    LIST_SCAN_LIMIT,
+    LOG_MAX_CHUNKS,
+    LOG_TTL,
+    MAX_RETRIES,
+    QUEUE_PREFIX,
+    REAP_LIMIT,
+    TERMINAL_STATUSES,
+    WAKE_TOKEN_LIMIT,
+    archived_dependency_statuses,
+    candidate_buckets,
+    cursor_position,
+    executor_wake_key,
+    fitting_queues,
+    job_position,
+    list_archived_jobs,
+    merge_job_pages,
+    queue_bucket,
+    queue_name,
+    queue_score,
+    wake_key,
+    with_archived_jobs,
+)
+
+__all__ = [
+    "abort_jobs",
+    "abort_matching_jobs",
+    "append_job_logs",
+    "archive_jobs",
+    "dequeue_job",
+    "enqueue_job",
+    "finish_job_logs",
+    "heartbeat",
+    "list_executors",
+    "list_jobs",
+    "load_job",
+    "load_job_field",
+    "load_jobs",
+    "migrate_queues",
+    "prune_executors",
+    "publish_abort",
+    "queue_stats",
+    "queued_job_ids",
+    "reap_expired_jobs",
+    "renew_leases",
+    "save_and_enqueue_jobs",
+    "save_job",
+    "subscribe_to_aborts",
+    "time_out_overdue_jobs",
+    "upcoming_images",
+    "update_job",
+    "wait_for_work",
+    "wake_executor",
+]
+
+# one lock for all of it, like redis running one script at a time. it's a condition too,
+# so whoever waits for something to happen can wait on it
+lock = threading.Condition(threading.RLock())
+
+# job records by id
+job_records: Dict[str, Dict[str, str]] = {}
+# what the listing indexes score every job at (when it was submitted), and every job
+# ordered by that, then by id
+scores: Dict[str, float] = {}
+listing: List[Tuple[float, str]] = []
+# the queue heaps, and the entry number of the one live entry of every queued job
+queues: Dict[str, List[Tuple[float, str, int]]] = defaultdict(list)
+queued: Dict[str, int] = {}
+entries = 0
+# bucket to the sizes it has queues for, see sizes_key
+sizes: Dict[str, Set[str]] = defaultdict(set)
+# how many wake up tokens are waiting for executors, by redis wake key
+wake_tokens: Dict[str, int] = defaultdict(int)
+# job id to when its lease runs out, and to when it runs out of time
+inflight: Dict[str, float] = {}
+deadlines: Dict[str, float] = {}
+# finished jobs waiting to be archived, by when they finished
+archive: Dict[str, float] = {}
+# job id to the ids of the jobs waiting on it, see finish.lua
+dependents: Dict[str, Set[str]] = defaultdict(set)
+# array job id to its tasks that were claimed and aren't done yet, see dequeue.lua
+tasks: Dict[str, Set[str]] = defaultdict(set)
+# what stays with an array job when a task of it gets a record of its own
+ARRAY_ONLY_FIELDS = (
+    "id",
+    "status",
+    "array_size",
+    "tasks_claimed",
+    "tasks_succeeded",
+    "tasks_failed",
+    "depends_on",
+    "dependencies_left",
+)
+# executor registry records by name
+executors: Dict[str, Dict[str, str]] = {}
+abort_handlers: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+
+
+class JobLog:
+    """A job's output, the last LOG_MAX_CHUNKS chunks of it, numbered from 1"""
+
+    def __init__(self):
+        self.chunks: Deque[Tuple[int, str]] = deque(maxlen=LOG_MAX_CHUNKS)
+        self.written = 0
+        self.finished = False
+        self.expires_at: Optional[float] = None
+
+
+logs: Dict[str, JobLog] = {}
+
+
+def reset():
+    """
+    Forget everything, the flushdb of this backend. Abort subscriptions stay, they're
+    who is listening rather than what's stored, like redis pubsub.
+    """
+    global entries
+    with lock:
+        for state in (
+            job_records,
+            scores,
+            queues,
+            queued,
+            sizes,
+            wake_tokens,
+            inflight,
+            deadlines,
+            archive,
+            dependents,
+            tasks,
+            executors,
+            logs,
+        ):
+            state.clear()
+        listing.clear()
+        entries = 0
+
+
+def finished_and_archived(status: Optional[str]) -> bool:
+    """Whether a job going into status should be queued up for archiving, see archive_key"""
+    return persistence.job_store is not None and status in TERMINAL_STATUSES
+
+
+def write(record: Dict[str, str], fields: Dict[str, str]):
+    """Write fields into a job record, empty ones unset the field (see save.lua)"""
+    for field, value in fields.items():
+        if value == "":
+            record.pop(field, None)
+        else:
+            record[field] = value
+
+
+@timed("save")
+def save_job(job, client=None) -> bool:
+    # client is the redis pipeline to batch this into, nothing to batch here
+    record = job.to_record()
+    score = job.submitted_at.timestamp()
+    with lock:
+        write(job_records.setdefault(job.id, {}), record)
+        if scores.get(job.id) != score:
+            if job.id in scores:
+                listing.remove((scores[job.id], job.id))
+            scores[job.id] = score
+            insort(listing, (score, job.id))
+        if finished_and_archived(record["status"]):
+            archive[job.id] = time()
+    return True
+
+
+def load_jobs(job_ids: List[str]) -> List[Dict[str, str]]:
+    with lock:
+        records = [dict(job_records.get(job_id, {})) for job_id in job_ids]
+    return with_archived_jobs(job_ids, records)
+
+
+@timed("load")
+def load_job(job_id) -> Optional[Dict[str, str]]:
+    return next(iter(load_jobs([job_id])), None)
+
+
+def load_job_field(job_id, field: str) -> Optional[str]:
+    with lock:
+        record = job_records.get(job_id)
+        if record is not None:
+            return record.get(field)
+    return (load_job(job_id) or {}).get(field)
+
+
+def update_job(
+    job_id,
+    fields: Dict[str, str],
+    expected_status: Optional[List[str]] = None,
+    expected_worker: Optional[str] = None,
+) -> bool:
+    """see transition.lua"""
+    with lock:
+        record = job_records.get(job_id)
+        if record is None:
+            return False
+        status = record["status"]
+        if expected_status and status not in expected_status:
+            return False
+        if expected_worker and record.get("worker") != expected_worker:
+            return False
+
+        write(record, fields)
+        new_status = record["status"]
+        if new_status != status:
+            if new_status == "running":
+                timeout = int(record.get("timeout_seconds") or 0)
+                if timeout > 0:
+                    deadlines[job_id] = time() + timeout
+            elif status == "running":
+                deadlines.pop(job_id, None)
+            if finished_and_archived(new_status):
+                archive[job_id] = time()
+            finish_job(job_id, new_status)
+        return True
+
+
+def list_jobs(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """see list.lua"""
+    filters = filters or {}
+    page, next_cursor = [], None
+    with lock:
+        start = bisect_right(listing, cursor_position(cursor)) if cursor else 0
+        examined = 0
+        for score, job_id in islice(listing, start, None):
+            examined += 1
+            record = job_records[job_id]
+            if (not status or record["status"] == status) and all(
+                record.get(field) == value for field, value in filters.items()
+            ):
+                page.append(dict(record))
+            if len(page) == limit or examined >= LIST_SCAN_LIMIT:
+                next_cursor = f"{score}:{job_id}"
+                break
+
+    archived = list_archived_jobs(status, filters, cursor, limit)
+    if archived is None:
+        return page, next_cursor
+    return merge_job_pages(page, next_cursor, archived, limit)
+
+
+def archive_jobs(delay: float = ARCHIVE_DELAY, limit: int = ARCHIVE_LIMIT) -> int:
+    """see app.persistence.archive_jobs"""
+    store = persistence.job_store
+    if store is None:
+        return 0
+    with lock:
+        cutoff = time() - delay
+        due = sorted(
+            (finished_at, job_id)
+            for job_id, finished_at in archive.items()
+            if finished_at <= cutoff
+        )[:limit]
+        job_ids = [job_id for _, job_id in due]
+        records = [dict(job_records.get(job_id, {})) for job_id in job_ids]
+
+    archived = [
+        record for record in records if record.get("status") in TERMINAL_STATUSES
+    ]
+    store.save([(record, job_position(record)[0]) for record in archived])
+
+    with lock:
+        # see forget.lua
+        for job_id in job_ids:
+            archive.pop(job_id, None)
+            record = job_records.get(job_id)
+            if record is not None and record["status"] not in TERMINAL_STATUSES:
+                continue
+            job_records.pop(job_id, None)
+            if job_id in scores:
+                listing.remove((scores.pop(job_id), job_id))
+    return len(archived)
+
+
+def abort_jobs(job_ids: List[str], aborted_at: datetime) -> List[str]:
+    """see abort.lua"""
+    aborts = []
+
+    def abort(job_id: str) -> bool:
+        record = job_records.get(job_id)
+        if record is None or record["status"] not in ABORTABLE_STATUSES:
+            return False
+        if record["status"] == "running":
+            deadlines.pop(job_id, None)
+        # out of its queue (a running array job can still be in one), its heap entry
+        # gets thrown out when it comes up
+        queued.pop(job_id, None)
+        record.update(status="aborted", aborted_at=aborted_at.isoformat())
+        if finished_and_archived("aborted"):
+            archive[job_id] = time()
+        if record.get("worker"):
+            aborts.append((record["worker"], job_id))
+        finish_job(job_id, "aborted")
+        for task_id in list(tasks.get(job_id, ())):
+            abort(task_id)
+        return True
+
+    with lock:
+        aborted = [job_id for job_id in job_ids if abort(job_id)]
+    for worker, job_id in aborts:
+        publish_abort(worker, job_id)
+    return aborted
+
+
+def abort_matching_jobs(
+    statuses: List[str], filters: Dict[str, str], aborted_at: datetime
+) -> List[str]:
+    """see abort.lua"""
+    for status in statuses:
+        if status not in ABORTABLE_STATUSES:
+            raise ValueError(f"Jobs that are {status} can't be aborted")
+    with lock:
+        # in status order and oldest first, like walking the status indexes
+        job_ids = [
+            job_id
+            for status in statuses
+            for _, job_id in listing
+            if job_records[job_id]["status"] == status
+            and all(
+                job_records[job_id].get(field) == value
+                for field, value in filters.items()
+            )
+        ]
+        return abort_jobs(job_ids, aborted_at)
+
+
+def publish_abort(worker: str, job_id: str) -> int:
+    with lock:
+        handlers = list(abort_handlers[worker])
+    for handler in handlers:
+        handler(job_id)
+    return len(handlers)
+
+
+class AbortSubscription:
+    """What subscribe_to_aborts hands back, like the redis pubsub thread it can be stopped"""
+
+    def __init__(self, worker: str, handler: Callable[[str], None]):
+        self.worker = worker
+        self.handler = handler
+
+    def stop(self):
+        with lock:
+            if self.handler in abort_handlers[self.worker]:
+                abort_handlers[self.worker].remove(self.handler)
+
+
+def subscribe_to_aborts(worker: str, handler: Callable[[str], None]):
+    with lock:
+        abort_handlers[worker].append(handler)
+    return AbortSubscription(worker, handler)
+
+
+def queued_job_ids(queue: str) -> List[str]:
+    with lock:
+        return [
+            job_id
+            for _, job_id, entry in sorted(queues.get(queue, []))
+            if queued.get(job_id) == entry
+        ]
+
+
+def queue_stats() -> List[Tuple[str, int, float]]:
+    now = time()
+    stats = []
+    with lock:
+        for queue, heap in queues.items():
+            waiting = [
+                score for score, job_id, entry in heap if queued.get(job_id) == entry
+            ]
+            if waiting:
+                stats.append(
+                    (queue.removeprefix(QUEUE_PREFIX), len(waiting), now - min(waiting))
+                )
+    return sorted(stats)
+
+
+def migrate_queues() -> int:
+    """Nothing in here outlives the process, so there are no queues of an older layout"""
+    return 0
+
+
+def push(queue: str, job_id: str, score: float, array_size: Optional[int] = None):
+    """Put a job in a queue and leave wake up tokens for whoever waits on it"""
+    global entries
+    entries += 1
+    queued[job_id] = entries
+    heapq.heappush(queues[queue], (score, job_id, entries))
+    bucket, size = queue_bucket(queue)
+    sizes[bucket].add(size)
+    key = wake_key(bucket)
+    wake_tokens[key] = min(
+        wake_tokens[key] + persistence.wake_tokens(array_size), WAKE_TOKEN_LIMIT
+    )
+    lock.notify_all()
+
+
+@timed("enqueue")
+def enqueue_job(job, client=None) -> bool:
+    queue = queue_name(
+        job.gpu_type,
+        job.dc,
+        job.region,
+        job.memory_requested,
+        job.cpu_cores_requested,
+    )
+    if job.depends_on:
+        hold(job, queue, archived_dependency_statuses([job]))
+        return True
+    with lock:
+        push(
+            queue,
+            job.id,
+            queue_score(job.submitted_at.timestamp(), job.priority),
+            job.array_size,
+        )
+        # where the job is, so an abort can take it back out
+        if job.id in job_records:
+            job_records[job.id]["queue"] = queue
+    return True
+
+
+def hold(job, queue: str, archived: Dict[str, str]):
+    """see depend.lua"""
+    with lock:
+        left, failed_dependency = set(), None
+        for dependency in job.depends_on:
+            status = job_records.get(dependency, {}).get("status") or archived.get(
+                dependency, ""
+            )
+            if status == "succeeded":
+                continue
+            if status == "" or status in TERMINAL_STATUSES:
+                failed_dependency = failed_dependency or dependency
+            else:
+                dependents[dependency].add(job.id)
+                left.add(dependency)
+
+        record = job_records[job.id]
+        record["queue"] = queue
+        if failed_dependency:
+            record.update(
+                status="failed",
+                completed_at=datetime.now().isoformat(),
+                failed_dependency=failed_dependency,
+            )
+            if finished_and_archived("failed"):
+                archive[job.id] = time()
+        elif left:
+            record.update(status="waiting", dependencies_left=str(len(left)))
+        else:
+            push(
+                queue,
+                job.id,
+                queue_score(job.submitted_at.timestamp(), job.priority),
+                job.array_size,
+            )
+
+
+def finish_job(job_id: str, status: str):
+    """see finish.lua"""
+    if status not in TERMINAL_STATUSES:
+        return
+    upstream = [(job_id, status)]
+    while upstream:
+        done, done_status = upstream.pop()
+
+        array_id = job_records.get(done, {}).get("array_id")
+        array = job_records.get(array_id) if array_id else None
+        if array is not None:
+            tasks[array_id].discard(done)
+            if not tasks[array_id]:
+                del tasks[array_id]
+            # see finish.lua, only archiving keeps a finished task around
+            if persistence.job_store is None:
+                del job_records[done]
+            counter = (
+                "tasks_succeeded" if done_status == "succeeded" else "tasks_failed"
+            )
+            array[counter] = str(int(array.get(counter) or 0) + 1)
+            succeeded = int(array.get("tasks_succeeded") or 0)
+            failed = int(array.get("tasks_failed") or 0)
+            # an aborted array stays aborted, however its tasks end
+            if array["status"] not in TERMINAL_STATUSES and succeeded + failed >= int(
+                array["array_size"]
+            ):
+                array_status = "failed" if failed else "succeeded"
+                array.update(
+                    status=array_status, completed_at=datetime.now().isoformat()
+                )
+                if finished_and_archived(array_status):
+                    archive[array_id] = time()
+                upstream.append((array_id, array_status))
+
+        for dependent in dependents.pop(done, ()):
+            record = job_records.get(dependent)
+            if record is None or record["status"] != "waiting":
+                continue
+            if done_status == "succeeded":
+                left = int(record["dependencies_left"]) - 1
+                record["dependencies_left"] = str(left)
+                if left <= 0:
+                    record["status"] = "pending"
+                    priority = int(record.get("priority") or 0)
+                    push(
+                        record["queue"],
+                        dependent,
+                        queue_score(scores[dependent], priority),
+                        record.get("array_size"),
+                    )
+            else:
+                record.update(
+                    status="failed",
+                    completed_at=datetime.now().isoformat(),
+                    failed_dependency=done,
+                )
+                if finished_and_archived("failed"):
+                    archive[dependent] = time()
+                upstream.append((dependent, "failed"))
+
+
+@timed("save_and_enqueue")
+def save_and_enqueue_jobs(jobs) -> List[bool]:
+    # all under the lock, so it's all or nothing to anyone looking, like the redis transaction
+    with lock:
+        return [save_job(job) and enqueue_job(job) for job in jobs]
+
+
+def wake_executor(worker: str, released_cores: int = 0):
+    with lock:
+        executor = executors.get(worker)
+        if released_cores and executor is not None:
+            # see release.lua
+            executor["cores_used"] = str(
+                int(executor.get("cores_used", 0)) - released_cores
+            )
+        wake_tokens[executor_wake_key(worker)] = 1
+        lock.notify_all()
+
+
+def wait_for_work(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str = "Any",
+    region: str = "Any",
+    timeout: float = 1,
+    worker: Optional[str] = None,
+) -> bool:
+    keys = [
+        wake_key(bucket)
+        for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores)
+        for bucket in tier
+    ]
+    if worker:
+        keys.append(executor_wake_key(worker))
+
+    give_up_at = monotonic() + timeout
+    with lock:
+        while True:
+            for key in keys:
+                if wake_tokens.get(key):
+                    wake_tokens[key] -= 1
+                    return True
+            remaining = give_up_at - monotonic()
+            if remaining <= 0:
+                return False
+            lock.wait(remaining)
+
+
+def upcoming_images(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str = "Any",
+    region: str = "Any",
+    depth: int = 10,
+) -> List[str]:
+    images = []
+    buckets = [
+        bucket
+        for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores)
+        for bucket in tier
+    ]
+    with lock:
+        bucket_sizes = [list(sizes.get(bucket, ())) for bucket in buckets]
+        for queue in fitting_queues(buckets, bucket_sizes, memory_gb, cpu_cores):
+            front = heapq.nsmallest(
+                depth,
+                (
+                    (score, job_id)
+                    for score, job_id, entry in queues.get(queue, [])
+                    if queued.get(job_id) == entry
+                ),
+            )
+            images += [job_records[job_id]["image"] for _, job_id in front]
+    return list(dict.fromkeys(images))
+
+
+def first_fit(
+    queue: str, memory_gb: int, cpu_cores: int, budget: int
+) -> Tuple[Optional[Tuple[float, str, int]], int]:
+    """
+    The oldest job in this queue that we can fit, as score, id and cores, and how much of
+    the budget is left. Looks at no more than budget entries, throwing out the ones of
+    jobs that aren't queued anymore on the way.
+    """
+    heap = queues.get(queue)
+    looked_at, fit = [], None
+    while heap and budget > 0:
+        budget -= 1
+        score, job_id, entry = heapq.heappop(heap)
+        if queued.get(job_id) != entry:
+            continue
+        record = job_records.get(job_id)
+        # an array job runs while there are tasks of it left to claim
+        if record is None or not (
+            record["status"] == "pending"
+            or (record["status"] == "running" and "array_size" in record)
+        ):
+            del queued[job_id]
+            continue
+        looked_at.append((score, job_id, entry))
+        if (
+            int(record["memory_requested"]) <= memory_gb
+            and int(record["cpu_cores_requested"]) <= cpu_cores
+        ):
+            fit = (score, job_id, int(record["cpu_cores_requested"]))
+            break
+    # they all keep their place in line, even the one that fit, until it's actually taken
+    for entry in looked_at:
+        heapq.heappush(heap, entry)
+    return fit, budget
+
+
+def above_fair_share(worker: str) -> bool:
+    """Whether the executor is busier than the fleet as a whole, see dequeue.lua"""
+    mine = executors.get(worker)
+    if not mine:
+        return False
+    my_cores, my_used = int(mine.get("cpu_cores", 0)), int(mine.get("cores_used", 0))
+    fleet_cores = sum(int(e.get("cpu_cores", 0)) for e in executors.values())
+    fleet_used = sum(int(e.get("cores_used", 0)) for e in executors.values())
+    if my_used <= 0 or my_cores <= 0 or fleet_cores <= 0:
+        return False
+    return my_used / my_cores > fleet_used / fleet_cores + FAIR_SHARE_SLACK
+
+
+def claim_task(array_id: str) -> str:
+    """Give the next task of an array job a record of its own, see dequeue.lua"""
+    array = job_records[array_id]
+    index = int(array.get("tasks_claimed") or 0)
+    array.update(tasks_claimed=str(index + 1), status="running")
+    if index + 1 >= int(array["array_size"]):
+        del queued[array_id]
+
+    task_id = f"{array_id}_{index}"
+    job_records[task_id] = {
+        **{
+            field: value
+            for field, value in array.items()
+            if field not in ARRAY_ONLY_FIELDS
+        },
+        "id": task_id,
+        "status": "pending",
+        "array_id": array_id,
+        "array_index": str(index),
+    }
+    tasks[array_id].add(task_id)
+    return task_id
+
+
+@timed("dequeue")
+def dequeue_job(
+    gpu_type: Literal["NVIDIA", "AMD", "Intel", "Any"],
+    cpu_cores: int,
+    memory_gb: int,
+    dc: str = "Any",
+    region: str = "Any",
+    worker: str = "",
+) -> Optional[Dict[str, str]]:
+    """see dequeue.lua"""
+    with lock:
+        now = time()
+        backing_off = above_fair_share(worker)
+        budget = DEQUEUE_SCAN_LIMIT
+        for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores):
+            best_queue, best = None, None
+            for bucket in tier:
+                bucket_sizes = sizes.get(bucket, set())
+                for queue in fitting_queues(
+                    [bucket], [list(bucket_sizes)], memory_gb, cpu_cores
+                ):
+                    fit, budget = first_fit(queue, memory_gb, cpu_cores, budget)
+                    if fit and (best is None or fit[0] < best[0]):
+                        best_queue, best = queue, fit
+                    elif not fit and not queues.get(queue):
+                        bucket_sizes.discard(queue_bucket(queue)[1])
+            if best is None:
+                continue
+
+            score, job_id, cores = best
+            if backing_off and now - score < FAIR_SHARE_GRACE:
+                return None
+
+            if "array_size" in job_records[job_id]:
+                job_id = claim_task(job_id)
+            else:
+                del queued[job_id]
+            inflight[job_id] = now + LEASE_SECONDS
+            executor = executors.get(worker)
+            if executor is not None:
+                executor["cores_used"] = str(int(executor.get("cores_used", 0)) + cores)
+            record = job_records[job_id]
+            record.update(worker=worker, queue=best_queue)
+            return dict(record)
+    return None
+
+
+def append_job_logs(job_id: str, chunk: str):
+    with lock:
+        log = logs.setdefault(job_id, JobLog())
+        log.written += 1
+        log.chunks.append((log.written, chunk))
+        lock.notify_all()
+
+
+def finish_job_logs(job_id: str):
+    with lock:
+        log = logs.setdefault(job_id, JobLog())
+        log.finished = True
+        log.expires_at = time() + LOG_TTL
+        lock.notify_all()
+
+
+def job_log_chunks(job_id: str, after: int = 0) -> Tuple[List[Tuple[int, str]], bool]:
+    """The chunks of a job's output numbered after `after`, and whether that's all of it"""
+    with lock:
+        log = logs.get(job_id)
+        if log is None:
+            return [], False
+        if log.expires_at is not None and log.expires_at < time():
+            del logs[job_id]
+            return [], False
+        return [chunk for chunk in log.chunks if chunk[0] > after], log.finished
+
+
+def wait_for_job_logs(job_id: str, after: int, timeout: float) -> bool:
+    """Block until there's output numbered after `after` or the log is over, or the timeout"""
+    give_up_at = monotonic() + timeout
+    with lock:
+        while True:
+            log = logs.get(job_id)
+            if log is not None and (log.finished or log.written > after):
+                return True
+            remaining = give_up_at - monotonic()
+            if remaining <= 0:
+                return False
+            lock.wait(remaining)
+
+
+def time_out_overdue_jobs() -> List[str]:
+    """see sweep.lua"""
+    timed_out, aborts = [], []
+    with lock:
+        now = time()
+        overdue = sorted(
+            (deadline, job_id)
+            for job_id, deadline in deadlines.items()
+            if deadline <= now
+        )[:REAP_LIMIT]
+        for _, job_id in overdue:
+            del deadlines[job_id]
+            record = job_records.get(job_id)
+            if record is None or record["status"] != "running":
+                continue
+            record.update(status="timed_out", completed_at=datetime.now().isoformat())
+            if finished_and_archived("timed_out"):
+                archive[job_id] = now
+            if record.get("worker"):
+                aborts.append((record["worker"], job_id))
+            finish_job(job_id, "timed_out")
+            timed_out.append(job_id)
+    # the kill goes out like any abort would, once we let go of the lock
+    for worker, job_id in aborts:
+        publish_abort(worker, job_id)
+    return timed_out
+
+
+def heartbeat(
+    worker: str, fields: Dict[str, str], job_ids: Optional[List[str]] = None
+) -> List[str]:
+    """see heartbeat.lua"""
+    with lock:
+        now = str(time())
+        executor = executors.setdefault(worker, {"registered_at": now})
+        executor.update(fields)
+        executor["heartbeat_at"] = now
+        return renew_leases(worker, job_ids or [])
+
+
+def prune_executors(workers: Optional[List[str]] = None) -> List[str]:
+    """see prune.lua"""
+    with lock:
+        if workers is None:
+            cutoff = time() - EXECUTOR_TTL
+            workers = sorted(
+                name
+                for name, executor in executors.items()
+                if float(executor["heartbeat_at"]) <= cutoff
+            )[:REAP_LIMIT]
+        return [name for name in workers if executors.pop(name, None) is not None]
+
+
+def list_executors() -> List[Dict[str, str]]:
+    with lock:
+        cutoff = time() - EXECUTOR_TTL
+        return [
+            dict(executor)
+            for executor in executors.values()
+            if float(executor["heartbeat_at"]) >= cutoff
+        ]
+
+
+def renew_leases(worker: str, job_ids: List[str]) -> List[str]:
+    """see renew.lua"""
+    lost = []
+    with lock:
+        expires = time() + LEASE_SECONDS
+        for job_id in job_ids:
+            if (
+                job_id in inflight
+                and job_records.get(job_id, {}).get("worker") == worker
+            ):
+                inflight[job_id] = expires
+            else:
+                lost.append(job_id)
+    return lost
+
+
+def reap_expired_jobs() -> Tuple[List[str], List[str]]:
+    """see reap.lua"""
+    requeued, failed = [], []
+    with lock:
+        now = time()
+        expired = sorted(
+            (expires, job_id) for job_id, expires in inflight.items() if expires <= now
+        )[:REAP_LIMIT]
+        for _, job_id in expired:
+            del inflight[job_id]
+            record = job_records.get(job_id)
+            if record is None or record["status"] not in ("pending", "running"):
+                continue
+
+            deadlines.pop(job_id, None)
+            retries = int(record.get("retries") or 0) + 1
+            queue = record.get("queue")
+            if retries > MAX_RETRIES or not queue:
+                record.update(status="failed", completed_at=datetime.now().isoformat())
+                if finished_and_archived("failed"):
+                    archive[job_id] = now
+                finish_job(job_id, "failed")
+                failed.append(job_id)
+            else:
+                write(
+                    record,
+                    {
+                        "status": "pending",
+                        "retries": str(retries),
+                        "worker": "",
+                        "started_at": "",
+                    },
+                )
+                # back where it was, so it doesn't lose its place in line. the task of
+                # an array job isn't listed, it goes where its array was
+                priority = int(record.get("priority") or 0)
+                scored = record.get("array_id", job_id)
+                if scored in scores:
+                    submitted = scores[scored]
+                elif record.get("submitted_at"):
+                    submitted = datetime.fromisoformat(
+                        record["submitted_at"]
+                    ).timestamp()
+                else:
+                    submitted = now
+                push(queue, job_id, queue_score(submitted, priority))
+                requeued.append(job_id)
+
+        # nothing expires on its own in here, so the reaper takes the old logs out too
+        for job_id in [
+            job_id
+            for job_id, log in logs.items()
+            if log.expires_at is not None and log.expires_at < now
+        ]:
+            del logs[job_id]
+    return requeued, failed
+
+
+if persistence.BACKEND == "memory":
+    # whichever of us got imported first, app.persistence is all there by now
+    for name in __all__:
+        setattr(persistence, name, globals()[name])
@@ -0,0 +1,201 @@
+"""app.persistence_async without redis, on top of app.persistence_memory.
+
+Nothing in there waits on the network, so most of this just calls straight through.
+What can block (waiting on the job store, or for more log output) goes to a thread,
+so the event loop never waits on it.
+
+With JOBSERVITOR_BACKEND=memory this swaps itself in for app.persistence_async, like
+app.persistence_memory does for app.persistence.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app import persistence, persistence_async, persistence_memory
+from app.persistence import (
+    ARCHIVE_DELAY,
+    ARCHIVE_LIMIT,
+    BACKEND,
+    LOG_FOLLOWERS_LIMIT,
+    TERMINAL_STATUSES,
+)
+
+__all__ = [
+    "abort_jobs",
+    "abort_matching_jobs",
+    "archive_jobs",
+    "connect",
+    "disconnect",
+    "job_logs",
+    "list_executors",
+    "list_jobs",
+    "load_job",
+    "load_job_field",
+    "load_jobs",
+    "log_followers",
+    "prune_executors",
+    "publish_abort",
+    "queue_stats",
+    "reap_expired_jobs",
+    "release_log_follower",
+    "reserve_log_follower",
+    "save_and_enqueue_jobs",
+    "time_out_overdue_jobs",
+    "update_job",
+]
+
+# how long a log follower waits for more output at a time, before it checks on the job
+LOG_FOLLOW_BLOCK_SECONDS = 5
+# the followers wait in threads of their own, so they can't take up the default executor's
+# threads everything else in here goes to
+follower_threads = ThreadPoolExecutor(
+    max_workers=LOG_FOLLOWERS_LIMIT, thread_name_prefix="log-follower"
+)
+followers = 0
+
+
+async def connect():
+    print("✅ No redis, jobs and queues live in this process")
+
+
+async def disconnect():
+    pass
+
+
+async def save_and_enqueue_jobs(jobs) -> List[bool]:
+    return persistence_memory.save_and_enqueue_jobs(jobs)
+
+
+async def load_job(job_id) -> Optional[Dict[str, str]]:
+    # archived jobs come out of the job store, which may well block
+    return await asyncio.to_thread(persistence_memory.load_job, job_id)
+
+
+async def load_job_field(job_id, field: str) -> Optional[str]:
+    return await asyncio.to_thread(persistence_memory.load_job_field, job_id, field)
+
+
+async def load_jobs(job_ids: List[str]) -> List[Dict[str, str]]:
+    return await asyncio.to_thread(persistence_memory.load_jobs, job_ids)
+
+
+async def update_job(
+    job_id,
+    fields: Dict[str, str],
+    expected_status: Optional[List[str]] = None,
+    expected_worker: Optional[str] = None,
+) -> bool:
+    return persistence_memory.update_job(
+        job_id, fields, expected_status, expected_worker
+    )
+
+
+async def list_jobs(
+    status: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    return await asyncio.to_thread(
+        persistence_memory.list_jobs, status, filters, cursor, limit
+    )
+
+
+async def archive_jobs(delay: float = ARCHIVE_DELAY, limit: int = ARCHIVE_LIMIT) -> int:
+    return await asyncio.to_thread(persistence_memory.archive_jobs, delay, limit)
+
+
+async def queue_stats() -> List[Tuple[str, int, float]]:
+    return persistence_memory.queue_stats()
+
+
+async def abort_jobs(job_ids: List[str], aborted_at: datetime) -> List[str]:
+    return persistence_memory.abort_jobs(job_ids, aborted_at)
+
+
+async def abort_matching_jobs(
+    statuses: List[str], filters: Dict[str, str], aborted_at: datetime
+) -> List[str]:
+    return persistence_memory.abort_matching_jobs(statuses, filters, aborted_at)
+
+
+async def publish_abort(worker: str, job_id: str) -> int:
+    return persistence_memory.publish_abort(worker, job_id)
+
+
+async def reap_expired_jobs() -> Tuple[List[str], List[str]]:
+    return persistence_memory.reap_expired_jobs()
+
+
+async def time_out_overdue_jobs() -> List[str]:
+    return persistence_memory.time_out_overdue_jobs()
+
+
+async def prune_executors(workers: Optional[List[str]] = None) -> List[str]:
+    return persistence_memory.prune_executors(workers)
+
+
+async def list_executors() -> List[Dict[str, str]]:
+    return persistence_memory.list_executors()
+
+
+async def job_logs(
+    job_id: str, tail: Optional[int] = None, follow: bool = False
+) -> AsyncIterator[str]:
+    """see app.persistence_async.job_logs"""
+    chunks, finished = persistence_memory.job_log_chunks(job_id)
+    last = chunks[-1][0] if chunks else 0
+
+    if tail is not None:
+        text = "".join(data for _, data in chunks).splitlines(keepends=True)
+        if tail and text:
+            yield "".join(text[-tail:])
+    else:
+        for _, data in chunks:
+            yield data
+
+    if not follow or finished:
+        return
+    while not finished:
+        more = await asyncio.get_running_loop().run_in_executor(
+            follower_threads,
+            persistence_memory.wait_for_job_logs,
+            job_id,
+            last,
+            LOG_FOLLOW_BLOCK_SECONDS,
+        )
+        chunks, finished = persistence_memory.job_log_chunks(job_id, last)
+        if not more:
+            status = await load_job_field(job_id, "status")
+            if status is None or status in TERMINAL_STATUSES:
+                # done, and its executor never got to mark the end of the log
+                return
+        for chunk, data in chunks:
+            last = chunk
+            yield data
+
+
+def reserve_log_follower() -> bool:
+    """see app.persistence_async.reserve_log_follower"""
+    global followers
+    if followers >= persistence.LOG_FOLLOWERS_LIMIT:
+        return False
+    followers += 1
+    return True
+
+
+def release_log_follower():
+    global followers
+    followers -= 1
+
+
+def log_followers() -> int:
+    """see app.persistence_async.log_followers"""
+    return followers
+
+
+if BACKEND == "memory":
+    for name in __all__:
+        setattr(persistence_async, name, globals()[name])
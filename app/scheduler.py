@@ -1,82 +1,350 @@
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException
+import asyncio
+import sqlite3
+import threading
+import traceback
+from contextlib import asynccontextmanager
+from os import environ
+from typing import Annotated, Any, List, Dict, Literal, Optional
+import redis
+from fastapi import Body, FastAPI, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
-from app.models import Job, JobCreate, redis_client
+from app import metrics, persistence, persistence_async
+from app.models import (
+    TERMINAL_STATUSES,
+    Executor,
+    GpuType,
+    Job,
+    JobCreate,
+    JobStatus,
+)
 
-app = FastAPI()
+# the biggest batch we'll take in one go, everything goes into one redis transaction
+BATCH_LIMIT = int(environ.get("JOBSERVITOR_BATCH_LIMIT", "10000"))
+# how often we look for jobs whose executor stopped renewing its lease
+REAPER_INTERVAL = float(environ.get("JOBSERVITOR_REAPER_INTERVAL", 5))
+# how often we look for jobs that ran past their timeout, which is how late a timeout can be
+SWEEPER_INTERVAL = float(environ.get("JOBSERVITOR_SWEEPER_INTERVAL", 1))
+# how often we move finished jobs out of redis, when there's a job store to move them to
+ARCHIVER_INTERVAL = float(environ.get("JOBSERVITOR_ARCHIVER_INTERVAL", 10))
+# run an executor inside the scheduler process too. that's how a single box runs without
+# redis (JOBSERVITOR_BACKEND=memory), no executor in another process could see the queues
+EMBEDDED_EXECUTOR = environ.get("JOBSERVITOR_EMBEDDED_EXECUTOR", "") not in ("", "0")
+# what the background loops shrug off and try again on the next pass: redis (or the job
+# store) going away for a bit. anything else is a bug, and they'd best not hide it
+HOUSEKEEPING_ERRORS = (redis.RedisError, sqlite3.Error, OSError)
 
 
-@app.on_event("startup")
-async def startup_event():
+def housekeeping_failed(what: str):
+    """Tell whoever reads our output one of the background loops failed a pass, and where"""
+    print(f"{what}:\n{traceback.format_exc()}", end="")
+
+
+async def reap_expired_jobs():
+    """
+    Executors hold a lease on every job they dequeue and keep renewing it while they work.
+    When one dies (or loses redis) its leases run out, and this puts those jobs back in line.
+    Dead executors get dropped from the registry on the same schedule.
+    It's a single atomic script per pass, so running a scheduler or three is fine.
+    """
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        try:
+            requeued, failed = await persistence_async.reap_expired_jobs()
+            pruned = await persistence_async.prune_executors()
+        except HOUSEKEEPING_ERRORS:
+            # the reaper going down would quietly leave jobs stranded, so keep at it
+            housekeeping_failed("Reaper could not reap")
+            continue
+        metrics.REQUEUED_JOBS.inc(len(requeued))
+        if requeued or failed:
+            print(f"♻️ Requeued {len(requeued)} jobs, gave up on {len(failed)}")
+        if pruned:
+            print(f"🪦 Executors {', '.join(pruned)} stopped sending heartbeats")
+
+
+async def sweep_overdue_jobs():
+    """
+    Jobs with a timeout sit in a deadline index while they run, so instead of every executor
+    watching the clock for every job, this looks at the front of that index once a second
+    and has the overdue ones killed. Like the reaper it's atomic, so more schedulers is fine.
+    """
+    while True:
+        await asyncio.sleep(SWEEPER_INTERVAL)
+        try:
+            timed_out = await persistence_async.time_out_overdue_jobs()
+        except HOUSEKEEPING_ERRORS:
+            housekeeping_failed("Sweeper could not sweep")
+            continue
+        if timed_out:
+            print(f"⏰ Timed out {len(timed_out)} jobs")
+
+
+async def archive_finished_jobs():
+    """
+    With a job store configured, finished jobs move out of redis (and into the store) a
+    little while after they're done, so redis only ever holds what's still in flight.
+    """
+    while True:
+        await asyncio.sleep(ARCHIVER_INTERVAL)
+        try:
+            # keep going while there's a backlog, one batch at a time
+            while await persistence_async.archive_jobs() == persistence.ARCHIVE_LIMIT:
+                pass
+        except HOUSEKEEPING_ERRORS:
+            housekeeping_failed("Archiver could not archive")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     print("🚀 App is starting up...")
-    print(f"✅ Connected to Redis {redis_client.info()["redis_version"]}")
+    # the handlers are async and share one redis connection pool, which lives as long as the app
+    await persistence_async.connect()
+    # jobs still in queues of an older layout would never be picked up
+    if moved := await asyncio.to_thread(persistence.migrate_queues):
+        print(f"🚚 Moved {moved} jobs out of queues of an older layout")
+    reaper = asyncio.create_task(reap_expired_jobs())
+    sweeper = asyncio.create_task(sweep_overdue_jobs())
+    tasks = [reaper, sweeper]
+    if persistence.job_store is not None:
+        tasks.append(asyncio.create_task(archive_finished_jobs()))
 
+    stop_executor = threading.Event()
+    if EMBEDDED_EXECUTOR:
+        # only now, no point importing it otherwise
+        from app.executor import connect_to_docker, listen_for_work, worker_config
 
-@app.on_event("shutdown")
-async def shutdown_event():
+        connect_to_docker()
+        threading.Thread(
+            target=listen_for_work,
+            kwargs={**worker_config(), "stop": stop_executor},
+            daemon=True,
+        ).start()
+    elif persistence.BACKEND == "memory":
+        print(
+            "⚠️ No redis and no embedded executor, nothing is going to run these jobs"
+        )
+    yield
     print("🛑 App is shutting down...")
-    # TODO: if i wanted to make a proper persistence layer and not redis messiness, this is where we could clean up
+    stop_executor.set()
+    for task in tasks:
+        task.cancel()
+    await persistence_async.disconnect()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/jobs")
-def submit_job(job_create: JobCreate) -> Dict:
+async def submit_job(job_create: JobCreate) -> Dict:
     """If the job fails to validate, fastapi will raise a 422 error automatically."""
     # using separated Job and JobCreate to protect housekeeping fields
     # TODO: support DC + region in job spec
     job = Job.model_validate({**job_create.model_dump()})
 
     # TODO: if persistence fails to redis what do?
-    if job.save():
-        # we saved the job to redis
-        # toss it into the queue
-        job.enqueue()
+    # saved to redis and tossed into the queue in one round trip
+    if await job.asave_and_enqueue():
         return {"id": job.id}
 
     raise HTTPException(status_code=500, detail="Failed to save job")
 
 
+@app.post("/jobs/batch")
+async def submit_jobs(job_creates: List[Dict[str, Any]]) -> List[Dict]:
+    """
+    Submit a whole list of jobs at once. Everything that validates is saved and enqueued
+    in one redis transaction, instead of two round trips per job.
+
+    One bad job doesn't sink the batch. The response lines up with the request,
+    each item is either {"id": ...} or {"error": ...} for that job.
+    """
+    if len(job_creates) > BATCH_LIMIT:
+        raise HTTPException(
+            status_code=413, detail=f"Batches are limited to {BATCH_LIMIT} jobs"
+        )
+
+    results: List[Dict] = []
+    jobs: List[Job] = []
+    for job_create in job_creates:
+        try:
+            job = Job.model_validate(
+                {**JobCreate.model_validate(job_create).model_dump()}
+            )
+        except ValidationError as e:
+            results.append(
+                {"error": e.errors(include_url=False, include_context=False)}
+            )
+            continue
+        results.append({"id": job.id})
+        jobs.append(job)
+
+    # TODO: if persistence fails to redis what do? for now tell the caller which ones didn't make it
+    saved = iter(await Job.asave_and_enqueue_all(jobs))
+    return [
+        (
+            {"error": "Failed to save job"}
+            if "id" in result and not next(saved)
+            else result
+        )
+        for result in results
+    ]
+
+
 @app.get("/jobs/{job_id}")
-def get_job(job_id) -> Job:
+async def get_job(job_id) -> Job:
     # TODO: pull the job based on the given ID from redis
     # TODO: altho using redis as a repoistory of jobs is not the best option. maybe keep just IDs in redis
     # but the rest of the job information in something more persistent like sqlite
-    return Job.load(job_id)
+    return await Job.aload(job_id)
+
+
+class FollowingResponse(StreamingResponse):
+    """
+    The response of a log follower, holding one of the follower slots. It's handed back when
+    the response is over however that happens: the log ended, the client went away, or the
+    body never even got started
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            persistence_async.release_log_follower()
+
+
+@app.get("/jobs/{job_id}/logs")
+async def get_job_logs(
+    job_id,
+    tail: Optional[int] = Query(None, ge=0),
+    follow: bool = False,
+) -> StreamingResponse:
+    """
+    Whatever the job printed so far, as plain text. tail=N for just the last N lines,
+    follow=true to keep the response open and get the rest as the job prints it. There's
+    room for LOG_FOLLOWERS_LIMIT followers at a time, past that it's a 503.
+    """
+    if await Job.aload_status(job_id) is None:
+        raise HTTPException(status_code=404, detail="No such job")
+    if not follow:
+        return StreamingResponse(
+            persistence_async.job_logs(job_id, tail=tail), media_type="text/plain"
+        )
+    # every follower holds on to a connection for as long as it follows. the slot is ours
+    # from here, the response gives it back once it's done
+    if not persistence_async.reserve_log_follower():
+        raise HTTPException(
+            status_code=503,
+            detail="Too many log followers, try again later",
+            headers={"Retry-After": "5"},
+        )
+    return FollowingResponse(
+        persistence_async.job_logs(job_id, tail=tail, follow=True),
+        media_type="text/plain",
+    )
 
 
 @app.get("/jobs")
-def list_jobs() -> List[Job]:
-    """List existing jobs in redis"""
-    # TODO: this relies on queued jobs only. are there jobs that are not queued that will be missed? like finished jobs?
-    return [Job.load(job["job_id"]) for job in Job.all()]
+async def list_jobs(
+    response: Response,
+    status: Optional[JobStatus] = None,
+    gpu_type: Optional[GpuType] = None,
+    dc: Optional[str] = None,
+    region: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+) -> List[Job]:
+    """
+    List jobs, oldest first, a page at a time. Finished jobs included.
+
+    If there's more, the cursor for the next page comes back in the X-Next-Cursor header.
+    """
+    filters = {"gpu_type": gpu_type, "dc": dc, "region": region}
+    jobs, next_cursor = await Job.alist(
+        status=status,
+        cursor=cursor,
+        limit=limit,
+        **{field: value for field, value in filters.items() if value is not None},
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return jobs
 
 
 @app.delete("/jobs/{job_id}")
-def abort_job(job_id) -> bool:
-    """Receives a job id and aborts it if the job is in pending/running status"""
-    job = Job.load(job_id)
-
-    # this is pretty improvised and just because I'm running out of my self imposted timeline
-    # but what I really should have is a way to communicate to the worker that its job has been cancelled
-    # probably via some kinda pubsub type of mechanism for the executor to listen for abort messages
-    # from the scheduler
-    if job.status in ["pending", "running"]:
-        job.status = "aborted"
-        job.save()
+async def abort_job(job_id) -> bool:
+    """
+    Receives a job id and aborts it if the job is in waiting/pending/running status.
+    A pending job comes out of its queue right away, a running one gets killed by its executor.
+    Whatever depends on it fails.
+    """
+    if await Job.aabort_all([job_id]):
         return True
-        # TODO: remove from queue
-        # but for now leave and let the executors delete it when they come across it
 
-    if job.status in ["succeeded", "failed", "aborted"]:
+    # someone else got there first (or the job was already done), see where it ended up
+    status = await Job.aload_status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No such job")
+    if status in TERMINAL_STATUSES:
         raise HTTPException(
             status_code=400, detail="Job already completed, cannot abort. sorry!"
         )
 
-    # TODO: find the job in the queue and delete it from the queue if it's pending
-    # TODO: how to communicate to executor that they need to abort the job? will simply setting the job status to aborted be sufficient for THIS project?
-
     return True
 
 
+@app.delete("/jobs")
+async def abort_jobs(
+    status: Optional[Literal["waiting", "pending", "running"]] = None,
+    image: Optional[str] = None,
+    gpu_type: Optional[GpuType] = None,
+    dc: Optional[str] = None,
+    region: Optional[str] = None,
+    job_ids: Annotated[Optional[List[str]], Body()] = None,
+) -> Dict:
+    """
+    Abort a whole lot of jobs at once: either the ids in the body, or every waiting, pending
+    or running job that matches the query (e.g. ?status=pending&image=busybox). The matching
+    happens in redis, the jobs never come back to us, so this is quick however many there are.
+
+    Jobs that were already done are skipped. Returns how many got aborted.
+    """
+    filters = {"image": image, "gpu_type": gpu_type, "dc": dc, "region": region}
+    filters = {field: value for field, value in filters.items() if value is not None}
+    if job_ids is not None:
+        if status or filters:
+            raise HTTPException(
+                status_code=400, detail="Either give job ids or filter, not both"
+            )
+        return {"aborted": len(await Job.aabort_all(job_ids))}
+
+    # nothing to go by would be everything, and that's one request away from a bad day
+    if not status and not filters:
+        raise HTTPException(
+            status_code=400, detail="Say which jobs to abort, by id or by filter"
+        )
+    return {"aborted": len(await Job.aabort_matching(status, **filters))}
+
+
+@app.get("/executors")
+async def list_executors() -> List[Executor]:
+    """Every executor that sent a heartbeat recently, with how busy it was at the time"""
+    return await Executor.alive()
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """Everything in app.metrics, in the Prometheus text format, queues as of right now"""
+    stats = await persistence_async.queue_stats()
+    metrics.QUEUE_DEPTH.clear()
+    metrics.QUEUE_OLDEST_AGE.clear()
+    for queue, depth, age in stats:
+        metrics.QUEUE_DEPTH.set(depth, queue=queue)
+        metrics.QUEUE_OLDEST_AGE.set(age, queue=queue)
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/")
 @app.get("/health")
 def health_check() -> Dict:
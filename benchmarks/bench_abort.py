@@ -0,0 +1,91 @@
+"""Cancel a big backlog of queued jobs, and see how long until executors get to real work again.
+
+Queues up --jobs jobs to cancel with one job to keep behind them. Then it cancels them in
+three ways and reports how long the cancelling took, how many jobs were still sitting in the
+queue afterwards, and how long (and how many dequeues) it took an executor to get to the
+job we kept:
+- flip: flip every job to aborted and leave it in the queue, which is what abort used to do.
+  Executors wade through the leftovers, DEQUEUE_SCAN_LIMIT of them per dequeue
+- one by one: abort every job on its own, each one comes out of the queue
+- bulk: abort them all by filter (image), the matching happens in redis
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_abort --jobs 100000
+"""
+
+import argparse
+from datetime import datetime
+from time import perf_counter
+from typing import List
+
+from app.models import Job
+from app.persistence import queue_name, queued_job_ids, redis_client
+
+BATCH_SIZE = 1000
+
+
+def fill(jobs: int) -> List[str]:
+    """Queue up jobs to cancel, and one busybox:keep job behind them. Returns the ids to cancel"""
+    backlog = [
+        Job(image="busybox:cancel", command=["true"], arguments=[]) for _ in range(jobs)
+    ]
+    for start in range(0, jobs, BATCH_SIZE):
+        Job.save_and_enqueue_all(backlog[start : start + BATCH_SIZE])
+    keep = Job(image="busybox:keep", command=["true"], arguments=[])
+    keep.save()
+    keep.enqueue()
+    return [job.id for job in backlog]
+
+
+def flip(job_ids: List[str]):
+    for job_id in job_ids:
+        Job.load(job_id).transition(
+            ["pending", "running"], status="aborted", aborted_at=datetime.now()
+        )
+
+
+def one_by_one(job_ids: List[str]):
+    for job_id in job_ids:
+        Job.abort_all([job_id])
+
+
+def bulk(job_ids: List[str]):
+    Job.abort_matching("pending", image="busybox:cancel")
+
+
+def run(name: str, cancel, jobs: int):
+    redis_client.flushdb()
+    job_ids = fill(jobs)
+
+    start = perf_counter()
+    cancel(job_ids)
+    cancel_seconds = perf_counter() - start
+    left = len(queued_job_ids(queue_name("Any", "Any", "Any")))
+
+    start = perf_counter()
+    dequeues = 1
+    while Job.dequeue("Any", 1, 1) is None:
+        dequeues += 1
+    drain_seconds = perf_counter() - start
+
+    print(
+        f"{name:>10}: cancelled {jobs / cancel_seconds:.0f} jobs/s ({cancel_seconds:.2f}s), "
+        f"{left - 1} left in the queue, "
+        f"{dequeues} dequeues and {drain_seconds:.2f}s to the next real job"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=100_000)
+    args = parser.parse_args()
+
+    run("flip", flip, args.jobs)
+    run("one by one", one_by_one, args.jobs)
+    run("bulk", bulk, args.jobs)
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Submit N copies of a job as N jobs and as one array job, and compare.
+
+For every --tasks count, submits that many jobs (in batches, like the batch endpoint does)
+and then one array job with that many tasks. Reports how long submitting took, how many
+keys and how much redis memory the backlog holds on to, and how fast executors can claim
+the tasks off it.
+An array job is one record and one queue entry however many tasks it has, a task only gets
+a record of its own once it's claimed, and (without a job store) loses it once it's done.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_arrays --tasks 1000 10000 100000
+"""
+
+import argparse
+from time import perf_counter
+from typing import Callable, Optional
+
+from app.models import Job
+from app.persistence import redis_client
+
+BATCH_SIZE = 1000
+
+
+def job(array_size: Optional[int] = None) -> Job:
+    return Job(image="busybox", command=["true"], arguments=[], array_size=array_size)
+
+
+def as_jobs(tasks: int):
+    for start in range(0, tasks, BATCH_SIZE):
+        Job.save_and_enqueue_all([job() for _ in range(min(BATCH_SIZE, tasks - start))])
+
+
+def as_array(tasks: int):
+    Job.save_and_enqueue_all([job(tasks)])
+
+
+def redis_memory() -> int:
+    return redis_client.info("memory")["used_memory"]
+
+
+def run(name: str, submit: Callable[[int], None], tasks: int, claims: int):
+    redis_client.flushdb()
+    before = redis_memory()
+    start = perf_counter()
+    submit(tasks)
+    submit_seconds = perf_counter() - start
+    held, keys = redis_memory() - before, redis_client.dbsize()
+
+    claims = min(claims, tasks)
+    start = perf_counter()
+    for _ in range(claims):
+        assert Job.dequeue("Any", 1, 1, worker="bench") is not None
+    claim_seconds = perf_counter() - start
+
+    print(
+        f"{name:>6} {tasks:>7} tasks: submitted in {submit_seconds * 1000:.1f}ms, "
+        f"{keys} keys and {held / 1024:.0f}KB of redis, "
+        f"claimed {claims / claim_seconds:.0f} tasks/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, nargs="+", default=[1000, 10_000, 100_000])
+    parser.add_argument(
+        "--claims", type=int, default=1000, help="how many tasks to claim off each"
+    )
+    args = parser.parse_args()
+
+    for tasks in args.tasks:
+        run("jobs", as_jobs, tasks, args.claims)
+        run("array", as_array, tasks, args.claims)
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
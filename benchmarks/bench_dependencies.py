@@ -0,0 +1,92 @@
+"""How long finishing a job takes when other jobs depend on it.
+
+A job succeeding releases its dependents into their queues (and a job failing fails them,
+all the way down), in the same script that marks it done. That should cost a little per
+dependent and nothing for everything else that is waiting, so this finishes a job with
+--fanout dependents once next to a few unrelated waiting jobs and once next to --waiting
+of them, and then fails the head of a --depth long chain.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_dependencies --fanout 10 100 1000 --waiting 10000
+"""
+
+import argparse
+from time import perf_counter
+from typing import List, Optional
+
+from app.models import Job
+from app.persistence import redis_client
+
+BATCH_SIZE = 1000
+
+
+def job(depends_on: Optional[List[str]] = None) -> Job:
+    return Job(image="busybox", command=["true"], arguments=[], depends_on=depends_on)
+
+
+def submit(jobs: List[Job]):
+    for start in range(0, len(jobs), BATCH_SIZE):
+        Job.save_and_enqueue_all(jobs[start : start + BATCH_SIZE])
+
+
+def started(job_id: str) -> Job:
+    """Pick the job up and run it, like an executor would"""
+    running = Job.dequeue("Any", 1, 1, worker="bench")
+    assert running.id == job_id
+    assert running.transition(["pending"], status="running")
+    return running
+
+
+def fan_out(fanout: int, waiting: int) -> float:
+    redis_client.flushdb()
+    unrelated, head = job(), job()
+    submit([unrelated, head])
+    # waiting on something that never finishes, so they just sit there
+    submit([job([unrelated.id]) for _ in range(waiting)])
+    submit([job([head.id]) for _ in range(fanout)])
+    Job.dequeue("Any", 1, 1, worker="bench")  # unrelated, out of the way
+
+    head = started(head.id)
+    start = perf_counter()
+    head.transition(["running"], status="succeeded")
+    return perf_counter() - start
+
+
+def chain(depth: int) -> float:
+    redis_client.flushdb()
+    head = job()
+    jobs = [head]
+    for _ in range(depth):
+        jobs.append(job([jobs[-1].id]))
+    submit(jobs)
+
+    head = started(head.id)
+    start = perf_counter()
+    head.transition(["running"], status="failed")
+    seconds = perf_counter() - start
+    assert Job.load_status(jobs[-1].id) == "failed"
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fanout", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--waiting", type=int, default=10_000)
+    parser.add_argument("--depth", type=int, default=1000)
+    args = parser.parse_args()
+
+    for fanout in args.fanout:
+        for waiting in (10, args.waiting):
+            seconds = fan_out(fanout, waiting)
+            print(
+                f"release {fanout:>6} dependents, {waiting:>6} others waiting: "
+                f"{seconds * 1000:.1f}ms ({seconds / fanout * 1_000_000:.0f}us/dependent)"
+            )
+    seconds = chain(args.depth)
+    print(f"fail a chain {args.depth} deep: {seconds * 1000:.1f}ms")
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Compare the lua dequeue against the old zpopmin/re-enqueue cascade.
+
+Seeds a backlog of jobs where some fraction is too big for the executor, then drains
+everything the executor can fit, once with each implementation, and reports latency
+per dequeue plus round trips and server-side redis commands per job.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_dequeue --jobs 2000 --oversized 0.5
+"""
+
+import argparse
+from statistics import median, quantiles
+from time import perf_counter
+
+from app.models import Job
+from app.persistence import (
+    QUEUE_PREFIX,
+    candidate_buckets,
+    dequeue_job,
+    enqueue_job,
+    load_job,
+    redis_client,
+    sizes_key,
+)
+
+
+def legacy_dequeue_one(queue, cpu_cores, memory_gb):
+    """The pre-lua dequeue_job, kept verbatim-ish so we have something to compare to"""
+    possible_jobs = redis_client.zpopmin(queue, count=10)
+    if not possible_jobs:
+        return None
+
+    selected_job = None
+    for queued_work in possible_jobs:
+        job = Job.from_record(load_job(queued_work[0]))
+        if (
+            selected_job is None
+            and job.memory_requested <= memory_gb
+            and job.cpu_cores_requested <= cpu_cores
+        ):
+            selected_job = job
+        else:
+            enqueue_job(job)
+
+    return selected_job
+
+
+def legacy_dequeue(gpu_type, cpu_cores, memory_gb, dc, region):
+    # it didn't know about sizes, every queue of a bucket was one to it
+    for tier in candidate_buckets(gpu_type, dc, region, memory_gb, cpu_cores):
+        for bucket in tier:
+            for size in sorted(redis_client.smembers(sizes_key(bucket))):
+                queue = f"{QUEUE_PREFIX}{bucket}:{size}"
+                job = legacy_dequeue_one(queue, cpu_cores, memory_gb)
+                if job is not None:
+                    return job
+    return None
+
+
+def lua_dequeue(gpu_type, cpu_cores, memory_gb, dc, region):
+    data = dequeue_job(gpu_type, cpu_cores, memory_gb, dc=dc, region=region)
+    return Job.from_record(data) if data else None
+
+
+class RoundTripCounter:
+    """Counts every command the client sends by wrapping execute_command"""
+
+    def __init__(self, client):
+        self.client = client
+        self.count = 0
+        self.original = client.execute_command
+
+    def __enter__(self):
+        def counting(*args, **kwargs):
+            self.count += 1
+            return self.original(*args, **kwargs)
+
+        self.client.execute_command = counting
+        return self
+
+    def __exit__(self, *exc):
+        self.client.execute_command = self.original
+
+
+def server_commands() -> int:
+    """Total commands redis has executed, including the ones called from lua"""
+    stats = redis_client.info("commandstats")
+    return sum(stat["calls"] for stat in stats.values())
+
+
+def seed(jobs: int, oversized: float, big_gb: int = 64) -> int:
+    """
+    Returns how many of the seeded jobs an executor with enough room could run.
+    The oversized ones ask for big_gb of memory
+    """
+    redis_client.flushdb()
+    runnable = 0
+    for i in range(jobs):
+        # spread the oversized jobs evenly through the backlog
+        too_big = int((i + 1) * oversized) > int(i * oversized)
+        job = Job(
+            image="busybox",
+            command=["true"],
+            arguments=[],
+            memory_requested=big_gb if too_big else 1,
+        )
+        job.save()
+        job.enqueue()
+        runnable += not too_big
+    return runnable
+
+
+def run(name, dequeue, jobs, oversized, memory_gb, big_gb=64):
+    runnable = seed(jobs, oversized, big_gb)
+    latencies = []
+    before = server_commands()
+    with RoundTripCounter(redis_client) as counter:
+        while True:
+            start = perf_counter()
+            job = dequeue("Any", 1, memory_gb, "Any", "Any")
+            latencies.append(perf_counter() - start)
+            if job is None:
+                break
+    # the INFO call itself counts as one
+    commands = server_commands() - before - 1
+    # the last dequeue is the empty one that ended the loop
+    picked = max(len(latencies) - 1, 1)
+
+    p99 = quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{name:>10}: picked {picked}/{runnable} runnable jobs, "
+        f"p50 {median(latencies) * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms, "
+        f"{counter.count / picked:.1f} round trips/job, "
+        f"{commands / picked:.1f} redis commands/job"
+    )
+
+
+def sweep(memory_gb):
+    """
+    Grow a backlog of jobs too big for us and check the cost of our dequeues stays flat.
+    Once with the big jobs in a resource bucket above ours, and once with them in our own
+    bucket (16GB jobs against a 10GB executor), where we can't skip them by bucket
+    """
+    for backlog in (0, 1_000, 10_000, 50_000):
+        jobs = backlog + 100
+        run(f"{backlog} big", lua_dequeue, jobs, backlog / jobs, memory_gb)
+    for backlog in (0, 1_000, 10_000, 50_000):
+        jobs = backlog + 100
+        run(f"{backlog} 16GB", lua_dequeue, jobs, backlog / jobs, 10, big_gb=16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument(
+        "--oversized", type=float, default=0.5, help="fraction of jobs too big to run"
+    )
+    parser.add_argument("--memory-gb", type=int, default=4)
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="measure the lua path against a growing backlog of oversized jobs",
+    )
+    args = parser.parse_args()
+
+    if args.sweep:
+        sweep(args.memory_gb)
+        redis_client.flushdb()
+        return
+
+    run("legacy", legacy_dequeue, args.jobs, args.oversized, args.memory_gb)
+    run("lua", lua_dequeue, args.jobs, args.oversized, args.memory_gb)
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Run jobs through the whole system, API to executor to finished, and report how fast.
+
+Submits a backlog of jobs to the scheduler app (in-process, lifespan and all), then lets
+a bunch of executors work through it side by side, each one looping over handle_one_job
+like a single slot executor would. Containers come from a fake docker client (see
+benchmarks.fake_docker) that "runs" every job for --run-seconds, so what's left to measure
+is our own overhead: the API, redis and the executor's bookkeeping.
+
+Runs once per shard layout and backlog size and reports, for each run:
+- submitted jobs/s through POST /jobs/batch
+- finished jobs/s, from the first executor starting to the last job finishing
+- p50/p99 queue wait, how long jobs sat in the queue before an executor picked them up
+- redis commands per job, end to end (INFO commandstats, so the ones lua runs count too)
+
+The shard layouts:
+- flat: every job goes into the same queue
+- buckets: jobs of all sizes, spread over the memory/cpu buckets
+- placement: jobs pinned to gpus, dcs and regions, with executors in every combination
+
+--output writes the results as json, hand that to --baseline on a later run to see how
+much it moved.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_e2e --executors 16 --backlog 100 1000 5000 --output e2e.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import threading
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks import fake_docker
+
+# before the executor makes its docker client, which it does the first time it needs it
+fake_client = fake_docker.install()
+
+from app.executor import handle_one_job  # noqa: E402
+from app.persistence import BACKEND, redis_client  # noqa: E402
+from app.scheduler import app, lifespan  # noqa: E402
+
+BATCH_SIZE = 500
+
+# (gpu_type, cpu_cores, memory_gb, dc, region)
+Profile = Tuple[str, int, int, str, str]
+
+# what the executors have to offer, and what the jobs ask for, in each layout
+LAYOUTS: Dict[str, Tuple[List[Profile], List[Profile]]] = {
+    "flat": (
+        [("Any", 1, 1, "Any", "Any")],
+        [("Any", 1, 1, "Any", "Any")],
+    ),
+    "buckets": (
+        [("Any", 32, 64, "Any", "Any")],
+        [
+            ("Any", cpu_cores, memory_gb, "Any", "Any")
+            for cpu_cores in (1, 4, 16)
+            for memory_gb in (1, 8, 32)
+        ],
+    ),
+    "placement": (
+        [
+            (gpu_type, 1, 1, dc, region)
+            for gpu_type in ("NVIDIA", "AMD")
+            for dc, region in (("dc-1", "region-1"), ("dc-2", "region-2"))
+        ],
+        [
+            # each of these is in the queues at least one executor looks at
+            (gpu_type, 1, 1, dc, region)
+            for gpu_type, dc, region in (
+                ("NVIDIA", "dc-1", "region-1"),
+                ("AMD", "dc-2", "region-2"),
+                ("Any", "dc-1", "region-1"),
+                ("Any", "dc-2", "Any"),
+                ("Any", "Any", "Any"),
+            )
+        ],
+    ),
+}
+
+
+def reset():
+    if BACKEND == "redis":
+        redis_client.flushdb()
+    else:
+        from app import persistence_memory
+
+        persistence_memory.reset()
+
+
+def server_commands() -> Optional[int]:
+    """Total commands redis has executed, including the ones called from lua"""
+    if BACKEND != "redis":
+        return None
+    stats = redis_client.info("commandstats")
+    return sum(stat["calls"] for stat in stats.values())
+
+
+def p50_p99(values: List[float]) -> Tuple[float, float]:
+    p99 = quantiles(values, n=100)[98] if len(values) > 1 else values[0]
+    return median(values), p99
+
+
+async def submit(client: httpx.AsyncClient, job_profiles: List[Profile], jobs: int):
+    payloads = [
+        {
+            "image": "busybox",
+            "command": ["true"],
+            "arguments": [],
+            "gpu_type": gpu_type,
+            "cpu_cores_requested": cpu_cores,
+            "memory_requested": memory_gb,
+            "dc": dc,
+            "region": region,
+        }
+        for gpu_type, cpu_cores, memory_gb, dc, region in (
+            job_profiles[i % len(job_profiles)] for i in range(jobs)
+        )
+    ]
+    for start in range(0, jobs, BATCH_SIZE):
+        response = await client.post(
+            "/jobs/batch", json=payloads[start : start + BATCH_SIZE]
+        )
+        assert response.status_code == 200
+        assert all("id" in result for result in response.json())
+
+
+def drain(
+    executor_profiles: List[Profile], executors: int, jobs: int, timeout: float
+) -> List[float]:
+    """Run executors until every job is done, returns how long each job waited in the queue"""
+    waits: List[float] = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def executor(profile: Profile):
+        while not done.is_set():
+            job = handle_one_job(*profile)
+            if job is None:
+                # nothing for us, the others may still be busy with the last few jobs
+                done.wait(0.01)
+                continue
+            with lock:
+                waits.append(job.queue_wait_seconds)
+                if len(waits) == jobs:
+                    done.set()
+
+    threads = [
+        threading.Thread(
+            target=executor,
+            args=(executor_profiles[i % len(executor_profiles)],),
+            daemon=True,
+        )
+        for i in range(executors)
+    ]
+    # the executor says so every time it comes up empty, which would drown out everything else
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        finished = done.wait(timeout)
+        done.set()
+        for thread in threads:
+            thread.join()
+    if not finished:
+        print(f"timed out with {len(waits)}/{jobs} jobs done")
+    return waits
+
+
+async def run(
+    client: httpx.AsyncClient,
+    layout: str,
+    backlog: int,
+    executors: int,
+    drain_timeout: float,
+) -> Dict:
+    executor_profiles, job_profiles = LAYOUTS[layout]
+    reset()
+    before = server_commands()
+
+    start = perf_counter()
+    await submit(client, job_profiles, backlog)
+    submit_seconds = perf_counter() - start
+
+    # the event loop keeps going meanwhile, so the scheduler's reaper and sweeper do too
+    start = perf_counter()
+    waits = await asyncio.to_thread(
+        drain, executor_profiles, executors, backlog, drain_timeout
+    )
+    drain_seconds = perf_counter() - start
+
+    after = server_commands()
+    wait_p50, wait_p99 = p50_p99(waits)
+    return {
+        "layout": layout,
+        "backlog": backlog,
+        "finished": len(waits),
+        "submitted_jobs_per_second": backlog / submit_seconds,
+        "jobs_per_second": len(waits) / drain_seconds,
+        "queue_wait_p50": wait_p50,
+        "queue_wait_p99": wait_p99,
+        # the INFO calls themselves count as one
+        "redis_commands_per_job": (
+            (after - before - 1) / backlog if before is not None else None
+        ),
+    }
+
+
+def report(result: Dict, baseline: Optional[Dict]):
+    def moved(metric: str) -> str:
+        if not baseline or not baseline.get(metric) or result[metric] is None:
+            return ""
+        return f" ({(result[metric] / baseline[metric] - 1) * 100:+.0f}%)"
+
+    commands = result["redis_commands_per_job"]
+    print(
+        f"{result['layout']:>9} {result['backlog']:>6}: "
+        f"submit {result['submitted_jobs_per_second']:.0f} jobs/s{moved('submitted_jobs_per_second')}, "
+        f"run {result['jobs_per_second']:.0f} jobs/s{moved('jobs_per_second')}, "
+        f"queue wait p50 {result['queue_wait_p50'] * 1000:.0f}ms{moved('queue_wait_p50')} "
+        f"p99 {result['queue_wait_p99'] * 1000:.0f}ms{moved('queue_wait_p99')}, "
+        + (
+            f"{commands:.1f} redis commands/job{moved('redis_commands_per_job')}"
+            if commands is not None
+            else "no redis"
+        )
+    )
+
+
+async def main_async(args) -> List[Dict]:
+    baseline = {}
+    if args.baseline:
+        previous = await asyncio.to_thread(Path(args.baseline).read_text)
+        baseline = {
+            (result["layout"], result["backlog"]): result
+            for result in json.loads(previous)["results"]
+        }
+
+    results = []
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for layout in args.layouts:
+                for backlog in args.backlog:
+                    result = await run(
+                        client, layout, backlog, args.executors, args.timeout
+                    )
+                    report(result, baseline.get((layout, backlog)))
+                    results.append(result)
+    reset()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--executors", type=int, default=16)
+    parser.add_argument("--backlog", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument(
+        "--layouts", nargs="+", choices=list(LAYOUTS), default=list(LAYOUTS)
+    )
+    parser.add_argument(
+        "--run-seconds", type=float, default=0.01, help="how long every job runs"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=300, help="give up on a run after this long"
+    )
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument(
+        "--baseline", help="compare against the results of an earlier run"
+    )
+    args = parser.parse_args()
+
+    fake_client.run_seconds = args.run_seconds
+    results = asyncio.run(main_async(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "backend": BACKEND,
+                    "executors": args.executors,
+                    "run_seconds": args.run_seconds,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
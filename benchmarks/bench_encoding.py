@@ -0,0 +1,96 @@
+"""Compare the job record versions: what a job takes up in redis and what decoding it costs.
+
+Writes the same jobs once the way we used to (every field, unset ones as empty strings)
+and once as current records (unset fields left out, with a version), and reports bytes per
+job and Job.from_record time per job for both. A fresh pending job and a finished one are
+measured separately, they have very different numbers of fields set.
+
+Bytes are what redis reports with MEMORY USAGE, and the raw field and value bytes
+when it can't.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_encoding --jobs 10000
+"""
+
+import argparse
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+from typing import Dict, List
+
+import redis
+
+from app.models import Job
+from app.persistence import PROJECT_PREFIX, load_job, redis_client
+
+
+def make_job(finished: bool) -> Job:
+    job = Job(
+        image="python:3.12",
+        command=["python"],
+        arguments=["-c", "print('Hello, World!')"],
+        memory_requested=4,
+        cpu_cores_requested=2,
+    )
+    if finished:
+        job.status = "succeeded"
+        job.started_at = job.completed_at = datetime.now()
+        job.worker = "executor-1-10.0.0.1"
+        job.exit_code = 0
+        job.queue_wait_seconds, job.pull_seconds, job.run_seconds = 0.5, 0.0, 12.3
+    return job
+
+
+def old_record(job: Job) -> Dict[str, str]:
+    return {field: value for field, value in job.to_record().items() if field != "v"}
+
+
+def record_bytes(job_id: str, record: Dict[str, str]) -> int:
+    try:
+        return redis_client.memory_usage(PROJECT_PREFIX + job_id)
+    except redis.ResponseError:
+        return sum(len(field) + len(value) for field, value in record.items())
+
+
+def measure(name: str, records: List[Dict[str, str]]):
+    sizes, latencies = [], []
+    for record in records:
+        # straight into redis, the old records have to go in as they are
+        key = PROJECT_PREFIX + record["id"]
+        redis_client.hset(key, mapping=record)
+        stored = load_job(record["id"])
+        sizes.append(record_bytes(record["id"], stored))
+
+        start = perf_counter()
+        Job.from_record(stored)
+        latencies.append(perf_counter() - start)
+    print(
+        f"{name:>18}: {median(sizes):.0f} bytes/job, "
+        f"decode {median(latencies) * 1_000_000:.1f}us/job"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=10_000)
+    args = parser.parse_args()
+
+    for finished in (False, True):
+        label = "finished" if finished else "pending"
+        jobs = [make_job(finished) for _ in range(args.jobs)]
+        redis_client.flushdb()
+        measure(f"{label} unversioned", [old_record(job) for job in jobs])
+        redis_client.flushdb()
+        measure(
+            f"{label} v2",
+            [
+                {field: value for field, value in job.to_record().items() if value}
+                for job in jobs
+            ],
+        )
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
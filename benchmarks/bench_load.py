@@ -0,0 +1,102 @@
+"""Hammer the scheduler API with concurrent clients and report requests per second.
+
+Every client loops over submit, get and list, so the numbers cover the mix the API
+actually sees. Runs once per concurrency level, which is where the async handlers and
+the pooled redis connection should show up: throughput ought to keep climbing with
+concurrency until redis or the pool (REDIS_MAX_CONNECTIONS) is the bottleneck.
+
+Runs against the app in-process by default, pass --url to hit a running scheduler.
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_load --requests 5000 --concurrency 1 10 50 200
+"""
+
+import argparse
+import asyncio
+from statistics import median, quantiles
+from time import perf_counter
+
+import httpx
+
+from app.persistence import redis_client
+from app.scheduler import app, lifespan
+
+JOB = {
+    "image": "busybox",
+    "command": ["uname"],
+    "arguments": ["-a"],
+    "memory_requested": 1,
+    "cpu_cores_requested": 1,
+}
+
+
+async def one_round(client) -> None:
+    response = await client.post("/jobs", json=JOB)
+    assert response.status_code == 200
+    job_id = response.json()["id"]
+    assert (await client.get(f"/jobs/{job_id}")).status_code == 200
+    assert (await client.get("/jobs", params={"limit": 10})).status_code == 200
+
+
+async def worker(client, rounds: int, latencies) -> None:
+    for _ in range(rounds):
+        start = perf_counter()
+        await one_round(client)
+        latencies.append(perf_counter() - start)
+
+
+async def run(client, requests: int, concurrency: int) -> None:
+    redis_client.flushdb()
+    # 3 requests per round, spread as evenly as we can over the clients
+    rounds = max(requests // 3, concurrency)
+    latencies = []
+    start = perf_counter()
+    await asyncio.gather(
+        *(
+            worker(
+                client, rounds // concurrency + (i < rounds % concurrency), latencies
+            )
+            for i in range(concurrency)
+        )
+    )
+    elapsed = perf_counter() - start
+
+    p99 = quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{concurrency:>5} clients: {rounds * 3} requests in {elapsed:.2f}s, "
+        f"{rounds * 3 / elapsed:,.0f} req/s, "
+        f"round p50 {median(latencies) * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms"
+    )
+
+
+async def bench(args) -> None:
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, limits=limits) as client:
+            for concurrency in args.concurrency:
+                await run(client, args.requests, concurrency)
+        return
+
+    # ASGITransport doesn't run the lifespan for us, so do it by hand
+    transport = httpx.ASGITransport(app=app)
+    async with lifespan(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://scheduler", limits=limits
+        ) as client:
+            for concurrency in args.concurrency:
+                await run(client, args.requests, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--url", help="scheduler to hit instead of running in-process")
+    args = parser.parse_args()
+
+    asyncio.run(bench(args))
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""How long it takes from a fresh interpreter to importing our modules and to a service being up.
+
+Imports every module in a new interpreter of its own (so nothing is cached), --runs times,
+next to an interpreter that imports nothing for a baseline. Then starts the scheduler
+(uvicorn) and an executor as they'd be started for real and times how long until the
+scheduler answers /health and the executor shows up in the executor registry.
+
+The imports don't need redis or docker, the services need both.
+
+    uv run python -m benchmarks.bench_startup --runs 10
+"""
+
+import argparse
+import subprocess
+import sys
+from os import environ
+from statistics import median
+from time import perf_counter, sleep
+from uuid import uuid4
+
+import httpx
+
+MODULES = ("app.persistence", "app.models", "app.executor", "app.scheduler")
+
+IMPORT = """
+from time import perf_counter
+start = perf_counter()
+{statement}
+print(perf_counter() - start)
+"""
+
+
+def import_seconds(module: str) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT.format(statement=f"import {module}")],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output.splitlines()[-1])
+
+
+def interpreter_seconds() -> float:
+    start = perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return perf_counter() - start
+
+
+def wait_until(ready, process: subprocess.Popen, timeout: float) -> float:
+    """Seconds from now until ready() is true, with the process still running"""
+    start = perf_counter()
+    while perf_counter() - start < timeout:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        if ready():
+            return perf_counter() - start
+        sleep(0.005)
+    raise TimeoutError(f"{process.args} didn't come up within {timeout}s")
+
+
+def scheduler_seconds(port: int, timeout: float) -> float:
+    def answers() -> bool:
+        try:
+            return httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200
+        except httpx.TransportError:
+            return False
+
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.scheduler:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until(answers, process, timeout)
+        return perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def executor_seconds(timeout: float) -> float:
+    from app.persistence import list_executors
+
+    name = f"bench-{uuid4().hex[:8]}"
+
+    def registered() -> bool:
+        return any(
+            record.get("name", "").startswith(f"{name}-") for record in list_executors()
+        )
+
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.executor"],
+        env={**environ, "EXECUTOR_NAME": name},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until(registered, process, timeout)
+        return perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def report(name: str, seconds):
+    print(
+        f"{name:>22}: median {median(seconds) * 1000:.0f}ms, "
+        f"min {min(seconds) * 1000:.0f}ms, max {max(seconds) * 1000:.0f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument(
+        "--imports-only",
+        action="store_true",
+        help="skip bringing up the services, which need redis and docker",
+    )
+    args = parser.parse_args()
+
+    report("interpreter", [interpreter_seconds() for _ in range(args.runs)])
+    for module in MODULES:
+        report(f"import {module}", [import_seconds(module) for _ in range(args.runs)])
+    if args.imports_only:
+        return
+
+    report(
+        "scheduler up",
+        [scheduler_seconds(args.port, args.timeout) for _ in range(args.runs)],
+    )
+    report(
+        "executor registered",
+        [executor_seconds(args.timeout) for _ in range(args.runs)],
+    )
+
+
+if __name__ == "__main__":
+    main()
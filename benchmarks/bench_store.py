@@ -0,0 +1,110 @@
+"""Compare keeping finished jobs in redis against archiving them into the sqlite job store.
+
+Seeds a history of finished jobs, then loads jobs by id and walks the listing (all jobs
+and one status) page by page, once with everything in redis and once with the jobs
+archived into sqlite. Reports how long archiving took, latency per load and per page,
+and how much memory redis is holding on to in each case.
+
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_store --jobs 20000 --page 100
+"""
+
+import argparse
+import random
+import tempfile
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+
+from app import persistence
+from app.job_store import SqliteJobStore
+from app.models import Job
+from app.persistence import archive_jobs, list_jobs, load_job, redis_client
+
+
+def seed(jobs: int) -> list:
+    redis_client.flushdb()
+    created = []
+    for i in range(jobs):
+        job = Job(
+            image="busybox",
+            command=["true"],
+            arguments=[],
+            status="succeeded" if i % 4 else "failed",
+        )
+        job.save()
+        created.append(job.id)
+    return created
+
+
+def redis_memory() -> int:
+    return redis_client.info("memory")["used_memory"]
+
+
+def p50_p99(latencies) -> str:
+    p99 = quantiles(latencies, n=100)[98] if len(latencies) > 1 else latencies[0]
+    return f"p50 {median(latencies) * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms"
+
+
+def measure(name: str, job_ids: list, loads: int, page: int):
+    latencies = []
+    for job_id in random.sample(job_ids, min(loads, len(job_ids))):
+        start = perf_counter()
+        assert load_job(job_id) is not None
+        latencies.append(perf_counter() - start)
+    print(f"{name:>7}: load by id {p50_p99(latencies)}")
+
+    for status in (None, "failed"):
+        latencies, seen, cursor = [], 0, None
+        while True:
+            start = perf_counter()
+            jobs, cursor = list_jobs(status=status, cursor=cursor, limit=page)
+            latencies.append(perf_counter() - start)
+            seen += len(jobs)
+            if cursor is None:
+                break
+        print(
+            f"{name:>7}: list {status or 'all'} ({seen} jobs in {len(latencies)} pages) "
+            f"{p50_p99(latencies)}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20_000)
+    parser.add_argument("--loads", type=int, default=2000)
+    parser.add_argument("--page", type=int, default=100)
+    args = parser.parse_args()
+
+    baseline = redis_memory()
+    job_ids = seed(args.jobs)
+    print(f"  redis: {(redis_memory() - baseline) / 2**20:.1f}MB for {args.jobs} jobs")
+    measure("redis", job_ids, args.loads, args.page)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / "jobs.db"
+        persistence.job_store = SqliteJobStore(str(path))
+        # nothing is queued for archiving yet, seeding went around the transitions
+        now, _ = redis_client.time()
+        redis_client.zadd(persistence.ARCHIVE_KEY, {job_id: now for job_id in job_ids})
+
+        start = perf_counter()
+        while archive_jobs(delay=0):
+            pass
+        took = perf_counter() - start
+        print(
+            f" sqlite: archived {args.jobs} jobs in {took:.2f}s "
+            f"({args.jobs / took:.0f} jobs/s), redis down to "
+            f"{(redis_memory() - baseline) / 2**20:.1f}MB, "
+            # WAL mode, most of it is still in the -wal file at this point
+            f"database {sum(f.stat().st_size for f in path.parent.iterdir()) / 2**20:.1f}MB"
+        )
+        measure("sqlite", job_ids, args.loads, args.page)
+        persistence.job_store = None
+
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
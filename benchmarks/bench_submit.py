@@ -0,0 +1,69 @@
+"""Measure job submission throughput, in jobs per second.
+
+Submits the same number of jobs one POST /jobs at a time, and then through
+POST /jobs/batch in batches of a few sizes.
+
+Runs against the app in-process by default, pass --url to hit a running scheduler.
+THIS FLUSHES THE REDIS DB POINTED TO BY REDIS_URI.
+
+    uv run python -m benchmarks.bench_submit --jobs 5000
+"""
+
+import argparse
+from time import perf_counter
+
+import httpx
+from fastapi.testclient import TestClient
+
+from app.persistence import redis_client
+from app.scheduler import app
+
+JOB = {
+    "image": "busybox",
+    "command": ["uname"],
+    "arguments": ["-a"],
+    "memory_requested": 1,
+    "cpu_cores_requested": 1,
+}
+
+
+def single(client, jobs):
+    for _ in range(jobs):
+        assert client.post("/jobs", json=JOB).status_code == 200
+
+
+def batched(batch_size):
+    def submit(client, jobs):
+        for start in range(0, jobs, batch_size):
+            batch = [JOB] * min(batch_size, jobs - start)
+            response = client.post("/jobs/batch", json=batch)
+            assert response.status_code == 200
+            assert all("id" in result for result in response.json())
+
+    return submit
+
+
+def run(name, submit, client, jobs):
+    redis_client.flushdb()
+    start = perf_counter()
+    submit(client, jobs)
+    elapsed = perf_counter() - start
+    print(f"{name:>12}: {jobs} jobs in {elapsed:.2f}s, {jobs / elapsed:,.0f} jobs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--url", help="scheduler to hit instead of running in-process")
+    args = parser.parse_args()
+
+    # entering the TestClient runs the app's lifespan, which is what connects it to redis
+    with httpx.Client(base_url=args.url) if args.url else TestClient(app) as client:
+        run("single", single, client, args.jobs)
+        for batch_size in (10, 100, 1000):
+            run(f"batch {batch_size}", batched(batch_size), client, args.jobs)
+    redis_client.flushdb()
+
+
+if __name__ == "__main__":
+    main()
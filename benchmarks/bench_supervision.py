@@ -0,0 +1,107 @@
+"""Compare watching containers through the docker events stream against polling them.
+
+Starts a bunch of containers that sleep for a bit, side by side, and waits for all of
+them to exit, once by polling container.reload() like the executor used to and once
+through the ContainerSupervisor. Reports the CPU time the process burnt and the number
+of docker API requests it made, per container.
+
+Needs a docker daemon, and redis (importing the executor connects to it).
+
+    uv run python -m benchmarks.bench_supervision --containers 20 --seconds 5
+"""
+
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, process_time, sleep
+from uuid import uuid4
+
+from app.executor import (
+    EXECUTOR_LABEL,
+    JOB_LABEL,
+    client,
+    container_supervisor,
+    executor_name,
+)
+
+POLL_INTERVAL = 0.1
+
+
+class RequestCounter:
+    """Counts every HTTP request the docker client makes, with a requests response hook"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, response, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        client.api.hooks["response"].append(self)
+        return self
+
+    def __exit__(self, *exc):
+        client.api.hooks["response"].remove(self)
+
+
+def start(job_id, image, seconds):
+    return client.containers.run(
+        image=image,
+        command=f"sleep {seconds}",
+        detach=True,
+        labels={EXECUTOR_LABEL: executor_name, JOB_LABEL: job_id},
+    )
+
+
+def polled(image, seconds):
+    """The pre-supervisor loop, more or less"""
+    container = start(str(uuid4()), image, seconds)
+    while container.status != "exited":
+        sleep(POLL_INTERVAL)
+        container.reload()
+    container.remove()
+
+
+def supervised(image, seconds):
+    job_id = str(uuid4())
+    wakeup = threading.Event()
+    container_exit = container_supervisor.watch(job_id, wakeup)
+    container = start(job_id, image, seconds)
+    wakeup.wait()
+    assert container_exit.exited
+    container_supervisor.unwatch(job_id)
+    container.remove()
+
+
+def run(name, supervise, containers, image, seconds):
+    with RequestCounter() as requests:
+        cpu, wall = process_time(), perf_counter()
+        with ThreadPoolExecutor(max_workers=containers) as pool:
+            for _ in range(containers):
+                pool.submit(supervise, image, seconds)
+        cpu, wall = process_time() - cpu, perf_counter() - wall
+
+    print(
+        f"{name:>10}: {containers} containers in {wall:.1f}s, "
+        f"{cpu * 1000 / containers:.1f}ms cpu/container, "
+        f"{requests.count / containers:.1f} docker requests/container"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--containers", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--image", default="busybox")
+    args = parser.parse_args()
+
+    client.images.pull(args.image)
+    # the events stream is one request for the whole process, not per container
+    container_supervisor.start()
+
+    run("polling", polled, args.containers, args.image, args.seconds)
+    run("events", supervised, args.containers, args.image, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
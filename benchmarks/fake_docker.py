@@ -0,0 +1,156 @@
+"""A docker client that doesn't need docker, for benchmarking the rest of the system.
+
+Containers don't run anything, they just exit (with 0) after run_seconds, and tell
+whoever follows the events stream about it like docker would. Pulls take pull_seconds.
+Just enough of the docker SDK for app.executor, nothing more.
+
+install() has to be called before the executor first talks to docker, that's when it
+makes its client (see app.executor.LazyDockerClient).
+"""
+
+import queue
+import threading
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+
+import docker
+import docker.errors
+
+
+class FakeContainer:
+    def __init__(self, client: "FakeDocker", image: str, labels: Dict[str, str]):
+        self.client = client
+        self.id = f"fake-{next(client.ids)}"
+        self.image = image
+        self.labels = labels
+        self.status = "running"
+        self.attrs = {"State": {"OOMKilled": False, "ExitCode": 0}}
+        self.exited = threading.Event()
+        self.lock = threading.Lock()
+        timer = threading.Timer(client.run_seconds, self.die, args=(0,))
+        timer.daemon = True
+        timer.start()
+
+    def die(self, exit_code: int) -> bool:
+        with self.lock:
+            if self.exited.is_set():
+                return False
+            self.status = "exited"
+            self.attrs["State"]["ExitCode"] = exit_code
+            self.exited.set()
+        self.client.emit(
+            {
+                "Type": "container",
+                "Action": "die",
+                "Actor": {
+                    "ID": self.id,
+                    "Attributes": {**self.labels, "exitCode": str(exit_code)},
+                },
+            }
+        )
+        return True
+
+    def reload(self):
+        pass
+
+    def kill(self):
+        if not self.die(137):
+            raise docker.errors.APIError(f"Container {self.id} is not running")
+
+    def logs(self, stream: bool = False, follow: bool = False):
+        line = f"hello from {self.id}\n".encode()
+        if not stream:
+            return line
+
+        def lines():
+            yield line
+            if follow:
+                self.exited.wait()
+
+        return lines()
+
+    def remove(self, **kwargs):
+        pass
+
+
+class FakeContainers:
+    def __init__(self, client: "FakeDocker"):
+        self.client = client
+
+    def run(self, image: str, command: str, labels=None, **kwargs) -> FakeContainer:
+        return FakeContainer(self.client, image, labels or {})
+
+
+class FakeImage:
+    def __init__(self, name: str):
+        self.id = name
+        self.tags = [name]
+        self.attrs = {"Size": 100 * 2**20}
+
+
+class FakeImages:
+    def __init__(self, client: "FakeDocker"):
+        self.client = client
+        self.pulled = set()
+
+    def get(self, name: str) -> FakeImage:
+        if name not in self.pulled:
+            raise docker.errors.ImageNotFound(name)
+        return FakeImage(name)
+
+    def pull(self, name: str, **kwargs) -> FakeImage:
+        threading.Event().wait(self.client.pull_seconds)
+        self.pulled.add(name)
+        return FakeImage(name)
+
+    def remove(self, name: str, **kwargs):
+        self.pulled.discard(name)
+
+
+class FakeApi:
+    def __init__(self):
+        self.hooks = {"response": []}
+
+
+class FakeDocker:
+    def __init__(self, run_seconds: float = 0.01, pull_seconds: float = 0):
+        self.run_seconds = run_seconds
+        self.pull_seconds = pull_seconds
+        self.ids = count()
+        self.containers = FakeContainers(self)
+        self.images = FakeImages(self)
+        self.api = FakeApi()
+        # everyone following the events stream, with the labels they filter on
+        self.followers: List[Tuple[queue.Queue, List[str]]] = []
+
+    def info(self) -> Dict:
+        return {"ServerVersion": "fake"}
+
+    def ping(self) -> bool:
+        return True
+
+    def emit(self, event: Dict):
+        attributes = event["Actor"]["Attributes"]
+        for events, labels in list(self.followers):
+            if all(
+                attributes.get(key) == value
+                for key, value in (label.split("=", 1) for label in labels)
+            ):
+                events.put(event)
+
+    def events(self, filters: Optional[Dict] = None, **kwargs):
+        events: queue.Queue = queue.Queue()
+        self.followers.append((events, (filters or {}).get("label", [])))
+
+        def stream():
+            while True:
+                yield events.get()
+
+        return stream()
+
+
+def install(run_seconds: float = 0.01, pull_seconds: float = 0) -> FakeDocker:
+    """Make docker.from_env() hand out a FakeDocker, which is returned"""
+    client = FakeDocker(run_seconds, pull_seconds)
+    docker.from_env = lambda *args, **kwargs: client
+    return client
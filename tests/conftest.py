@@ -1,10 +1,16 @@
 import pytest
 
+from app import persistence_memory
 from app.persistence import redis_client
 
 
 @pytest.fixture(autouse=True)
 def run_around_tests():
-    redis_client.flushdb()  # Clear the Redis database before each test, in case I randomly killed it
+    # no redis_client with JOBSERVITOR_BACKEND=memory, the in-process state gets wiped either way
+    if redis_client is not None:
+        redis_client.flushdb()  # Clear the Redis database before each test, in case I randomly killed it
+    persistence_memory.reset()
     yield
-    redis_client.flushdb()  # Clear the Redis database after each test, because I will probably randomly kill it
+    if redis_client is not None:
+        redis_client.flushdb()  # Clear the Redis database after each test, because I will probably randomly kill it
+    persistence_memory.reset()
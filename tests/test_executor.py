@@ -1,18 +1,82 @@
-from unittest.mock import patch
+import docker
+import pytest
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from unittest.mock import MagicMock, patch
 
 from fastapi.testclient import TestClient
 import threading
 
 # TODO: clean up these adhoc imports
-from app.executor import handle_one_job, start_worker
+from app.executor import (
+    JOB_LABEL,
+    ImageCache,
+    ResourceLedger,
+    client as docker_client,
+    execute_job,
+    executor_name,
+    handle_one_job,
+    listen_for_work,
+    report_crash,
+    start_worker,
+)
 from app.scheduler import app
-from app.models import Job, redis_client
-from app.persistence import queue_name
+from app.models import Executor, Job, redis_client
+from app import persistence, persistence_memory
+from app.persistence import (
+    ALL_JOBS_INDEX,
+    BACKEND,
+    DEADLINE_INDEX,
+    EXECUTOR_REGISTRY,
+    FLEET_KEY,
+    INFLIGHT_KEY,
+    MAX_RETRIES,
+    PRIORITY_SECONDS,
+    PROJECT_PREFIX,
+    QUEUES_KEY,
+    heartbeat,
+    prune_executors,
+    queue_bucket,
+    queue_name,
+    queued_job_ids,
+    reap_expired_jobs,
+    renew_leases,
+    sizes_key,
+    time_out_overdue_jobs,
+    upcoming_images,
+    wait_for_work,
+)
 
-from time import sleep
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+from typing import Any, Callable
 
 client = TestClient(app)
 
+# these look at (or poke) the redis side of things directly
+redis_only = pytest.mark.skipif(BACKEND != "redis", reason="looks inside redis")
+
+
+def wait_for(condition: Callable[[], Any], timeout: float = 10) -> Any:
+    """
+    Poll condition until it comes back truthy or timeout seconds go by, and hand back what it
+    returned last so the caller can assert on it
+    """
+    deadline = perf_counter() + timeout
+    while not (result := condition()) and perf_counter() < deadline:
+        sleep(0.1)
+    return result
+
+
+@pytest.fixture(scope="module", autouse=True)
+def lifespan():
+    # runs the app's lifespan (and so the async redis pool) around every test in here
+    with client:
+        yield
+
 
 def test_no_job_found():
     assert (
@@ -36,9 +100,7 @@ def test_job_found():
     assert response.status_code == 200
 
     # queue should have a job
-    assert redis_client.zrange(queue_name("NVIDIA", "Any", "Any"), 0, -1) == [
-        response.json()["id"]
-    ]
+    assert queued_job_ids(queue_name("NVIDIA", "Any", "Any")) == [response.json()["id"]]
 
     assert (
         handle_one_job(
@@ -49,9 +111,7 @@ def test_job_found():
 
     # queue should be empty now
     assert (
-        redis_client.zrange(
-            queue_name(gpu_type="NVIDIA", dc="us-east-1", region="az1"), 0, -1
-        )
+        queued_job_ids(queue_name(gpu_type="NVIDIA", dc="us-east-1", region="az1"))
         == []
     )
 
@@ -69,9 +129,7 @@ def test_executor_ignores_architecture_that_doesnt_belong_to_it():
     assert response.status_code == 200
 
     # queue should have a job
-    assert redis_client.zrange(queue_name("NVIDIA", "Any", "Any"), 0, -1) == [
-        response.json()["id"]
-    ]
+    assert queued_job_ids(queue_name("NVIDIA", "Any", "Any")) == [response.json()["id"]]
 
     assert (
         handle_one_job(
@@ -81,9 +139,9 @@ def test_executor_ignores_architecture_that_doesnt_belong_to_it():
     )
 
     # queue should still have the job
-    assert redis_client.zrange(
-        queue_name(gpu_type="NVIDIA", dc="Any", region="Any"), 0, -1
-    ) == [response.json()["id"]]
+    assert queued_job_ids(queue_name(gpu_type="NVIDIA", dc="Any", region="Any")) == [
+        response.json()["id"]
+    ]
 
 
 def test_executor_checks_the_any_queue_after_checking_its_own_arch():
@@ -98,9 +156,7 @@ def test_executor_checks_the_any_queue_after_checking_its_own_arch():
     assert response.status_code == 200
 
     # this job went to the Any queue
-    assert redis_client.zrange(queue_name("Any", "Any", "Any"), 0, -1) == [
-        response.json()["id"]
-    ]
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [response.json()["id"]]
 
     assert (
         handle_one_job(
@@ -110,7 +166,7 @@ def test_executor_checks_the_any_queue_after_checking_its_own_arch():
     )
 
     # queue should be empty
-    assert redis_client.zrange(queue_name("Any", "Any", "Any"), 0, -1) == []
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == []
 
 
 def test_executor_completes_a_job_and_correctly_updates_it():
@@ -141,10 +197,7 @@ def test_executor_completes_a_job_and_correctly_updates_it():
 
     # queue should be empty
     assert (
-        redis_client.zrange(
-            queue_name(gpu_type="AMD", dc="us-east-1", region="az1"), 0, -1
-        )
-        == []
+        queued_job_ids(queue_name(gpu_type="AMD", dc="us-east-1", region="az1")) == []
     )
 
 
@@ -237,6 +290,355 @@ def test_executor_finds_the_one_job_it_can_run():
     assert complete_job.image == "busybox:1.37"
 
 
+@redis_only
+def test_jobs_that_dont_fit_keep_their_place_in_the_queue():
+    # 12GB and 8GB jobs land in the same memory bucket, each size in a queue of its own
+    job_data = {
+        "image": "busybox:1.36",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 12,
+        "cpu_cores_requested": 1,
+    }
+    big_ids = [client.post("/jobs", json=job_data).json()["id"] for _ in range(3)]
+    queue = queue_name("Any", "Any", "Any", memory_gb=12)
+    before = redis_client.zrange(queue, 0, -1, withscores=True)
+
+    job_data["memory_requested"] = 8
+    small_id = client.post("/jobs", json=job_data).json()["id"]
+    bucket, _ = queue_bucket(queue)
+    assert redis_client.smembers(sizes_key(bucket)) == {"12x1", "8x1"}
+
+    # we skip over the big jobs without popping them
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=10).id == small_id
+    assert redis_client.zrange(queue, 0, -1, withscores=True) == before
+    assert [job_id for job_id, _ in before] == big_ids
+
+    # and nothing else fits
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=10) is None
+
+
+def test_jobs_that_dont_fit_dont_hold_up_the_ones_behind_them(monkeypatch):
+    monkeypatch.setattr(persistence, "DEQUEUE_SCAN_LIMIT", 5)
+    # 16GB and 6GB jobs land in the same memory bucket, and more of the big ones than
+    # the dequeue would look at in one go were there first
+    job_data = {
+        "image": "busybox:1.36",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 16,
+    }
+    big = client.post("/jobs/batch", json=[job_data] * 12).json()
+    small_id = client.post("/jobs", json={**job_data, "memory_requested": 6}).json()[
+        "id"
+    ]
+    queue = queue_name("Any", "Any", "Any", memory_gb=16)
+
+    assert Job.dequeue("Any", cpu_cores=4, memory_gb=10).id == small_id
+    assert queued_job_ids(queue) == [job["id"] for job in big]
+    assert Job.dequeue("Any", cpu_cores=4, memory_gb=10) is None
+
+
+@redis_only
+def test_dequeue_looks_at_a_bounded_number_of_entries(monkeypatch):
+    monkeypatch.setattr(persistence, "DEQUEUE_SCAN_LIMIT", 5)
+    job_data = {"image": "busybox:1.36", "command": ["uname"], "arguments": ["-a"]}
+    stale = [
+        job["id"] for job in client.post("/jobs/batch", json=[job_data] * 12).json()
+    ]
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    queue = queue_name("Any", "Any", "Any")
+    # entries whose jobs went somewhere else behind the queue's back
+    for stale_id in stale:
+        redis_client.hset(PROJECT_PREFIX + stale_id, "status", "succeeded")
+
+    # every dequeue clears out a few of them and stops there
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1) is None
+    assert redis_client.zcard(queue) == 8
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1) is None
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1).id == job_id
+
+    # and once the queue is empty its size is gone from the bucket, and it's gone from
+    # the queues the metrics look at
+    assert redis_client.sismember(QUEUES_KEY, queue)
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1) is None
+    assert redis_client.smembers(sizes_key(queue_bucket(queue)[0])) == set()
+    assert not redis_client.sismember(QUEUES_KEY, queue)
+
+
+@redis_only
+def test_jobs_left_in_queues_of_an_older_layout_get_moved():
+    # the way the first version of the scheduler left things: the whole job as a json
+    # string, in one queue per dc/region/gpu
+    def baseline_job(status: str, submitted_at: datetime) -> str:
+        job = Job(
+            image="busybox:1.37",
+            command=["uname"],
+            arguments=["-a"],
+            status=status,
+            submitted_at=submitted_at,
+        )
+        redis_client.set(
+            PROJECT_PREFIX + job.id,
+            job.model_dump_json(
+                include={
+                    *("image", "command", "arguments", "gpu_type", "memory_requested"),
+                    *("cpu_cores_requested", "region", "dc", "id", "status"),
+                    *("submitted_at", "aborted_at", "completed_at", "started_at"),
+                    "worker",
+                }
+            ),
+        )
+        redis_client.zadd(
+            "jobservitor:queue:Any:Any:Any", {job.id: submitted_at.timestamp()}
+        )
+        return job.id
+
+    an_hour_ago = datetime.now() - timedelta(hours=1)
+    waiting = baseline_job("pending", an_hour_ago)
+    done = baseline_job("succeeded", an_hour_ago + timedelta(minutes=1))
+    # and something submitted since, in the queues of today
+    newer_id = client.post(
+        "/jobs",
+        json={"image": "busybox:1.37", "command": ["uname"], "arguments": ["-a"]},
+    ).json()["id"]
+
+    assert persistence.migrate_queues() == 1
+    assert not redis_client.exists("jobservitor:queue:Any:Any:Any")
+    assert redis_client.type(PROJECT_PREFIX + waiting) == "hash"
+    # the finished one is left as it was, it just isn't in line anymore
+    assert redis_client.type(PROJECT_PREFIX + done) == "string"
+    assert Job.load_status(done) == "succeeded"
+
+    # the old job is still first in line
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [waiting, newer_id]
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1).id == waiting
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1).id == newer_id
+
+    # and it's done once and for all
+    baseline_job("pending", an_hour_ago)
+    assert persistence.migrate_queues() == 0
+
+
+@redis_only
+def test_dequeue_steps_over_json_records():
+    job_id = client.post(
+        "/jobs",
+        json={"image": "busybox:1.37", "command": ["uname"], "arguments": ["-a"]},
+    ).json()["id"]
+    # a json record in one of today's queues, in front of the job
+    redis_client.set(PROJECT_PREFIX + "json-job", "{}")
+    redis_client.zadd(queue_name("Any", "Any", "Any"), {"json-job": 0})
+
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=1).id == job_id
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == ["json-job"]
+
+
+def test_jobs_are_sharded_by_resource_bucket():
+    job_data = {
+        "image": "busybox:1.36",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 64,
+        "cpu_cores_requested": 1,
+    }
+    big_id = client.post("/jobs", json=job_data).json()["id"]
+    job_data["memory_requested"] = 1
+    small_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert queued_job_ids(queue_name("Any", "Any", "Any", memory_gb=64)) == [big_id]
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [small_id]
+
+    # a small executor only ever looks at the small bucket
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=4).id == small_id
+    assert Job.dequeue("Any", cpu_cores=1, memory_gb=4) is None
+
+
+def test_executor_takes_the_oldest_job_across_buckets():
+    job_data = {
+        "image": "busybox:1.36",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 32,
+        "cpu_cores_requested": 16,
+    }
+    first_id = client.post("/jobs", json=job_data).json()["id"]
+    job_data["memory_requested"] = 1
+    job_data["cpu_cores_requested"] = 1
+    second_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert Job.dequeue("Any", cpu_cores=64, memory_gb=256).id == first_id
+    assert Job.dequeue("Any", cpu_cores=64, memory_gb=256).id == second_id
+
+
+def test_higher_priority_jobs_go_first():
+    job_data = {
+        "image": "busybox:1.36",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "dc": "priority-dc",
+        "priority": -1,
+    }
+    low_id = client.post("/jobs", json=job_data).json()["id"]
+    job_data["priority"] = 5
+    high_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert Job.dequeue("Any", 1, 1, dc="priority-dc").id == high_id
+    assert Job.dequeue("Any", 1, 1, dc="priority-dc").id == low_id
+
+
+def test_low_priority_jobs_catch_up_as_they_wait():
+    # waited longer than its lack of priority costs it
+    old = Job(
+        image="busybox:1.36",
+        command=["uname"],
+        arguments=[],
+        dc="aging-dc",
+        submitted_at=datetime.now() - timedelta(seconds=2 * PRIORITY_SECONDS),
+    )
+    old.save()
+    old.enqueue()
+    fresh_id = client.post(
+        "/jobs",
+        json={
+            "image": "busybox:1.36",
+            "command": ["uname"],
+            "arguments": [],
+            "dc": "aging-dc",
+            "priority": 1,
+        },
+    ).json()["id"]
+
+    assert Job.dequeue("Any", 1, 1, dc="aging-dc").id == old.id
+    assert Job.dequeue("Any", 1, 1, dc="aging-dc").id == fresh_id
+
+
+def test_priority_is_bounded():
+    job_data = {"image": "busybox", "command": ["true"], "arguments": []}
+    assert client.post("/jobs", json={**job_data, "priority": 1000}).status_code == 422
+
+
+def test_job_records_where_its_time_went():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    first_id = client.post("/jobs", json=job_data).json()["id"]
+    second_id = client.post("/jobs", json=job_data).json()["id"]
+
+    first = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert first.id == first_id
+    assert first.queue_wait_seconds >= 0
+    assert first.pull_seconds >= 0
+    assert first.run_seconds > 0
+
+    # same image, nothing to pull this time
+    second = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert second.id == second_id
+    assert second.pull_seconds == 0
+    assert Job.load(second_id).run_seconds == second.run_seconds
+
+
+def test_upcoming_images_come_off_the_front_of_our_queues():
+    for image in ("busybox:1.37", "alpine:3", "busybox:1.37"):
+        client.post(
+            "/jobs", json={"image": image, "command": ["true"], "arguments": []}
+        )
+    # not in a queue we take work from
+    client.post(
+        "/jobs",
+        json={
+            "image": "nvidia",
+            "command": ["true"],
+            "arguments": [],
+            "gpu_type": "NVIDIA",
+        },
+    )
+
+    assert upcoming_images("AMD", 1, 1) == ["busybox:1.37", "alpine:3"]
+    assert upcoming_images("AMD", 1, 1, depth=1) == ["busybox:1.37"]
+
+
+def test_image_cache_drops_the_least_recently_used_images():
+    sizes = {"small": 1, "medium": 2, "large": 3}
+    # in place of the client itself, not its images: getting at those through the lazy
+    # client would go and make a real one, which needs a docker daemon
+    images = patch.object(docker_client, "client", MagicMock()).start().images
+    try:
+        images.get.side_effect = lambda name: type(
+            "Image", (), {"attrs": {"Size": sizes[name] * 1024**3}}
+        )
+        cache = ImageCache(budget_gb=5)
+
+        cache.fetch("small")
+        cache.fetch("medium")
+        # in use by a job, so it stays no matter how long ago it was used
+        cache.acquire("small")
+        cache.fetch("large")
+        assert list(cache.images) == ["small", "large"]
+        images.remove.assert_called_once_with("medium")
+
+        cache.release("small")
+        cache.fetch("medium")
+        assert list(cache.images) == ["large", "medium"]
+    finally:
+        patch.stopall()
+
+
+def test_image_cache_keeps_counting_images_docker_would_not_remove():
+    sizes = {"small": 1, "large": 5}
+    images = patch.object(docker_client, "client", MagicMock()).start().images
+    try:
+        images.get.side_effect = lambda name: type(
+            "Image", (), {"attrs": {"Size": sizes[name] * 1024**3}}
+        )
+        # what docker says while a stopped container still uses the image
+        images.remove.side_effect = docker.errors.APIError(
+            "409 image is being used by stopped container"
+        )
+        cache = ImageCache(budget_gb=5)
+
+        cache.fetch("small")
+        cache.fetch("large")
+        # still on the disk, so still in the books
+        assert list(cache.images) == ["small", "large"]
+
+        images.remove.side_effect = None
+        cache.evict()
+        assert list(cache.images) == ["large"]
+    finally:
+        patch.stopall()
+
+
+def test_jobs_that_crash_in_the_worker_pool_get_reported(capsys):
+    def crash():
+        raise RuntimeError("docker said something we didn't expect")
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(crash).add_done_callback(partial(report_crash, "job-1"))
+        pool.submit(lambda: None).add_done_callback(partial(report_crash, "job-2"))
+
+    output = capsys.readouterr().out
+    assert "Running job job-1 crashed" in output
+    assert "RuntimeError: docker said something we didn't expect" in output
+    assert "job-2" not in output
+
+
+def test_finished_containers_are_removed():
+    job_data = {"image": "busybox:1.37", "command": ["uname"], "arguments": ["-a"]}
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert handle_one_job("Any", 1, 1, "Any", "Any").status == "succeeded"
+    # a stopped container left behind would pin its image, see ImageCache.evict
+    assert (
+        docker_client.containers.list(
+            all=True, filters={"label": f"{JOB_LABEL}={job_id}"}
+        )
+        == []
+    )
+
+
 def test_executor_respects_the_exit_code_of_the_job():
     # this job will succeed
     job_data = {
@@ -281,6 +683,30 @@ def test_executor_respects_the_exit_code_of_the_job():
     assert complete_job.status == "failed"
 
 
+def test_array_job_tasks_know_which_one_they_are():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["sh"],
+        "arguments": ["-c", "'exit $JOB_ARRAY_INDEX'"],
+        "array_size": 2,
+    }
+    array_id = client.post("/jobs", json=job_data).json()["id"]
+
+    first = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert (first.id, first.array_index, first.status) == (
+        f"{array_id}_0",
+        0,
+        "succeeded",
+    )
+    assert Job.load_status(array_id) == "running"
+
+    second = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert (second.array_index, second.exit_code, second.status) == (1, 1, "failed")
+    array = Job.load(array_id)
+    assert (array.status, array.tasks_succeeded, array.tasks_failed) == ("failed", 1, 1)
+    assert handle_one_job("Any", 1, 1, "Any", "Any") is None
+
+
 def test_long_running_job_status():
     job_data = {
         "image": "busybox:1.37",
@@ -304,6 +730,156 @@ def test_long_running_job_status():
     assert Job.load(response.json()["id"]).status == "succeeded"
 
 
+def test_executor_only_updates_jobs_it_holds():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    # say our lease ran out and the reaper handed the job to someone else
+    job = Job.dequeue("Any", 1, 1, worker="executor-other")
+
+    assert execute_job(job) is None
+    assert Job.load_status(job_id) == "pending"
+    assert not job.transition(
+        ["pending"], expected_worker=executor_name, status="failed"
+    )
+    assert job.transition(
+        ["pending"], expected_worker="executor-other", status="running"
+    )
+    assert Job.load(job_id).worker == "executor-other"
+
+
+def test_abort_is_pushed_to_the_executor():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["sleep"],
+        "arguments": ["30"],
+        "memory_requested": 1,
+        "cpu_cores_requested": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    temp_thread = threading.Thread(
+        target=handle_one_job, args=("Any", 1, 1, "Any", "Any")
+    )
+    temp_thread.start()
+    assert wait_for(lambda: Job.load_status(job_id) == "running")
+
+    # no job status polling while the container runs
+    with patch("app.executor.Job.load_status") as mock_load_status:
+        assert client.delete(f"/jobs/{job_id}").status_code == 200
+        temp_thread.join(timeout=10)
+    assert not temp_thread.is_alive()
+    mock_load_status.assert_not_called()
+
+    job = Job.load(job_id)
+    assert job.status == "aborted"
+    # abort to kill should be near instant, not the 30 seconds the job wanted
+    assert (job.completed_at - job.aborted_at).total_seconds() < 5
+
+
+def test_resource_ledger_only_reserves_what_is_free():
+    ledger = ResourceLedger(cpu_cores=4, memory_gb=8)
+    job = Job(image="busybox", command=[], arguments=[], memory_requested=6)
+
+    assert ledger.reserve(job)
+    assert ledger.available() == (3, 2)
+    # not enough memory left for a second one
+    assert not ledger.reserve(job)
+
+    ledger.release(job)
+    assert ledger.available() == (4, 8)
+
+
+def test_executor_runs_jobs_side_by_side():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["sleep"],
+        "arguments": ["2"],
+        "memory_requested": 1,
+        "cpu_cores_requested": 1,
+    }
+    job_ids = [client.post("/jobs", json=job_data).json()["id"] for _ in range(3)]
+
+    stop = threading.Event()
+    listener = threading.Thread(
+        target=listen_for_work,
+        kwargs={"gpu_type": "Any", "cpu_cores": 2, "memory_gb": 2, "stop": stop},
+    )
+    listener.start()
+    try:
+        # two fit at once, the third has to wait for one of them
+        assert wait_for(
+            lambda: [Job.load_status(job_id) for job_id in job_ids].count("running")
+            >= 2
+        )
+        assert Job.load_status(job_ids[2]) == "pending"
+
+        assert wait_for(lambda: Job.load_status(job_ids[2]) == "succeeded")
+    finally:
+        stop.set()
+        listener.join()
+
+    assert [Job.load_status(job_id) for job_id in job_ids] == ["succeeded"] * 3
+
+
+def test_idle_executor_wakes_up_when_work_shows_up():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "gpu_type": "AMD",
+    }
+    # nothing there, so we sit out the whole timeout
+    assert not wait_for_work("AMD", 1, 1, timeout=0.5)
+
+    woken = []
+    waiter = threading.Thread(
+        target=lambda: woken.append(wait_for_work("AMD", 1, 1, timeout=10))
+    )
+    waiter.start()
+    sleep(0.5)
+    started = perf_counter()
+    client.post("/jobs", json=job_data)
+    waiter.join()
+    assert woken == [True]
+    assert perf_counter() - started < 5
+
+    # a job for a gpu we don't have doesn't wake us
+    client.post("/jobs", json={**job_data, "gpu_type": "NVIDIA"})
+    assert not wait_for_work("AMD", 1, 1, timeout=0.5)
+
+
+def test_array_job_wakes_an_executor_per_task():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["true"],
+        "arguments": [],
+        "gpu_type": "AMD",
+        "array_size": 3,
+    }
+    client.post("/jobs", json=job_data)
+    assert [wait_for_work("AMD", 1, 1, timeout=0.5) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+    # and the same once what it waits on is done
+    first = client.post("/jobs", json={**job_data, "array_size": None}).json()["id"]
+    client.post("/jobs", json={**job_data, "depends_on": [first]})
+    assert wait_for_work("AMD", 1, 1, timeout=0.5)
+    assert not wait_for_work("AMD", 1, 1, timeout=0.5)
+    job = Job.load(first)
+    assert job.transition(["pending"], status="running")
+    assert job.transition(["running"], status="succeeded")
+    assert [wait_for_work("AMD", 1, 1, timeout=0.5) for _ in range(4)] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+
 def test_executor_startup_configuration(monkeypatch):
     monkeypatch.setenv("EXECUTOR_GPU_TYPE", "NVIDIA")
     monkeypatch.setenv("EXECUTOR_CPU_CORES", "1")
@@ -319,9 +895,520 @@ def test_executor_startup_configuration(monkeypatch):
     )
 
 
+def test_importing_the_executor_needs_neither_redis_nor_docker():
+    # nothing listens on port 1, anything that connects at import time blows up
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.executor, app.scheduler"],
+        env={
+            **os.environ,
+            "REDIS_URI": "redis://127.0.0.1:1/0",
+            "DOCKER_HOST": "tcp://127.0.0.1:1",
+        },
+        capture_output=True,
+        text=True,
+        timeout=60,
+        # the return code is what we're checking, with the output to go with it
+        check=False,
+    )
+    assert result.returncode == 0, result.stderr
+
+
 def test_we_can_work_off_of_the_dc():
     pass
 
 
 def test_we_Can_work_off_of_the_region():
     pass
+
+
+def expire_lease(job_id):
+    redis_client.zadd(INFLIGHT_KEY, {job_id: 0})
+
+
+@redis_only
+def test_job_of_a_dead_executor_goes_back_in_line():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 1,
+        "cpu_cores_requested": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    queue = queue_name("Any", "Any", "Any")
+    score = redis_client.zscore(queue, job_id)
+
+    # the executor dequeues the job and then dies before it ever claims it
+    assert Job.dequeue("Any", 1, 1, worker="executor-dead").id == job_id
+    assert redis_client.zscore(INFLIGHT_KEY, job_id) is not None
+    # nothing happens while the lease lasts
+    assert reap_expired_jobs() == ([], [])
+
+    expire_lease(job_id)
+    assert reap_expired_jobs() == ([job_id], [])
+
+    # back where it was in line, with a retry on the clock
+    assert redis_client.zscore(queue, job_id) == score
+    job = Job.load(job_id)
+    assert job.status == "pending"
+    assert job.retries == 1
+    assert job.worker is None
+
+    # and someone else gets to run it
+    complete_job = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert complete_job.id == job_id
+    assert complete_job.status == "succeeded"
+
+
+@redis_only
+def test_task_of_a_dead_executor_goes_back_in_line():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "array_size": 2,
+    }
+    array_id = client.post("/jobs", json=job_data).json()["id"]
+    queue = queue_name("Any", "Any", "Any")
+    score = redis_client.zscore(queue, array_id)
+
+    task = Job.dequeue("Any", 1, 1, worker="executor-dead")
+    expire_lease(task.id)
+    assert reap_expired_jobs() == ([task.id], [])
+    # where its array is in line, as a job of its own
+    assert redis_client.zscore(queue, task.id) == score
+
+    done = [handle_one_job("Any", 1, 1, "Any", "Any") for _ in range(2)]
+    assert sorted(job.id for job in done) == [f"{array_id}_0", f"{array_id}_1"]
+    assert Job.load(array_id).status == "succeeded"
+
+
+@redis_only
+def test_job_of_a_dead_executor_keeps_its_priority():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "dc": "reaped-priority-dc",
+        "priority": 3,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    queue = queue_name("Any", "reaped-priority-dc", "Any")
+    score = redis_client.zscore(queue, job_id)
+
+    assert Job.dequeue("Any", 1, 1, dc="reaped-priority-dc", worker="executor-dead")
+    expire_lease(job_id)
+    assert reap_expired_jobs() == ([job_id], [])
+    assert redis_client.zscore(queue, job_id) == pytest.approx(score)
+
+
+@redis_only
+def test_job_of_a_dead_executor_missing_from_the_index_goes_by_when_it_was_submitted():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "dc": "reaped-unindexed-dc",
+        "priority": 2,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    queue = queue_name("Any", "reaped-unindexed-dc", "Any")
+    score = redis_client.zscore(queue, job_id)
+
+    assert Job.dequeue("Any", 1, 1, dc="reaped-unindexed-dc", worker="executor-dead")
+    redis_client.zrem(ALL_JOBS_INDEX, job_id)
+    expire_lease(job_id)
+    assert reap_expired_jobs() == ([job_id], [])
+    assert redis_client.zscore(queue, job_id) == pytest.approx(score)
+
+
+@redis_only
+def test_job_that_keeps_losing_its_executor_fails():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 1,
+        "cpu_cores_requested": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    for _ in range(MAX_RETRIES):
+        assert Job.dequeue("Any", 1, 1, worker="executor-dead").id == job_id
+        assert Job.load(job_id).transition(["pending"], status="running")
+        expire_lease(job_id)
+        assert reap_expired_jobs() == ([job_id], [])
+        assert Job.load_status(job_id) == "pending"
+
+    Job.dequeue("Any", 1, 1, worker="executor-dead")
+    expire_lease(job_id)
+    assert reap_expired_jobs() == ([], [job_id])
+
+    job = Job.load(job_id)
+    assert job.status == "failed"
+    assert job.completed_at is not None
+    assert Job.list(status="failed")[0][0].id == job_id
+    assert Job.dequeue("Any", 1, 1) is None
+
+
+@redis_only
+def test_leases_are_only_renewed_by_their_owner():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "memory_requested": 1,
+        "cpu_cores_requested": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    Job.dequeue("Any", 1, 1, worker="executor-a")
+    expires = redis_client.zscore(INFLIGHT_KEY, job_id)
+
+    sleep(0.01)
+    assert renew_leases("executor-a", [job_id]) == []
+    assert redis_client.zscore(INFLIGHT_KEY, job_id) > expires
+
+    # executor-a got cut off for too long, the job went back in line and b picked it up
+    expire_lease(job_id)
+    reap_expired_jobs()
+    Job.dequeue("Any", 1, 1, worker="executor-b")
+    assert renew_leases("executor-a", [job_id]) == [job_id]
+    assert renew_leases("executor-b", [job_id]) == []
+
+    # finished jobs just get dropped once their lease runs out
+    Job.load(job_id).transition(["pending"], status="succeeded")
+    expire_lease(job_id)
+    assert reap_expired_jobs() == ([], [])
+    assert redis_client.zscore(INFLIGHT_KEY, job_id) is None
+
+
+@redis_only
+def test_executors_show_up_while_they_listen():
+    assert client.get("/executors").json() == []
+
+    stop = threading.Event()
+    listener = threading.Thread(
+        target=listen_for_work,
+        kwargs={"gpu_type": "AMD", "cpu_cores": 2, "memory_gb": 4, "stop": stop},
+    )
+    listener.start()
+    try:
+        [executor] = wait_for(lambda: client.get("/executors").json())
+        assert executor["name"] == "executor-1-127.0.0.1"
+        assert executor["gpu_type"] == "AMD"
+        assert executor["cpu_cores"] == 2
+        assert executor["memory_gb"] == 4
+        assert executor["cores_used"] == 0
+    finally:
+        stop.set()
+        listener.join()
+
+    # a clean shutdown takes us out of the registry right away
+    assert client.get("/executors").json() == []
+    assert redis_client.hgetall(FLEET_KEY) == {"cpu_cores": "0", "cores_used": "0"}
+
+
+def register(name, cpu_cores):
+    heartbeat(
+        name,
+        {
+            "name": name,
+            "cpu_cores": str(cpu_cores),
+            "memory_gb": "8",
+            "cores_used": "0",
+        },
+    )
+
+
+@redis_only
+def test_busy_executors_leave_fresh_jobs_to_idle_ones():
+    register("executor-busy", 4)
+    register("executor-idle", 4)
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "cpu_cores_requested": 3,
+    }
+    first_id = client.post("/jobs", json=job_data).json()["id"]
+    second_id = client.post("/jobs", json=job_data).json()["id"]
+
+    # the first job lands on an idle fleet, so whoever asks gets it
+    assert Job.dequeue("Any", 4, 8, worker="executor-busy").id == first_id
+    assert redis_client.hget("jobservitor:executor:executor-busy", "cores_used") == "3"
+    assert redis_client.hget(FLEET_KEY, "cores_used") == "3"
+
+    # a job that's been waiting for a while goes to whoever asks, busy or not
+    old_job = Job.model_validate(
+        {
+            **job_data,
+            "cpu_cores_requested": 1,
+            "submitted_at": datetime.now() - timedelta(minutes=1),
+        }
+    )
+    old_job.save()
+    old_job.enqueue()
+    assert Job.dequeue("Any", 4, 8, worker="executor-busy").id == old_job.id
+
+    # but we're at 100% against a fleet at 50%, so the fresh one is for someone else
+    assert Job.dequeue("Any", 4, 8, worker="executor-busy") is None
+    assert Job.dequeue("Any", 4, 8, worker="executor-idle").id == second_id
+
+
+@redis_only
+def test_executor_gives_back_the_cores_of_a_job_it_finished():
+    register(executor_name, 4)
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["true"],
+        "arguments": [],
+        "cpu_cores_requested": 3,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert handle_one_job("Any", 4, 8, "Any", "Any").id == job_id
+    assert Job.load_status(job_id) == "succeeded"
+    assert (
+        redis_client.hget(f"jobservitor:executor:{executor_name}", "cores_used") == "0"
+    )
+    assert redis_client.hget(FLEET_KEY, "cores_used") == "0"
+
+
+@redis_only
+def test_executors_that_stop_beating_get_pruned():
+    register("executor-a", 4)
+    register("executor-b", 8)
+    assert redis_client.hgetall(FLEET_KEY) == {"cpu_cores": "12", "cores_used": "0"}
+
+    # nothing from executor-a in ages
+    redis_client.zadd(EXECUTOR_REGISTRY, {"executor-a": 0})
+    assert prune_executors() == ["executor-a"]
+    assert [executor.name for executor in Executor.live()] == ["executor-b"]
+    assert redis_client.hgetall(FLEET_KEY) == {"cpu_cores": "8", "cores_used": "0"}
+
+
+@redis_only
+def test_job_that_runs_too_long_times_out():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["sleep"],
+        "arguments": ["30"],
+        "timeout_seconds": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    # same job with all the time it needs
+    job_data["arguments"] = ["1"]
+    job_data["timeout_seconds"] = 30
+    other_id = client.post("/jobs", json=job_data).json()["id"]
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(handle_one_job("Any", 1, 1, "Any", "Any"))
+        )
+        for _ in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    assert wait_for(lambda: redis_client.zcard(DEADLINE_INDEX) == 2)
+    # the scheduler's sweeper does this by itself within a second, this is just quicker
+    assert wait_for(time_out_overdue_jobs) == [job_id]
+    for thread in threads:
+        thread.join(timeout=30)
+    assert not any(thread.is_alive() for thread in threads)
+
+    # the executor got told to kill it, it didn't sit out the whole sleep
+    timed_out = Job.load(job_id)
+    assert timed_out.status == "timed_out"
+    assert (timed_out.completed_at - timed_out.started_at).total_seconds() < 10
+    assert Job.load_status(other_id) == "succeeded"
+    assert redis_client.zcard(DEADLINE_INDEX) == 0
+    assert [job.id for job in Job.list(status="timed_out")[0]] == [job_id]
+
+
+def test_job_that_runs_out_of_memory_is_oom_killed():
+    job_data = {
+        "image": "busybox:1.37",
+        # reads forever looking for a newline, holding on to all of it
+        "command": ["tail"],
+        "arguments": ["/dev/zero"],
+        "memory_requested": 1,
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    job = handle_one_job("Any", 1, 1, "Any", "Any")
+    assert job.id == job_id
+    assert job.status == "failed"
+    assert job.oom_killed
+    assert job.exit_code == 137
+    assert Job.load(job_id).oom_killed
+
+
+# the in-process backend, poked at directly so these run whichever backend is configured
+def memory_job(**fields) -> Job:
+    return Job(image="busybox:1.37", command=["uname"], arguments=["-a"], **fields)
+
+
+def test_memory_backend_keeps_jobs_that_dont_fit_in_line():
+    # 12GB and 8GB jobs land in the same memory bucket
+    big = [memory_job(memory_requested=12) for _ in range(3)]
+    small = memory_job(memory_requested=8)
+    assert persistence_memory.save_and_enqueue_jobs([*big, small]) == [True] * 4
+    queue = queue_name("Any", "Any", "Any", memory_gb=12)
+
+    assert persistence_memory.dequeue_job("Any", 1, 10)["id"] == small.id
+    assert persistence_memory.queued_job_ids(queue) == [job.id for job in big]
+    assert persistence_memory.dequeue_job("Any", 1, 10) is None
+    assert persistence_memory.dequeue_job("Any", 1, 16)["id"] == big[0].id
+
+
+def test_memory_backend_puts_jobs_of_dead_executors_back_in_line():
+    first, second = memory_job(), memory_job()
+    persistence_memory.save_and_enqueue_jobs([first, second])
+    queue = queue_name("Any", "Any", "Any")
+
+    assert persistence_memory.dequeue_job("Any", 1, 1, worker="executor-a")["id"] == (
+        first.id
+    )
+    assert persistence_memory.reap_expired_jobs() == ([], [])
+    persistence_memory.inflight[first.id] = 0
+    assert persistence_memory.reap_expired_jobs() == ([first.id], [])
+
+    # in front of the job that came after it, and executor-a doesn't hold it anymore
+    assert persistence_memory.queued_job_ids(queue) == [first.id, second.id]
+    assert persistence_memory.load_job(first.id)["retries"] == "1"
+    assert persistence_memory.renew_leases("executor-a", [first.id]) == [first.id]
+    assert persistence_memory.dequeue_job("Any", 1, 1, worker="executor-b")["id"] == (
+        first.id
+    )
+    assert persistence_memory.renew_leases("executor-b", [first.id]) == []
+
+
+def test_memory_backend_puts_jobs_missing_from_the_index_back_by_submission():
+    first, second = memory_job(), memory_job()
+    persistence_memory.save_and_enqueue_jobs([first, second])
+    queue = queue_name("Any", "Any", "Any")
+
+    assert persistence_memory.dequeue_job("Any", 1, 1, worker="executor-a")["id"] == (
+        first.id
+    )
+    del persistence_memory.scores[first.id]
+    persistence_memory.inflight[first.id] = 0
+    assert persistence_memory.reap_expired_jobs() == ([first.id], [])
+    assert persistence_memory.queued_job_ids(queue) == [first.id, second.id]
+
+
+def test_memory_backend_busy_executors_leave_fresh_jobs_to_idle_ones():
+    for name in ("executor-busy", "executor-idle"):
+        persistence_memory.heartbeat(
+            name, {"name": name, "cpu_cores": "4", "cores_used": "0"}
+        )
+    first, second = memory_job(cpu_cores_requested=3), memory_job(cpu_cores_requested=3)
+    persistence_memory.save_and_enqueue_jobs([first, second])
+
+    assert persistence_memory.dequeue_job("Any", 4, 8, worker="executor-busy")[
+        "id"
+    ] == (first.id)
+    assert persistence_memory.dequeue_job("Any", 4, 8, worker="executor-busy") is None
+    assert persistence_memory.dequeue_job("Any", 4, 8, worker="executor-idle")[
+        "id"
+    ] == (second.id)
+
+    # done with the first one, back in line for work
+    persistence_memory.wake_executor("executor-busy", released_cores=3)
+    assert persistence_memory.executors["executor-busy"]["cores_used"] == "0"
+
+
+def test_memory_backend_wakes_up_waiting_executors():
+    assert not persistence_memory.wait_for_work("Any", 1, 1, timeout=0.1)
+
+    woken = []
+    waiter = threading.Thread(
+        target=lambda: woken.append(
+            persistence_memory.wait_for_work("Any", 1, 1, timeout=5)
+        )
+    )
+    waiter.start()
+    start = perf_counter()
+    persistence_memory.enqueue_job(memory_job())
+    waiter.join()
+    assert woken == [True]
+    assert perf_counter() - start < 1
+
+    # an array job wakes up as many as it has tasks
+    persistence_memory.enqueue_job(memory_job(array_size=3))
+    assert [
+        persistence_memory.wait_for_work("Any", 1, 1, timeout=0.1) for _ in range(4)
+    ] == [True, True, True, False]
+
+
+def test_memory_backend_times_out_overdue_jobs():
+    job = memory_job(timeout_seconds=1)
+    persistence_memory.save_and_enqueue_jobs([job])
+    aborts = []
+    persistence_memory.subscribe_to_aborts("executor-a", aborts.append)
+
+    persistence_memory.dequeue_job("Any", 1, 1, worker="executor-a")
+    assert persistence_memory.update_job(job.id, {"status": "running"}, ["pending"])
+    assert persistence_memory.time_out_overdue_jobs() == []
+    persistence_memory.deadlines[job.id] = 0
+
+    assert persistence_memory.time_out_overdue_jobs() == [job.id]
+    assert aborts == [job.id]
+    assert persistence_memory.load_job_field(job.id, "status") == "timed_out"
+    assert job.id not in persistence_memory.deadlines
+
+
+def test_job_records_round_trip_in_every_version():
+    job = Job(
+        image="busybox",
+        command=["sh", "-c"],
+        arguments=["echo hi"],
+        memory_requested=2,
+        status="succeeded",
+        completed_at=datetime.now(),
+        exit_code=0,
+        oom_killed=True,
+        run_seconds=1.5,
+    )
+    record = job.to_record()
+    assert record["v"] == "2"
+    assert Job.from_record(record) == job
+
+    # what we used to write: every field, unset ones as empty strings, and no version
+    old = {field: value for field, value in record.items() if field != "v"}
+    assert old["aborted_at"] == ""
+    assert Job.from_record(old) == job
+
+    # and before that, the whole job as json
+    assert Job.from_record({"v": "0", "json": job.model_dump_json()}) == job
+    with pytest.raises(ValueError):
+        Job.from_record({**record, "v": "99"})
+
+
+@redis_only
+def test_jobs_saved_as_json_are_still_readable():
+    # how jobs were saved before they were hashes
+    job = Job(image="busybox", command=["true"], arguments=[], priority=3)
+    redis_client.set(PROJECT_PREFIX + job.id, job.model_dump_json())
+
+    assert Job.load(job.id) == job
+    assert Job.load_status(job.id) == "pending"
+    assert persistence.load_jobs([job.id]) == [persistence.load_job(job.id)]
+    response = client.get(f"/jobs/{job.id}")
+    assert response.status_code == 200
+    assert response.json()["priority"] == 3
+
+
+def test_unset_fields_are_not_stored():
+    job_data = {"image": "busybox", "command": ["true"], "arguments": []}
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    record = persistence.load_job(job_id)
+    assert "" not in record.values()
+    assert "completed_at" not in record
+
+    job = Job.load(job_id)
+    assert job.transition(["pending"], worker="someone")
+    assert job.transition(["pending"], worker=None)
+    assert "worker" not in persistence.load_job(job_id)
+    assert Job.load(job_id).worker is None
@@ -1,14 +1,39 @@
+import pytest
 from fastapi.testclient import TestClient
 
+import asyncio
+import redis
 import threading
-from app.models import Job
+from app import persistence, persistence_async, persistence_memory_async
+from app.job_store import SqliteJobStore
+from app.models import Job, redis_client
+from app.persistence import (
+    BACKEND,
+    PROJECT_PREFIX,
+    append_job_logs,
+    archive_jobs,
+    finish_job_logs,
+    queue_name,
+    queued_job_ids,
+)
 from app.executor import handle_one_job
+from app import scheduler
 from app.scheduler import app
 from uuid import uuid4
-from time import sleep
+from time import perf_counter, sleep
 
 client = TestClient(app)
 
+# these look inside redis directly
+redis_only = pytest.mark.skipif(BACKEND != "redis", reason="looks inside redis")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def lifespan():
+    # runs the app's lifespan (and so the async redis pool) around every test in here
+    with client:
+        yield
+
 
 # happy path
 def test_submit_job():
@@ -48,6 +73,52 @@ def test_submitting_and_getting_job_back():
     assert list_response.json()[0]["dc"] == "Any"
 
 
+def test_submitting_a_batch_of_jobs():
+    job_data = {
+        "image": "busybox",
+        "command": ["uname"],
+        "arguments": ["-a"],
+        "gpu_type": "NVIDIA",
+    }
+    response = client.post("/jobs/batch", json=[job_data] * 3)
+    assert response.status_code == 200
+    job_ids = [result["id"] for result in response.json()]
+    assert len(set(job_ids)) == 3
+
+    for job_id in job_ids:
+        assert Job.load(job_id).status == "pending"
+
+    # and they are queued up in the order we sent them
+    assert queued_job_ids(queue_name("NVIDIA", "Any", "Any")) == job_ids
+
+
+def test_a_bad_job_does_not_sink_the_batch():
+    job_data = {
+        "image": "busybox",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    response = client.post(
+        "/jobs/batch", json=[job_data, {**job_data, "gpu_type": "TPU"}, job_data]
+    )
+    assert response.status_code == 200
+    first, bad, last = response.json()
+
+    assert Job.load(first["id"]) is not None
+    assert Job.load(last["id"]) is not None
+    assert "id" not in bad
+    assert bad["error"][0]["loc"] == ["gpu_type"]
+
+
+def test_jobs_ask_for_at_least_a_core_and_a_gigabyte():
+    job_data = {"image": "busybox", "command": ["uname"], "arguments": ["-a"]}
+    for field in ("memory_requested", "cpu_cores_requested"):
+        for value in (0, -4):
+            response = client.post("/jobs", json={**job_data, field: value})
+            assert response.status_code == 422
+            assert response.json()["detail"][0]["loc"] == ["body", field]
+
+
 def test_housekeeping_parameters_cannot_be_set_on_job_creation():
     job_data = {
         "image": "python:3.8",
@@ -81,6 +152,137 @@ def test_housekeeping_parameters_cannot_be_set_on_job_creation():
     assert job["completed_at"] is None
 
 
+def test_listing_includes_jobs_that_are_no_longer_queued():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    pending_id = client.post("/jobs", json=job_data).json()["id"]
+    aborted_id = client.post("/jobs", json=job_data).json()["id"]
+    assert client.delete(f"/jobs/{aborted_id}").status_code == 200
+
+    listed = client.get("/jobs").json()
+    assert [job["id"] for job in listed] == [pending_id, aborted_id]
+
+    listed = client.get("/jobs", params={"status": "aborted"}).json()
+    assert [job["id"] for job in listed] == [aborted_id]
+    listed = client.get("/jobs", params={"status": "pending"}).json()
+    assert [job["id"] for job in listed] == [pending_id]
+
+
+def test_listing_filters_by_gpu_dc_and_region():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    client.post("/jobs", json=job_data)
+    nvidia_id = client.post("/jobs", json={**job_data, "gpu_type": "NVIDIA"}).json()[
+        "id"
+    ]
+    az1_id = client.post(
+        "/jobs", json={**job_data, "dc": "us-east-1", "region": "az1"}
+    ).json()["id"]
+
+    listed = client.get("/jobs", params={"gpu_type": "NVIDIA"}).json()
+    assert [job["id"] for job in listed] == [nvidia_id]
+    listed = client.get("/jobs", params={"dc": "us-east-1", "region": "az1"}).json()
+    assert [job["id"] for job in listed] == [az1_id]
+    listed = client.get("/jobs", params={"status": "pending", "region": "az2"}).json()
+    assert listed == []
+
+
+def test_listing_is_paginated():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    response = client.post("/jobs/batch", json=[job_data] * 5)
+    job_ids = [result["id"] for result in response.json()]
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/jobs", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen += [job["id"] for job in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert seen == job_ids
+
+
+@pytest.fixture
+def job_store(tmp_path, monkeypatch):
+    store = SqliteJobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(persistence, "job_store", store)
+    return store
+
+
+@redis_only
+def test_finished_jobs_are_archived_to_the_job_store(job_store):
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    pending_id = client.post("/jobs", json=job_data).json()["id"]
+    aborted_id = client.post("/jobs", json=job_data).json()["id"]
+    assert client.delete(f"/jobs/{aborted_id}").status_code == 200
+
+    # not old enough yet
+    assert archive_jobs() == 0
+    assert archive_jobs(delay=0) == 1
+    # gone from redis, the pending one is still there
+    assert not redis_client.exists(PROJECT_PREFIX + aborted_id)
+    assert redis_client.exists(PROJECT_PREFIX + pending_id)
+
+    job = client.get(f"/jobs/{aborted_id}").json()
+    assert job["status"] == "aborted"
+    assert Job.load_status(aborted_id) == "aborted"
+    # aborting it again still knows it's done
+    assert client.delete(f"/jobs/{aborted_id}").status_code == 400
+
+    listed = client.get("/jobs").json()
+    assert [job["id"] for job in listed] == [pending_id, aborted_id]
+    listed = client.get("/jobs", params={"status": "aborted"}).json()
+    assert [job["id"] for job in listed] == [aborted_id]
+    listed = client.get("/jobs", params={"status": "pending"}).json()
+    assert [job["id"] for job in listed] == [pending_id]
+
+
+def test_listing_is_paginated_across_redis_and_the_job_store(job_store):
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    response = client.post("/jobs/batch", json=[job_data] * 7)
+    job_ids = [result["id"] for result in response.json()]
+    # every other job finishes and gets archived
+    for job_id in job_ids[::2]:
+        assert client.delete(f"/jobs/{job_id}").status_code == 200
+    assert archive_jobs(delay=0) == 4
+
+    for limit in (1, 2, 3, 10):
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+            response = client.get("/jobs", params=params)
+            assert len(response.json()) <= limit
+            seen += [job["id"] for job in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert seen == job_ids
+
+
 def test_fetching_a_job_by_id():
     job_data = {
         "image": uuid4().hex,
@@ -125,6 +327,39 @@ def test_abort_pending_job():
     assert Job.load(response.json()["id"]).status == "aborted"
 
 
+def test_job_status_can_be_read_without_loading_the_job():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert Job.load_status(job_id) == "pending"
+    assert Job.load_status(uuid4().hex) is None
+
+
+def test_abort_and_completion_cant_overwrite_each_other():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["uname"],
+        "arguments": ["-a"],
+    }
+    job = Job.load(client.post("/jobs", json=job_data).json()["id"])
+    assert job.transition(["pending"], status="running", worker="executor-test")
+
+    assert client.delete(f"/jobs/{job.id}").status_code == 200
+
+    # the executor finishing late doesn't undo the abort
+    assert not job.transition(["running"], status="succeeded")
+    assert job.status == "running"
+
+    job = Job.load(job.id)
+    assert job.status == "aborted"
+    assert job.aborted_at is not None
+    assert job.worker == "executor-test"
+
+
 def test_abort_succeeded_job():
     # succeeded job should NOT be abortable
     job_data = {
@@ -194,9 +429,412 @@ def test_abort_running_job():
     assert Job.load(response.json()["id"]).status == "aborted"
 
 
+def test_aborting_a_pending_job_takes_it_out_of_its_queue():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    kept_id = client.post("/jobs", json=job_data).json()["id"]
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [job_id, kept_id]
+
+    assert client.delete(f"/jobs/{job_id}").status_code == 200
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [kept_id]
+    assert Job.load(job_id).status == "aborted"
+
+    # never came across by an executor either
+    assert Job.dequeue("Any", 1, 1).id == kept_id
+    assert Job.dequeue("Any", 1, 1) is None
+
+
+def test_aborting_a_job_that_does_not_exist():
+    assert client.delete(f"/jobs/{uuid4()}").status_code == 404
+
+
+def test_jobs_can_be_aborted_in_bulk_by_filter(monkeypatch):
+    # a few jobs per call, so it has to pick up where it left off a few times
+    monkeypatch.setattr(persistence, "ABORT_LIMIT", 2)
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    busybox = [
+        job["id"] for job in client.post("/jobs/batch", json=[job_data] * 5).json()
+    ]
+    python = client.post("/jobs", json={**job_data, "image": "python:3.12"}).json()[
+        "id"
+    ]
+    running = Job.dequeue("Any", 1, 1, worker="executor-bulk")
+    assert running.id == busybox[0]
+    assert running.transition(["pending"], status="running", worker="executor-bulk")
+
+    response = client.delete(
+        "/jobs", params={"status": "pending", "image": "busybox:1.37"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"aborted": 4}
+    assert Job.load_status(busybox[0]) == "running"
+    assert [Job.load_status(job_id) for job_id in busybox[1:]] == ["aborted"] * 4
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [python]
+
+    # without a status it's the running ones too
+    response = client.delete("/jobs", params={"image": "busybox:1.37"})
+    assert response.json() == {"aborted": 1}
+    assert Job.load_status(busybox[0]) == "aborted"
+    assert Job.load_status(python) == "pending"
+
+
+def test_jobs_can_be_aborted_in_bulk_by_id():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    job_ids = [
+        job["id"] for job in client.post("/jobs/batch", json=[job_data] * 3).json()
+    ]
+    assert client.delete(f"/jobs/{job_ids[0]}").status_code == 200
+
+    response = client.request("DELETE", "/jobs", json=[*job_ids, str(uuid4())])
+    assert response.status_code == 200
+    # the one that was aborted already, and the one that doesn't exist, are skipped
+    assert response.json() == {"aborted": 2}
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == []
+
+
+def test_bulk_abort_has_to_be_told_which_jobs():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+
+    assert client.delete("/jobs").status_code == 400
+    response = client.request(
+        "DELETE", "/jobs", params={"image": "busybox:1.37"}, json=[job_id]
+    )
+    assert response.status_code == 400
+    assert client.delete("/jobs", params={"status": "succeeded"}).status_code == 422
+    assert Job.load_status(job_id) == "pending"
+
+
+def run_to_completion(job_id, status="succeeded"):
+    job = Job.dequeue("Any", 1, 1, worker="executor-deps")
+    assert job.id == job_id
+    assert job.transition(["pending"], status="running")
+    assert job.transition(["running"], status=status)
+
+
+def test_dependent_jobs_wait_for_their_dependencies():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    prep = client.post("/jobs", json=job_data).json()["id"]
+    other = client.post("/jobs", json=job_data).json()["id"]
+    train = client.post("/jobs", json={**job_data, "depends_on": [prep]}).json()["id"]
+    evaluate = client.post(
+        "/jobs", json={**job_data, "depends_on": [train, other, train]}
+    ).json()["id"]
+
+    # nothing waiting on something is in a queue
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [prep, other]
+    assert Job.load(train).status == "waiting"
+    assert Job.load(train).dependencies_left == 1
+    assert Job.load(evaluate).dependencies_left == 2
+    listed = client.get("/jobs", params={"status": "waiting"}).json()
+    assert [job["id"] for job in listed] == [train, evaluate]
+
+    run_to_completion(prep)
+    assert Job.load_status(train) == "pending"
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [other, train]
+
+    run_to_completion(other)
+    assert Job.load_status(evaluate) == "waiting"
+    run_to_completion(train)
+    assert Job.load_status(evaluate) == "pending"
+    assert Job.dequeue("Any", 1, 1).id == evaluate
+
+
+def test_a_failed_dependency_fails_everything_downstream():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    prep = client.post("/jobs", json=job_data).json()["id"]
+    train = client.post("/jobs", json={**job_data, "depends_on": [prep]}).json()["id"]
+    evaluate = client.post("/jobs", json={**job_data, "depends_on": [train]}).json()[
+        "id"
+    ]
+
+    run_to_completion(prep, status="failed")
+    train_job, evaluate_job = Job.load(train), Job.load(evaluate)
+    assert (train_job.status, train_job.failed_dependency) == ("failed", prep)
+    assert (evaluate_job.status, evaluate_job.failed_dependency) == ("failed", train)
+    assert evaluate_job.completed_at is not None
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == []
+
+    # aborting a job counts as it failing, for whatever depends on it
+    first = client.post("/jobs", json=job_data).json()["id"]
+    then = client.post("/jobs", json={**job_data, "depends_on": [first]}).json()["id"]
+    assert client.delete(f"/jobs/{first}").status_code == 200
+    assert Job.load(then).failed_dependency == first
+
+
+def test_depending_on_jobs_that_are_already_done():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    done = client.post("/jobs", json=job_data).json()["id"]
+    run_to_completion(done)
+
+    ready = client.post("/jobs", json={**job_data, "depends_on": [done]}).json()["id"]
+    assert Job.load_status(ready) == "pending"
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [ready]
+
+    missing = str(uuid4())
+    response = client.post("/jobs/batch", json=[{**job_data, "depends_on": [missing]}])
+    orphan = Job.load(response.json()[0]["id"])
+    assert (orphan.status, orphan.failed_dependency) == ("failed", missing)
+
+
+@redis_only
+def test_depending_on_jobs_that_are_archived_already(job_store):
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    done = client.post("/jobs", json=job_data).json()["id"]
+    run_to_completion(done)
+    assert archive_jobs(delay=0) == 1
+    assert not redis_client.exists(PROJECT_PREFIX + done)
+
+    ready = client.post("/jobs", json={**job_data, "depends_on": [done]}).json()["id"]
+    assert Job.load_status(ready) == "pending"
+
+
+def test_array_jobs_are_one_job_however_many_tasks():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    array_id = client.post("/jobs", json={**job_data, "array_size": 3}).json()["id"]
+    then = client.post("/jobs", json={**job_data, "depends_on": [array_id]}).json()[
+        "id"
+    ]
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == [array_id]
+
+    tasks = [Job.dequeue("Any", 1, 1, worker="executor-array") for _ in range(3)]
+    assert [task.id for task in tasks] == [f"{array_id}_{i}" for i in range(3)]
+    assert [task.array_index for task in tasks] == [0, 1, 2]
+    assert all(task.array_id == array_id for task in tasks)
+    assert all(task.image == "busybox:1.37" and not task.array_size for task in tasks)
+    assert Job.dequeue("Any", 1, 1) is None
+
+    # listed as the one job it is
+    listed = client.get("/jobs").json()
+    assert [job["id"] for job in listed] == [array_id, then]
+    assert (listed[0]["status"], listed[0]["tasks_claimed"]) == ("running", 3)
+
+    for task in tasks:
+        assert task.transition(["pending"], status="running")
+        assert task.transition(["running"], status="succeeded")
+    array = Job.load(array_id)
+    assert (array.status, array.tasks_succeeded, array.tasks_failed) == (
+        "succeeded",
+        3,
+        None,
+    )
+    assert array.completed_at is not None
+    # and what waits on the array goes once all of it is done
+    assert Job.load_status(then) == "pending"
+    # with no job store to archive them to, the tasks don't outlive their array's counters
+    assert [Job.load(task.id) for task in tasks] == [None] * 3
+
+
+def test_aborting_an_array_job_aborts_its_tasks():
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    array_id = client.post("/jobs", json={**job_data, "array_size": 3}).json()["id"]
+    running = Job.dequeue("Any", 1, 1, worker="executor-array")
+    assert running.transition(["pending"], status="running", worker="executor-array")
+
+    response = client.delete("/jobs", params={"image": "busybox:1.37"})
+    assert response.json() == {"aborted": 1}
+    array = Job.load(array_id)
+    assert (array.status, array.tasks_failed) == ("aborted", 1)
+    # the running task got aborted, and with no job store that's the last of it
+    assert Job.load_status(running.id) is None
+    # the tasks nobody claimed yet go with it
+    assert queued_job_ids(queue_name("Any", "Any", "Any")) == []
+    assert Job.dequeue("Any", 1, 1) is None
+
+
+def test_archived_tasks_are_listed_as_their_array(job_store):
+    job_data = {"image": "busybox:1.37", "command": ["true"], "arguments": []}
+    array_id = client.post("/jobs", json={**job_data, "array_size": 2}).json()["id"]
+    for _ in range(2):
+        task = Job.dequeue("Any", 1, 1, worker="executor-array")
+        assert task.transition(["pending"], status="running")
+        assert task.transition(["running"], status="failed")
+    assert Job.load(array_id).tasks_failed == 2
+    assert archive_jobs(delay=0) == 3
+
+    listed = client.get("/jobs").json()
+    assert [(job["id"], job["status"]) for job in listed] == [(array_id, "failed")]
+    assert client.get(f"/jobs/{array_id}_1").json()["status"] == "failed"
+
+
+def test_job_logs_are_kept():
+    job_data = {
+        "image": "busybox:1.37",
+        "command": ["echo"],
+        "arguments": ["hello there"],
+    }
+    job_id = client.post("/jobs", json=job_data).json()["id"]
+    handle_one_job("Any", 1, 1, "Any", "Any")
+
+    response = client.get(f"/jobs/{job_id}/logs")
+    assert response.status_code == 200
+    assert "hello there" in response.text
+
+    assert client.get(f"/jobs/{uuid4()}/logs").status_code == 404
+
+
+def test_job_logs_can_be_tailed():
+    job_id = client.post(
+        "/jobs", json={"image": "busybox", "command": ["seq"], "arguments": ["5"]}
+    ).json()["id"]
+    # lines don't line up with chunks
+    for chunk in ["1\n2", "\n3\n", "4\n5\n"]:
+        append_job_logs(job_id, chunk)
+    finish_job_logs(job_id)
+
+    logs = client.get(f"/jobs/{job_id}/logs")
+    assert logs.text == "1\n2\n3\n4\n5\n"
+    tail = client.get(f"/jobs/{job_id}/logs", params={"tail": 2})
+    assert tail.text == "4\n5\n"
+    tail = client.get(f"/jobs/{job_id}/logs", params={"tail": 4})
+    assert tail.text == "2\n3\n4\n5\n"
+    tail = client.get(f"/jobs/{job_id}/logs", params={"tail": 10})
+    assert tail.text == logs.text
+
+
+def test_job_logs_can_be_followed():
+    job_id = client.post(
+        "/jobs", json={"image": "busybox", "command": ["seq"], "arguments": ["3"]}
+    ).json()["id"]
+    append_job_logs(job_id, "1\n")
+
+    def print_the_rest():
+        sleep(0.5)
+        append_job_logs(job_id, "2\n")
+        sleep(0.5)
+        append_job_logs(job_id, "3\n")
+        finish_job_logs(job_id)
+
+    printer = threading.Thread(target=print_the_rest)
+    printer.start()
+    started = perf_counter()
+    response = client.get(f"/jobs/{job_id}/logs", params={"follow": True})
+    printer.join()
+
+    # the response stayed open until the job was done printing
+    assert response.text == "1\n2\n3\n"
+    assert perf_counter() - started >= 1
+
+
+def test_following_the_logs_of_a_job_that_has_not_started_yet(monkeypatch):
+    # check on the job every 0.1s instead of every few seconds
+    monkeypatch.setattr(persistence_async, "LOG_FOLLOW_BLOCK_MS", 100)
+    monkeypatch.setattr(persistence_memory_async, "LOG_FOLLOW_BLOCK_SECONDS", 0.1)
+    job_data = {"image": "busybox", "command": ["seq"], "arguments": ["1"]}
+    first_id = client.post("/jobs", json=job_data).json()["id"]
+    job_id = client.post("/jobs", json={**job_data, "depends_on": [first_id]}).json()[
+        "id"
+    ]
+    assert Job.load_status(job_id) == "waiting"
+
+    def run_later():
+        sleep(0.5)
+        append_job_logs(job_id, "1\n")
+        finish_job_logs(job_id)
+
+    runner = threading.Thread(target=run_later)
+    runner.start()
+    response = client.get(f"/jobs/{job_id}/logs", params={"follow": True})
+    runner.join()
+
+    # waiting isn't done, the response stayed open until the job printed
+    assert response.text == "1\n"
+
+
+def test_log_followers_are_turned_away_once_there_are_too_many(monkeypatch):
+    monkeypatch.setattr(persistence, "LOG_FOLLOWERS_LIMIT", 1)
+    job_id = client.post(
+        "/jobs", json={"image": "busybox", "command": ["seq"], "arguments": ["2"]}
+    ).json()["id"]
+    append_job_logs(job_id, "1\n")
+
+    # one follower takes the only slot, and holds it for as long as it follows
+    followed = []
+    follower = threading.Thread(
+        target=lambda: followed.append(
+            client.get(f"/jobs/{job_id}/logs", params={"follow": True}).text
+        )
+    )
+    follower.start()
+    for _ in range(100):
+        if persistence_async.log_followers():
+            break
+        sleep(0.1)
+    assert persistence_async.log_followers() == 1
+
+    response = client.get(f"/jobs/{job_id}/logs", params={"follow": True})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+    # just reading them is fine
+    assert client.get(f"/jobs/{job_id}/logs").text == "1\n"
+
+    # and the slot is free again once the first one is done
+    append_job_logs(job_id, "2\n")
+    finish_job_logs(job_id)
+    follower.join(timeout=10)
+    assert followed == ["1\n2\n"]
+    assert persistence_async.log_followers() == 0
+    response = client.get(f"/jobs/{job_id}/logs", params={"follow": True})
+    assert response.text == "1\n2\n"
+    assert persistence_async.log_followers() == 0
+
+
+def test_reaper_rides_out_redis_errors_but_not_bugs(monkeypatch, capsys):
+    monkeypatch.setattr(scheduler, "REAPER_INTERVAL", 0)
+    errors = [redis.ConnectionError("redis went away"), KeyError("a bug")]
+
+    async def failing_reap():
+        raise errors.pop(0)
+
+    monkeypatch.setattr(persistence_async, "reap_expired_jobs", failing_reap)
+    with pytest.raises(KeyError):
+        asyncio.run(scheduler.reap_expired_jobs())
+    # it kept going past the redis error, and said where it came from
+    assert errors == []
+    output = capsys.readouterr().out
+    assert "Reaper could not reap" in output
+    assert "Traceback" in output and "redis went away" in output
+
+
 def test_we_can_Schedule_by_Region():
     pass
 
 
 def test_we_can_Schedule_by_DC():
     pass
+
+
+def test_metrics_show_the_queues_and_what_went_through_them():
+    job_data = {
+        "image": "busybox",
+        "command": ["true"],
+        "arguments": [],
+        "dc": "metrics-dc",
+        "region": "metrics-region",
+    }
+    for _ in range(3):
+        assert client.post("/jobs", json=job_data).status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    shard = queue_name("Any", "metrics-dc", "metrics-region").removeprefix(
+        persistence.QUEUE_PREFIX
+    )
+    assert f'jobservitor_queue_depth{{queue="{shard}"}} 3' in lines
+    age = next(
+        line
+        for line in lines
+        if line.startswith(
+            f'jobservitor_queue_oldest_job_age_seconds{{queue="{shard}"}}'
+        )
+    )
+    assert float(age.split()[-1]) >= 0
+    assert any(
+        line.startswith(
+            'jobservitor_persistence_seconds_count{operation="save_and_enqueue"}'
+        )
+        for line in lines
+    )
+    assert any(line.startswith("jobservitor_enqueued_jobs_total ") for line in lines)